@@ -0,0 +1,172 @@
+"""SMB LZ batch export
+
+Exports many .blend files at once by running background Blender
+(blender -b) over each file, several Blender processes at a time.
+
+    python SMB_LZ_Batch.py "stages/*.blend" --output-dir build
+    python SMB_LZ_Batch.py a.blend b.blend --scene "Stage*" --compression NORMAL --jobs 4
+
+Every scene matching --scene (all scenes by default) is exported to
+<output-dir>/<blend name>_<scene name>.lz.raw, or .lz when compressed.
+A file with a single matching scene is exported as <blend name>.lz.raw.
+The same script runs inside each Blender process to do the export.
+"""
+import argparse
+import concurrent.futures
+import fnmatch
+import glob
+import json
+import os
+import subprocess
+import sys
+import time
+
+resultPrefix = "SMB_LZ_BATCH "      # Marks result lines printed by the Blender side
+
+
+def exportInBlender(argv):
+    """Runs inside background Blender, exports the scenes of the open .blend"""
+    import bpy
+
+    parser = argparse.ArgumentParser(prog="SMB_LZ_Batch.py (inside Blender)")
+    parser.add_argument("--output-dir", required=True)
+    parser.add_argument("--scene", action='append')
+    parser.add_argument("--compression", default='NONE')
+    args = parser.parse_args(argv)
+
+    # The exporter sits next to this script
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import SMB_LZ_Export
+    bpy.utils.register_class(SMB_LZ_Export.SMBLZExporter)
+
+    patterns = args.scene or ["*"]
+    scenes = [scene for scene in bpy.data.scenes if any(fnmatch.fnmatchcase(scene.name, p) for p in patterns)]
+    blendName = os.path.splitext(os.path.basename(bpy.data.filepath))[0]
+
+    failed = False
+    for scene in scenes:
+        name = blendName if len(scenes) == 1 else "%s_%s" % (blendName, scene.name)
+        filepath = os.path.join(args.output_dir, name + ".lz.raw")
+        start = time.perf_counter()
+        error = None
+        # The depsgraph belongs to a view layer, without one of this scene's the modifiers and visibility
+        # would be evaluated for the active scene
+        override = {'scene': scene}
+        if hasattr(scene, "view_layers"):
+            override['view_layer'] = scene.view_layers[0]
+        try:
+            if hasattr(bpy.context, "temp_override"):
+                with bpy.context.temp_override(**override):
+                    bpy.ops.export_smb.lz(filepath=filepath, compressionLevel=args.compression)
+            else:
+                bpy.ops.export_smb.lz(override, filepath=filepath, compressionLevel=args.compression)
+        except Exception as exception:
+            error = str(exception)
+            failed = True
+        print(resultPrefix + json.dumps({
+            'scene': scene.name,
+            'output': filepath,
+            'seconds': time.perf_counter() - start,
+            'error': error,
+            }), flush=True)
+
+    if not scenes:
+        print(resultPrefix + json.dumps({'scene': None, 'output': None, 'seconds': 0.0,
+                                         'error': "no scene matches %s" % ", ".join(patterns)}), flush=True)
+        failed = True
+    if failed:
+        sys.exit(1)
+
+
+def runJob(blender, blendPath, args):
+    """Exports one .blend in its own background Blender, returns its summary"""
+    command = [blender, "-b", blendPath, "--python-exit-code", "1", "--python", os.path.abspath(__file__), "--",
+               "--output-dir", os.path.abspath(args.output_dir), "--compression", args.compression]
+    for scene in args.scene or []:
+        command += ["--scene", scene]
+
+    start = time.perf_counter()
+    output = ""
+    error = None
+    try:
+        process = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                 universal_newlines=True, timeout=args.timeout)
+        output = process.stdout
+        if process.returncode != 0:
+            # Keep the end of Blender's log in case it failed before the exporter reported anything
+            error = "\n".join(output.strip().splitlines()[-5:]) or "Blender exited with %d" % process.returncode
+    except subprocess.TimeoutExpired as exception:
+        output = exception.output or ""
+        error = "timed out after %gs" % args.timeout
+    except OSError as exception:
+        error = str(exception)
+
+    exports = [json.loads(line[len(resultPrefix):]) for line in output.splitlines() if line.startswith(resultPrefix)]
+    if any(export['error'] for export in exports) and error and not error.startswith("timed out"):
+        # The failed exports already say what went wrong
+        error = None
+    return {
+        'blend': blendPath,
+        'seconds': time.perf_counter() - start,
+        'exports': exports,
+        'error': error,
+        }
+
+
+def printSummary(results, wallSeconds):
+    failures = 0
+    jobSeconds = 0.0
+    for result in results:
+        jobSeconds += result['seconds']
+        if result['error']:
+            failures += 1
+            print("FAIL %7.2fs %s: %s" % (result['seconds'], result['blend'], result['error']))
+        for export in result['exports']:
+            if export['error']:
+                failures += 1
+                print("FAIL %7.2fs %s [%s]: %s" % (export['seconds'], result['blend'], export['scene'], export['error']))
+            else:
+                print("ok   %7.2fs %s [%s] -> %s" % (export['seconds'], result['blend'], export['scene'], export['output']))
+    print("%d files, %d failures, %.2fs wall, %.2fs total Blender time" % (len(results), failures, wallSeconds, jobSeconds))
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export .blend files to SMB LZ stages with background Blender")
+    parser.add_argument("blends", nargs='+', help=".blend files or glob patterns")
+    parser.add_argument("--output-dir", default=".", help="where to write the stages")
+    parser.add_argument("--scene", action='append', help="scene name or pattern to export (repeatable, default all)")
+    parser.add_argument("--compression", default='NONE', choices=['NONE', 'FAST', 'NORMAL', 'BEST'])
+    parser.add_argument("--blender", default=os.environ.get("BLENDER", "blender"), help="Blender executable")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1, help="Blender processes to run at once")
+    parser.add_argument("--timeout", type=float, default=None, help="seconds before a Blender process is killed")
+    parser.add_argument("--report", help="write the summary as JSON to this file")
+    args = parser.parse_args(argv)
+
+    blends = []
+    for pattern in args.blends:
+        matches = sorted(glob.glob(pattern, recursive=True)) if glob.has_magic(pattern) else [pattern]
+        blends.extend(path for path in matches if path not in blends)
+    if not blends:
+        parser.error("no .blend files match")
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    # Each job is its own Blender process, the threads only wait on them
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, args.jobs)) as pool:
+        results = list(pool.map(lambda blend: runJob(args.blender, blend, args), blends))
+    wallSeconds = time.perf_counter() - start
+
+    failures = printSummary(results, wallSeconds)
+    if args.report:
+        with open(args.report, 'w') as file:
+            json.dump({'seconds': wallSeconds, 'failures': failures, 'results': results}, file, indent=2)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    # Blender has already imported bpy when it runs this script with --python
+    if "bpy" in sys.modules:
+        exportInBlender(sys.argv[sys.argv.index("--") + 1:])
+    else:
+        sys.exit(main())
@@ -0,0 +1,282 @@
+"""SMB LZ export benchmark
+
+Times the exporter outside Blender on generated stages. A small stand-in
+for the parts of bpy and mathutils the exporter uses is installed when
+the real ones aren't available, so this runs with plain Python + numpy.
+
+    python SMB_LZ_Benchmark.py
+    python SMB_LZ_Benchmark.py --sizes 1000 100000 1000000 --save-baseline bench.json
+    python SMB_LZ_Benchmark.py --baseline bench.json --tolerance 0.25
+
+Each stage of the export is timed on its own through the exporter's
+telemetry, along with the peak memory of the whole export. Comparing
+against a saved baseline exits with 1 when any stage got slower than the
+tolerance allows.
+"""
+import argparse
+import importlib.util
+import json
+import math
+import os
+import sys
+import tempfile
+import types
+
+import numpy as np
+
+# Triangle counts of the default stages, and how many objects and items they use
+defaultSizes = [1000, 10000, 100000]
+
+
+class FakeVector(object):
+    """Stand-in for mathutils.Vector, stores its components as 32 bit floats like Blender"""
+    __slots__ = ('values',)
+
+    def __init__(self, values=(0.0, 0.0, 0.0)):
+        self.values = np.array(values, dtype=np.float32)
+
+    x = property(lambda self: float(self.values[0]), lambda self, value: self.values.__setitem__(0, value))
+    y = property(lambda self: float(self.values[1]), lambda self, value: self.values.__setitem__(1, value))
+    z = property(lambda self: float(self.values[2]), lambda self, value: self.values.__setitem__(2, value))
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, index):
+        return float(self.values[index])
+
+    def __iter__(self):
+        return (float(value) for value in self.values)
+
+
+class FakeCollection(list):
+    """Stand-in for a bpy collection backed by one numpy array per attribute"""
+
+    def __init__(self, length, **attributes):
+        super(FakeCollection, self).__init__([None] * length)
+        self.attributes = attributes
+
+    def foreach_get(self, attribute, out):
+        out[:] = self.attributes[attribute].ravel()
+
+
+class FakeMesh(object):
+    """Stand-in for an evaluated bpy mesh"""
+    count = 0
+
+    def __init__(self, coordinates, triangles):
+        FakeMesh.count += 1
+        self.name = "Mesh.%03d" % FakeMesh.count
+        self.vertices = FakeCollection(len(coordinates), co=coordinates)
+        self.loop_triangles = FakeCollection(len(triangles), vertices=triangles)
+
+    def calc_loop_triangles(self):
+        pass
+
+
+class FakeObject(object):
+    """Stand-in for a bpy object, evaluating to its own mesh"""
+
+    def __init__(self, name, location=(0, 0, 0), rotation=(0, 0, 0), scale=(1, 1, 1), data=None):
+        self.name = name
+        self.type = 'MESH' if data is not None else 'EMPTY'
+        self.data = data
+        self.modifiers = []
+        self.animation_data = None
+        self.location = FakeVector(location)
+        self.rotation_euler = FakeVector(rotation)
+        self.scale = FakeVector(scale)
+
+    def get(self, key, default=None):
+        return default
+
+    def evaluated_get(self, depsgraph):
+        return self
+
+    def to_mesh(self):
+        return self.data
+
+    def to_mesh_clear(self):
+        pass
+
+
+class FakeContext(object):
+    def __init__(self, objects):
+        self.scene = types.SimpleNamespace(objects=objects)
+
+    def evaluated_depsgraph_get(self):
+        return None
+
+
+def installFakeBpy():
+    """Puts stand-ins for bpy, mathutils and bpy_extras in sys.modules if Blender isn't there"""
+    # Blender's own, or the stand-in from an earlier call
+    if "bpy" in sys.modules or importlib.util.find_spec("bpy") is not None:
+        return False
+
+    def module(name, **attributes):
+        created = types.ModuleType(name)
+        created.__dict__.update(attributes)
+        sys.modules[name] = created
+        return created
+
+    def prop(**options):
+        return options.get('default')
+
+    class Operator(object):
+        def report(self, level, message):
+            pass
+
+    class Menu(object):
+        def append(self, function):
+            pass
+
+        def remove(self, function):
+            pass
+
+    props = module('bpy.props', **{name: prop for name in ['BoolProperty', 'FloatProperty', 'IntProperty', 'StringProperty',
+                                                          'EnumProperty', 'FloatVectorProperty', 'IntVectorProperty']})
+    bpyTypes = module('bpy.types', Operator=Operator, INFO_MT_file_export=Menu())
+    utils = module('bpy.utils', register_class=lambda cls: None, unregister_class=lambda cls: None)
+    data = module('bpy.data', meshes=None)
+    app = module('bpy.app', version=(0, 0, 0))
+    module('bpy', props=props, types=bpyTypes, utils=utils, data=data, app=app)
+    module('mathutils', Vector=FakeVector)
+    ioUtils = module('bpy_extras.io_utils')
+    module('bpy_extras', io_utils=ioUtils)
+    return True
+
+
+def makeTerrain(random, numTriangles, center, size):
+    """Returns (coordinates, triangles) of a bumpy square grid with about numTriangles triangles"""
+    cells = max(1, int(math.sqrt(numTriangles / 2.0)))
+    xs, ys = np.meshgrid(np.linspace(-size, size, cells + 1), np.linspace(-size, size, cells + 1))
+    zs = random.uniform(-2.0, 2.0, xs.shape)
+    coordinates = np.stack((xs.ravel() + center[0], ys.ravel() + center[1], zs.ravel()), axis=1).astype(np.float32)
+
+    rows, columns = np.meshgrid(np.arange(cells), np.arange(cells), indexing='ij')
+    corner = (rows * (cells + 1) + columns).ravel()
+    first = np.stack((corner, corner + 1, corner + cells + 2), axis=1)
+    second = np.stack((corner, corner + cells + 2, corner + cells + 1), axis=1)
+    triangles = np.stack((first, second), axis=1).reshape(-1, 3).astype(np.int32)
+    return coordinates, triangles
+
+
+def makeStage(numTriangles, numObjects, numItems, seed=0):
+    """Builds a synthetic stage, the triangles are spread over numObjects level models"""
+    random = np.random.RandomState(seed)
+    objects = [FakeObject("Start", (0, 0, 1))]
+
+    spread = 20.0 * math.sqrt(numObjects)
+    for i in range(0, numObjects):
+        center = random.uniform(-spread, spread, 2)
+        coordinates, triangles = makeTerrain(random, numTriangles // numObjects, center, 10.0)
+        objects.append(FakeObject("Model.%03d" % i, data=FakeMesh(coordinates, triangles)))
+    objects.append(FakeObject("Reflective.000", data=FakeMesh(*makeTerrain(random, 32, (0, 0), 4.0))))
+    objects.append(FakeObject("Background.000", (0, 0, -50), scale=(10, 10, 1), data=FakeMesh(*makeTerrain(random, 32, (0, 0), 4.0))))
+
+    def placement():
+        return tuple(random.uniform(-spread, spread, 3)), tuple(random.uniform(-math.pi, math.pi, 3))
+
+    for kind in ["Goal", "Bumper", "Jamabar", "Banana"]:
+        for i in range(0, numItems):
+            location, rotation = placement()
+            objects.append(FakeObject("%s.%03d" % (kind, i), location, rotation))
+    return FakeContext(objects)
+
+
+def timeExport(exporterClass, context, filepath, compression='NONE', profile=False, workers=1):
+    """Runs one export and returns its per stage timings and peak memory from the exporter's telemetry"""
+    exporter = exporterClass()
+    exporter.filepath = filepath
+    exporter.compressionLevel = compression
+    exporter.reportTelemetry = False
+    exporter.traceMemory = True
+    exporter.profileExport = profile
+    exporter.workerProcesses = workers
+    exporter.execute(context)
+
+    telemetry = exporter.telemetry
+    stages = {}
+    for name, seconds, size, peak in telemetry.stages:
+        stages[name] = stages.get(name, 0.0) + seconds
+    if profile:
+        import pstats
+        pstats.Stats(telemetry.output + ".prof").sort_stats('cumulative').print_stats(15)
+    return {
+        'total': telemetry.seconds,
+        'stages': stages,
+        'peakMemory': telemetry.peakMemory,
+        'bytes': os.path.getsize(telemetry.output),
+        }
+
+
+def compare(results, baseline, tolerance):
+    """Prints stages that got slower than the baseline allows, returns how many did"""
+    regressions = 0
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        old = baseline[name]
+        checks = [('total', result['total'], old['total'])]
+        checks += [(stage, seconds, old['stages'].get(stage)) for stage, seconds in result['stages'].items()]
+        checks.append(('peakMemory', result['peakMemory'], old['peakMemory']))
+        for stage, new, before in checks:
+            # Ignore noise on stages that take next to no time
+            if before is None or (stage != 'peakMemory' and max(new, before) < 0.02):
+                continue
+            if new > before * (1.0 + tolerance):
+                regressions += 1
+                print("REGRESSION %s %s: %.4g -> %.4g (+%.0f%%)" % (name, stage, before, new, 100.0 * (new / before - 1.0)))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the SMB LZ exporter on generated stages")
+    parser.add_argument("--sizes", type=int, nargs='+', default=defaultSizes, help="triangle counts of the stages")
+    parser.add_argument("--objects", type=int, nargs='+', default=[8], help="level model counts to try")
+    parser.add_argument("--items", type=int, nargs='+', default=[50], help="items of each type to try")
+    parser.add_argument("--compression", default='NONE', choices=['NONE', 'FAST', 'NORMAL', 'BEST'])
+    parser.add_argument("--workers", type=int, default=1, help="processes to serialize collision fields in")
+    parser.add_argument("--profile", action='store_true', help="print the cProfile hot spots of each stage")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per stage, the fastest is kept")
+    parser.add_argument("--save-baseline", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare against this JSON file")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown against the baseline")
+    args = parser.parse_args(argv)
+
+    installFakeBpy()
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import SMB_LZ_Export
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        filepath = os.path.join(directory, "benchmark.lz.raw")
+        for numTriangles in args.sizes:
+            for numObjects in args.objects:
+                for numItems in args.items:
+                    name = "%dtris_%dobjects_%ditems" % (numTriangles, numObjects, numItems)
+                    context = makeStage(numTriangles, numObjects, numItems)
+                    runs = [timeExport(SMB_LZ_Export.SMBLZExporter, context, filepath, args.compression, args.profile,
+                                       args.workers)
+                            for i in range(0, max(1, args.repeat))]
+                    best = min(runs, key=lambda run: run['total'])
+                    results[name] = best
+                    slowest = sorted(best['stages'].items(), key=lambda item: -item[1])[:3]
+                    print("%-32s %8.3fs %7.1f MB peak %9d bytes  %s" % (
+                            name, best['total'], best['peakMemory'] / 1048576.0, best['bytes'],
+                            ", ".join("%s %.3fs" % item for item in slowest)))
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as file:
+            json.dump(results, file, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        if compare(results, baseline, args.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,142 @@
+"""SMB LZ export cache
+
+Keeps the serialized collision data of each exported object on disk so
+the next export can reuse it when the object hasn't changed. Entries are
+keyed on a hash of everything that goes into them and the least recently
+used entries are evicted once the cache grows past its size limit.
+
+This module doesn't need Blender.
+"""
+import hashlib
+import os
+import pickle
+import tempfile
+from collections import OrderedDict
+
+cacheVersion = 2                # Bump when the cached data or its key changes meaning
+entrySuffix = ".smbcache"
+
+
+def cacheKey(*parts):
+    """Hashes a mix of bytes-like objects and plain values into a cache key"""
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(repr(cacheVersion).encode())
+    for part in parts:
+        if isinstance(part, (bytes, bytearray, memoryview)):
+            digest.update(b"b%d:" % len(part))
+            digest.update(part)
+        else:
+            text = repr(part).encode()
+            digest.update(b"r%d:" % len(text))
+            digest.update(text)
+    return digest.hexdigest()
+
+
+class ExportCache(object):
+    """Size bounded on-disk cache of per object export data"""
+
+    def __init__(self, directory, maxBytes):
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def entryPath(self, key):
+        return os.path.join(self.directory, key + entrySuffix)
+
+    def get(self, key):
+        """Returns the entry stored for key, or None"""
+        path = self.entryPath(key)
+        try:
+            with open(path, 'rb') as file:
+                entry = pickle.load(file)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            self.misses += 1
+            return None
+        # Mark the entry as recently used for eviction
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        self.hits += 1
+        return entry
+
+    def put(self, key, entry):
+        """Stores an entry, replacing the file atomically so readers never see half of it"""
+        handle, temporaryPath = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(handle, 'wb') as file:
+                pickle.dump(entry, file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temporaryPath, self.entryPath(key))
+        except BaseException:
+            if os.path.exists(temporaryPath):
+                os.remove(temporaryPath)
+            raise
+
+    def evict(self):
+        """Removes the least recently used entries until the cache fits its size limit"""
+        entries = []
+        total = 0
+        for item in os.scandir(self.directory):
+            if item.name.endswith(entrySuffix):
+                stat = item.stat()
+                entries.append((stat.st_mtime, stat.st_size, item.path))
+                total += stat.st_size
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.maxBytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+        return total
+
+
+def entrySize(entry):
+    """Rough number of bytes an entry holds, counting its buffers and arrays"""
+    if isinstance(entry, (bytes, bytearray)):
+        return len(entry)
+    if hasattr(entry, "nbytes"):
+        return int(entry.nbytes)
+    if isinstance(entry, dict):
+        return sum(entrySize(value) for value in entry.values())
+    if isinstance(entry, (list, tuple)):
+        return sum(entrySize(value) for value in entry)
+    return 8
+
+
+class MemoryCache(object):
+    """Size bounded in-memory cache with the same interface as ExportCache, for exports repeated within a session"""
+
+    def __init__(self, maxBytes):
+        self.maxBytes = maxBytes
+        self.hits = 0
+        self.misses = 0
+        self.entries = OrderedDict()    # Key -> (entry, size), least recently used first
+        self.total = 0
+
+    def get(self, key):
+        """Returns the entry stored for key, or None"""
+        item = self.entries.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return item[0]
+
+    def put(self, key, entry):
+        if key in self.entries:
+            self.total -= self.entries.pop(key)[1]
+        size = entrySize(entry)
+        self.entries[key] = (entry, size)
+        self.total += size
+
+    def evict(self):
+        """Drops the least recently used entries until the cache fits its size limit"""
+        while self.total > self.maxBytes and self.entries:
+            self.total -= self.entries.popitem(last=False)[1][1]
+        return self.total
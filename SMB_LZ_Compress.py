@@ -0,0 +1,311 @@
+"""SMB LZ compression
+
+The game loads stages as LZSS compressed files with an 8 byte header:
+    (4i) Compressed size including the header, little endian
+    (4i) Uncompressed size, little endian
+followed by classic LZSS data (4096 byte window, 3-18 byte matches).
+Every group of 8 tokens starts with a flag byte, read from the lowest
+bit up. A set bit is a literal byte, a clear bit is a 2 byte reference
+into the window.
+
+This module doesn't need Blender so it can be used by command line tools.
+It uses numpy when it's available and plain Python otherwise, both write
+the same bytes.
+"""
+import struct
+from array import array
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+headerSize = 8                  # (8) Compressed size and uncompressed size
+windowSize = 4096               # Size of the decompressor's ring buffer
+minMatch = 3                    # Shortest reference worth encoding
+maxMatch = 18                   # Longest reference (4 bit length + minMatch)
+ringStart = windowSize - maxMatch   # Ring buffer position of the first output byte
+maxDistance = windowSize - maxMatch # Furthest back a reference may reach
+matchBlockSize = 1 << 20           # Positions searched at once with numpy
+
+# Compression levels: (hash chain candidates tried per position, lazy matching)
+levels = {
+    'FAST': (4, False),
+    'NORMAL': (32, True),
+    'BEST': (512, True),
+    }
+
+
+def compress(data, level='NORMAL'):
+    """Compresses data into an SMB LZ file"""
+
+    maxChain, lazy = levels[level]
+    data = bytes(data)
+
+    # Both give the same bytes, numpy just finds every position's match at once
+    if np is not None:
+        body = encodeTable(data, maxChain, lazy)
+    else:
+        body = encodeChains(data, maxChain, lazy)
+
+    return struct.pack('<II', headerSize + len(body), len(data)) + body
+
+
+def encodeChains(data, maxChain, lazy):
+    """Returns the LZSS tokens for data, searching hash chains of 3 byte prefixes as it goes"""
+
+    size = len(data)
+    out = bytearray()
+
+    # Hash chains of 3 byte prefixes, prev only needs to cover the window
+    head = {}
+    prev = array('i', [-1]) * windowSize
+    inserted = 0
+
+    def insertUpTo(end):
+        """Adds every position before end to the hash chains"""
+        nonlocal inserted
+        end = min(end, size - minMatch + 1)
+        while inserted < end:
+            key = data[inserted:inserted + minMatch]
+            prev[inserted & (windowSize - 1)] = head.get(key, -1)
+            head[key] = inserted
+            inserted += 1
+
+    def findMatch(position):
+        """Returns the (length, source) of the longest match for position"""
+        bestLength = 0
+        bestSource = 0
+        limit = min(maxMatch, size - position)
+        if limit < minMatch:
+            return bestLength, bestSource
+        candidate = head.get(data[position:position + minMatch], -1)
+        chain = maxChain
+        while candidate >= 0 and position - candidate <= maxDistance and chain > 0:
+            # Only look closer at candidates that could beat the best match
+            if data[candidate + bestLength] == data[position + bestLength]:
+                length = minMatch
+                while length < limit and data[candidate + length] == data[position + length]:
+                    length += 1
+                if length > bestLength:
+                    bestLength = length
+                    bestSource = candidate
+                    if length == limit:
+                        break
+            candidate = prev[candidate & (windowSize - 1)]
+            chain -= 1
+        return bestLength, bestSource
+
+    flagPosition = 0
+    flagBit = 8
+    position = 0
+    while position < size:
+        if flagBit == 8:
+            flagPosition = len(out)
+            out.append(0)
+            flagBit = 0
+
+        insertUpTo(position)
+        length, source = findMatch(position)
+
+        # Lazy matching: emit a literal if the next position has a longer match
+        if lazy and minMatch <= length < maxMatch and position + 1 < size:
+            insertUpTo(position + 1)
+            nextLength, nextSource = findMatch(position + 1)
+            if nextLength > length:
+                length = 0
+
+        if length >= minMatch:
+            ringPosition = (ringStart + source) & (windowSize - 1)
+            out.append(ringPosition & 0xFF)                                 # (1i) Low 8 bits of the window position
+            out.append(((ringPosition >> 4) & 0xF0) | (length - minMatch))  # (1i) High 4 bits of the position, length
+            position += length
+        else:
+            out[flagPosition] |= 1 << flagBit
+            out.append(data[position])                                      # (1i) Literal byte
+            position += 1
+        flagBit += 1
+
+    return bytes(out)
+
+
+def encodeTable(data, maxChain, lazy):
+    """Returns the LZSS tokens for data, using matches found for every position with numpy
+
+    Only walking from token to token is left to Python, the matches, the
+    lazy matching decisions and the output bytes are all arrays.
+    """
+
+    size = len(data)
+    if size == 0:
+        return b''
+    lengths, sources = matchTable(data, maxChain)
+
+    # Lazy matching: emit a literal if the next position has a longer match
+    useMatch = lengths >= minMatch
+    if lazy:
+        useMatch[:-1] &= (lengths[:-1] == maxMatch) | (lengths[1:] <= lengths[:-1])
+    steps = np.where(useMatch, lengths, 1).astype(np.uint8).tobytes()
+
+    tokens = array('i')
+    position = 0
+    while position < size:
+        tokens.append(position)
+        position += steps[position]
+    tokens = np.frombuffer(tokens, np.int32)
+
+    # Every group of 8 tokens is preceded by its flag byte
+    isMatch = useMatch[tokens]
+    del useMatch, steps
+    index = np.arange(len(tokens), dtype=np.int32)
+    tokenSizes = isMatch.astype(np.int32) + 1
+    offsets = np.cumsum(tokenSizes, dtype=np.int32) - tokenSizes + (index >> 3) + 1
+    flagOffsets = offsets[::8] - 1
+    out = np.zeros(offsets[-1] + tokenSizes[-1], np.uint8)
+
+    literals = tokens[~isMatch]
+    out[offsets[~isMatch]] = np.frombuffer(data, np.uint8)[literals]                   # (1i) Literal byte
+    matches = tokens[isMatch]
+    ringPositions = (ringStart + sources[matches]) & (windowSize - 1)
+    out[offsets[isMatch]] = ringPositions & 0xFF                                        # (1i) Low 8 bits of the window position
+    out[offsets[isMatch] + 1] = ((ringPositions >> 4) & 0xF0) | (lengths[matches] - minMatch)  # (1i) High 4 bits of the position, length
+    out[flagOffsets] = np.add.reduceat(np.where(isMatch, 0, 1 << (index & 7)), index[::8])
+
+    return out.tobytes()
+
+
+def matchTable(data, maxChain):
+    """Returns the (lengths, sources) arrays of the longest match for every position
+
+    The matches are the ones the hash chain search in encodeChains finds.
+    Positions are searched a block at a time so the memory needed doesn't
+    grow with the file, each block only needs the window before it.
+    """
+
+    size = len(data)
+    lengths = np.zeros(size, np.int32)
+    sources = np.zeros(size, np.int32)
+
+    # Unaligned little endian words starting at every byte
+    padded = data + bytes(24)
+    words = np.ndarray((len(padded) - 7,), '<u8', padded, strides=(1,))
+
+    count = size - minMatch + 1
+    for blockStart in range(0, count, matchBlockSize):
+        blockEnd = min(blockStart + matchBlockSize, count)
+        matchBlock(data, words, max(0, blockStart - maxDistance), blockStart, blockEnd, maxChain, lengths, sources)
+    return lengths, sources
+
+
+def matchBlock(data, words, historyStart, blockStart, blockEnd, maxChain, lengths, sources):
+    """Fills in lengths and sources for the positions from blockStart to blockEnd
+
+    Sorting the positions by their 3 byte prefix puts each position's hash
+    chain right before it, newest first. Every round tries the next
+    candidate of all positions that still have one, comparing 8 bytes at a
+    time, so there are at most maxChain rounds however big the block is.
+    """
+
+    raw = np.frombuffer(data, np.uint8, blockEnd - historyStart + minMatch - 1, historyStart).astype(np.int32)
+    count = blockEnd - historyStart
+    keys = (raw[:count] << 16) | (raw[1:count + 1] << 8) | raw[2:count + 2]
+    order = np.argsort(keys, kind='stable').astype(np.int32)
+    rank = np.empty(count, np.int32)
+    rank[order] = np.arange(count, dtype=np.int32)
+    del raw
+
+    # Positions are relative to historyStart until they're compared or stored
+    limits = np.minimum(maxMatch, len(data) - historyStart - np.arange(count, dtype=np.int32))
+    active = np.arange(blockStart - historyStart, count, dtype=np.int32)
+    best = np.zeros(count, np.int32)
+    for step in range(1, maxChain + 1):
+        # The chain ends at another prefix or past the window, and it's newest first so it stays ended
+        chainRank = rank[active] - step
+        candidates = order[np.maximum(chainRank, 0)]
+        found = (chainRank >= 0) & (keys[candidates] == keys[active]) & (active - candidates <= maxDistance)
+        active = active[found]
+        candidates = candidates[found]
+        if len(active) == 0:
+            break
+
+        # The prefix already matches, compare the 15 bytes after it
+        first = historyStart + minMatch
+        length = minMatch + commonBytes(words, active + first, candidates + first)
+        longer = length == minMatch + 8
+        length[longer] += commonBytes(words, active[longer] + first + 8, candidates[longer] + first + 8)
+        length = np.minimum(length, limits[active])
+
+        # Ties keep the nearer candidate, found in an earlier round
+        better = length > best[active]
+        best[active[better]] = length[better]
+        sources[active[better] + historyStart] = candidates[better] + historyStart
+        active = active[best[active] < limits[active]]
+
+    lengths[blockStart:blockEnd] = best[blockStart - historyStart:]
+
+
+def commonBytes(words, a, b):
+    """Returns how many of the 8 bytes at positions a and b match before the first difference"""
+    difference = words[a] ^ words[b]
+    lowestBit = difference & (~difference + np.uint64(1))
+    # frexp gives the bit's index + 1, 0 when there's no difference
+    exponent = np.frexp(lowestBit.astype(np.float64))[1]
+    return np.where(difference == 0, 8, (exponent - 1) >> 3)
+
+
+def decompress(data):
+    """Decompresses an SMB LZ file"""
+
+    compressedSize, size = struct.unpack_from('<II', data, 0)
+    if compressedSize > len(data):
+        raise ValueError("SMB LZ data is truncated (%d of %d bytes)" % (len(data), compressedSize))
+
+    out = bytearray()
+    position = headerSize
+    flags = 0
+    flagBit = 8
+    while len(out) < size and position < compressedSize:
+        if flagBit == 8:
+            flags = data[position]
+            position += 1
+            flagBit = 0
+            continue
+
+        if flags & (1 << flagBit):
+            out.append(data[position])
+            position += 1
+        else:
+            ringPosition = data[position] | ((data[position + 1] & 0xF0) << 4)
+            length = (data[position + 1] & 0x0F) + minMatch
+            position += 2
+            # Turn the ring buffer position into a distance back from the current byte
+            distance = ((ringStart + len(out)) - ringPosition) & (windowSize - 1)
+            if distance == 0:
+                distance = windowSize
+            source = len(out) - distance
+            if source < 0:
+                # Before the start of the data the ring buffer is still zero filled
+                padding = min(-source, length)
+                out.extend(bytes(padding))
+                source += padding
+                length -= padding
+            if distance >= length:
+                out.extend(out[source:source + length])
+            else:
+                # Overlapping reference, repeat the bytes as they're produced
+                for i in range(0, length):
+                    out.append(out[source + i])
+        flagBit += 1
+
+    if len(out) != size:
+        raise ValueError("SMB LZ data decompressed to %d bytes, expected %d" % (len(out), size))
+    return bytes(out)
+
+
+def isCompressed(data):
+    """Returns True if data looks like an SMB LZ file rather than a raw stage"""
+    if len(data) < headerSize:
+        return False
+    compressedSize, size = struct.unpack_from('<II', data, 0)
+    # LZSS grows incompressible data by at most one flag byte per 8 bytes
+    return compressedSize == len(data) and compressedSize <= headerSize + size + (size + 7) // 8
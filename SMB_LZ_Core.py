@@ -0,0 +1,1973 @@
+"""SMB LZ export core
+
+Builds the bytes of an SMB LZ stage from a plain description of it, the
+Blender operator in SMB_LZ_Export.py only extracts that description from
+the scene. Nothing here needs Blender, so stages can be built in worker
+processes, benchmarks and scripts.
+
+    stage = Stage()
+    stage.startPositions.append(StartPosition((0, 1, 0), (0, 0, 0)))
+    stage.levelModels.append(CollisionModel("floor", vertices, triangles))
+    data = StageWriter(stage).build()
+
+Everything is in game space (Y up): positions and scales are (x, y, z),
+rotations are (x, y, z) radians and collision models are vertex and
+triangle index arrays.
+"""
+import concurrent.futures
+import io
+import json
+import math
+import multiprocessing
+import os
+import struct
+import tempfile
+import time
+import tracemalloc
+from collections import namedtuple
+
+import numpy as np
+
+# Placement and resolution of a collision field's triangle grid (XZ plane, game space)
+CollisionGrid = namedtuple('CollisionGrid', ['startX', 'startZ', 'stepX', 'stepZ', 'countX', 'countZ'])
+
+# What StageWriter.buildSteps() has done so far, stage is the name of the step that just finished
+BuildProgress = namedtuple('BuildProgress', ['stage', 'fieldsDone', 'fields', 'trianglesDone', 'triangles'])
+
+goalTypes = {"blue": 0x4200, "green": 0x4700, "red": 0x5200}
+bananaTypes = {"single": 0, "bunch": 1}
+
+# Grid cells list triangles by 16 bit index and 0xFFFF ends a list, so a field can index at most this many
+maxCollisionTriangles = 65535
+
+# Channels of a collision field animation in the order of the animation header
+animationChannels = ['rotationX', 'rotationY', 'rotationZ', 'positionX', 'positionY', 'positionZ']
+sizeOfAnimationHeader = 64      # (8x) Count and offset per channel, then 16 zero bytes
+sizeOfKeyframe = 20             # Easing, time, value, in and out tangents
+
+# Big endian layout of one 20 byte animation keyframe
+keyframeDtype = np.dtype([
+        ('easing', '>u4'),
+        ('time', '>f4'),
+        ('value', '>f4'),
+        ('tangentIn', '>f4'),
+        ('tangentOut', '>f4'),
+        ])
+linearEasing = 1
+
+# Big endian layouts of the items, written a whole item type at a time
+goalDtype = np.dtype({
+        'names': ['position', 'rotation', 'goalType'],
+        'formats': [('>f4', 3), ('>u2', 3), '>u2'],
+        'offsets': [0, 12, 18],
+        'itemsize': 20,
+        })
+scaledItemDtype = np.dtype({
+        'names': ['position', 'rotation', 'scale'],
+        'formats': [('>f4', 3), ('>u2', 3), ('>f4', 3)],
+        'offsets': [0, 12, 20],
+        'itemsize': 32,
+        })
+bananaDtype = np.dtype({
+        'names': ['position', 'bananaType'],
+        'formats': [('>f4', 3), '>u4'],
+        'offsets': [0, 12],
+        'itemsize': 16,
+        })
+
+
+class StartPosition(object):
+    """(20) Start position"""
+    __slots__ = ('position', 'rotation')
+
+    def __init__(self, position, rotation):
+        self.position = position
+        self.rotation = rotation
+
+
+class Goal(object):
+    """(20) Goal, goalType is a key of goalTypes"""
+    __slots__ = ('position', 'rotation', 'goalType')
+
+    def __init__(self, position, rotation, goalType="blue"):
+        self.position = position
+        self.rotation = rotation
+        self.goalType = goalType
+
+
+class ScaledItem(object):
+    """(32) Bumper or jamabar"""
+    __slots__ = ('position', 'rotation', 'scale')
+
+    def __init__(self, position, rotation, scale):
+        self.position = position
+        self.rotation = rotation
+        self.scale = scale
+
+
+class Banana(object):
+    """(16) Banana, bananaType is a key of bananaTypes"""
+    __slots__ = ('position', 'bananaType')
+
+    def __init__(self, position, bananaType="single"):
+        self.position = position
+        self.bananaType = bananaType
+
+
+class ItemArray(object):
+    """Many goals, bumpers, jamabars or bananas at once, e.g. the particles of a particle system"""
+    """positions, rotations (radians) and scales are (N, 3) arrays, no rotations or scales means none and 1"""
+    """itemType is the goal or banana type of all of them, None for the default"""
+    __slots__ = ('positions', 'rotations', 'scales', 'itemType')
+
+    def __init__(self, positions, rotations=None, scales=None, itemType=None):
+        self.positions = np.asarray(positions, dtype=np.float64).reshape(-1, 3)
+        self.rotations = None if rotations is None else np.asarray(rotations, dtype=np.float64).reshape(-1, 3)
+        self.scales = None if scales is None else np.asarray(scales, dtype=np.float64).reshape(-1, 3)
+        self.itemType = itemType
+
+    def __len__(self):
+        return len(self.positions)
+
+
+class Animation(object):
+    """Sampled position and rotation channels of an animated collision field"""
+    """Each channel is None or a (times, values) pair of arrays, times in seconds and rotations in radians"""
+    __slots__ = tuple(animationChannels)
+
+    def __init__(self, **channels):
+        for name in animationChannels:
+            setattr(self, name, channels.get(name))
+
+
+class CollisionModel(object):
+    """Level model or reflective object with a collision field"""
+    """vertices is a (V, 3) float array in the object's space, triangles an (N, 3) array of indices into it"""
+    """The vertices are scaled by scale, the field header then places them at position and rotation"""
+    """Animated fields rotate around position, starting at rotation"""
+    """A decimateRatio under 1 decimates the collision down to about that fraction of its triangles"""
+    __slots__ = ('name', 'vertices', 'triangles', 'position', 'rotation', 'animation', 'decimateRatio', 'scale')
+
+    def __init__(self, name, vertices, triangles, position=(0.0, 0.0, 0.0), rotation=(0.0, 0.0, 0.0), animation=None,
+                 decimateRatio=1.0, scale=(1.0, 1.0, 1.0)):
+        self.name = name
+        self.vertices = vertices
+        self.triangles = triangles
+        self.position = position
+        self.rotation = rotation
+        self.animation = animation
+        self.decimateRatio = decimateRatio
+        self.scale = scale
+
+    @property
+    def triangleVertices(self):
+        """(N, 3, 3) array of every triangle's scaled vertices"""
+        return gatherTriangleVertices(scaleVertices(self.vertices, self.scale), self.triangles)
+
+
+class BackgroundModel(object):
+    """(56) Background model"""
+    __slots__ = ('name', 'position', 'rotation', 'scale')
+
+    def __init__(self, name, position, rotation, scale):
+        self.name = name
+        self.position = position
+        self.rotation = rotation
+        self.scale = scale
+
+
+class Stage(object):
+    """Everything that goes into one SMB LZ stage"""
+    """Items in the ItemArray lists are written after the single items of the same type"""
+    __slots__ = ('startPositions', 'falloutPlaneY', 'goals', 'bumpers', 'jamabars', 'bananas',
+                 'goalArrays', 'bumperArrays', 'jamabarArrays', 'bananaArrays',
+                 'levelModels', 'reflectiveObjects', 'backgroundModels')
+
+    def __init__(self):
+        self.startPositions = []
+        self.falloutPlaneY = -32.0
+        self.goals = []
+        self.bumpers = []
+        self.jamabars = []
+        self.bananas = []
+        self.goalArrays = []
+        self.bumperArrays = []
+        self.jamabarArrays = []
+        self.bananaArrays = []
+        self.levelModels = []
+        self.reflectiveObjects = []
+        self.backgroundModels = []
+
+
+def reduceKeyframes(times, values, tolerance):
+    """Returns the indices of the keys to keep so linear interpolation stays within tolerance of every key"""
+    """Ramer-Douglas-Peucker on the value axis, a channel that never leaves tolerance keeps one key"""
+    numKeys = len(times)
+    if numKeys == 0:
+        return np.zeros(0, dtype=np.int64)
+    if np.ptp(values) <= tolerance:
+        return np.zeros(1, dtype=np.int64)
+
+    keep = np.zeros(numKeys, dtype=bool)
+    keep[0] = keep[-1] = True
+    spans = [(0, numKeys - 1)]
+    while spans:
+        first, last = spans.pop()
+        if last - first < 2:
+            continue
+        # Error of every key between the ends against the line through them
+        inside = slice(first + 1, last)
+        slope = (values[last] - values[first]) / (times[last] - times[first])
+        error = np.abs(values[inside] - (values[first] + slope * (times[inside] - times[first])))
+        worst = int(np.argmax(error))
+        if error[worst] > tolerance:
+            middle = first + 1 + worst
+            keep[middle] = True
+            spans.append((first, middle))
+            spans.append((middle, last))
+    return np.flatnonzero(keep)
+
+
+def gatherTriangleVertices(vertices, triangles):
+    """Returns the (N, 3, 3) array of the vertices of every triangle"""
+    return np.asarray(vertices)[np.asarray(triangles)].astype(np.float64).reshape(-1, 3, 3)
+
+
+def spreadBits(values):
+    """Moves the low 16 bits of every value to the even bits, for interleaving two of them into a Morton code"""
+    values = values.astype(np.uint64)
+    values = (values | (values << np.uint64(8))) & np.uint64(0x00FF00FF)
+    values = (values | (values << np.uint64(4))) & np.uint64(0x0F0F0F0F)
+    values = (values | (values << np.uint64(2))) & np.uint64(0x33333333)
+    values = (values | (values << np.uint64(1))) & np.uint64(0x55555555)
+    return values
+
+
+def mortonOrder(triangleVertices):
+    """Returns the order of the triangles along a Morton (Z-order) curve over their XZ centroids"""
+    """Neighbouring triangles end up next to each other, so each grid cell lists a few runs of consecutive triangles"""
+    if len(triangleVertices) == 0:
+        return np.zeros(0, dtype=np.int64)
+    centroids = triangleVertices[:, :, [0, 2]].mean(axis=1)
+    low = centroids.min(axis=0)
+    span = centroids.max(axis=0) - low
+    quantized = np.clip((centroids - low) * (65535.0 / np.where(span > 0, span, 1.0)), 0, 65535)
+    codes = spreadBits(quantized[:, 0]) | (spreadBits(quantized[:, 1]) << np.uint64(1))
+    return np.argsort(codes, kind='stable')
+
+
+def uniqueRows(rows):
+    """Returns the index of the first of each distinct row of an (N, 3) integer array and every row's group"""
+    """Same as np.unique(rows, axis=0, return_index=True, return_inverse=True) but much faster on big arrays"""
+    if len(rows) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    low = rows.min(axis=0)
+    spans = rows.max(axis=0) - low + 1
+    if float(spans[0]) * float(spans[1]) * float(spans[2]) >= 2.0 ** 62:
+        # Too wide to pack into one integer, sort the rows lexicographically instead
+        order = np.lexsort(rows.T[::-1])
+        ordered = rows[order]
+        starts = np.ones(len(rows), dtype=bool)
+        starts[1:] = (ordered[1:] != ordered[:-1]).any(axis=1)
+        inverse = np.empty(len(rows), dtype=np.int64)
+        inverse[order] = np.cumsum(starts) - 1
+        return order[starts], inverse
+    shifted = (rows - low).astype(np.int64)
+    keys = (shifted[:, 0] * spans[1] + shifted[:, 1]) * spans[2] + shifted[:, 2]
+    first, inverse = np.unique(keys, return_index=True, return_inverse=True)[1:]
+    return first, inverse.reshape(-1)
+
+
+def sortedLookup(table, keys):
+    """Returns the index of each key in a sorted array of distinct values, -1 for keys that aren't in it"""
+    index = np.minimum(np.searchsorted(table, keys), len(table) - 1)
+    return np.where(table[index] == keys, index, -1)
+
+
+def axisRanks(values):
+    """Returns the rank of each value among the distinct values, the ranks of value - 1 and value + 1 (-1 where missing) and the number of distinct values"""
+    order = np.argsort(values, kind='stable')
+    ordered = values[order]
+    starts = np.ones(len(values), dtype=bool)
+    starts[1:] = ordered[1:] != ordered[:-1]
+    distinct = ordered[starts]
+    rank = np.empty(len(values), dtype=np.int64)
+    rank[order] = np.cumsum(starts) - 1
+    below = np.where(distinct[np.maximum(rank - 1, 0)] == values - 1, rank - 1, -1)
+    above = np.where(distinct[np.minimum(rank + 1, len(distinct) - 1)] == values + 1, rank + 1, -1)
+    return (below, rank, above), len(distinct)
+
+
+def neighbourCells(cells):
+    """Returns the (first, second) indices of every pair of rows of an (N, 3) array of distinct integer cells that touch"""
+    """Cells are looked up by their rank along each axis, which can't overflow like packing the coordinates can"""
+    if len(cells) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    # In lexicographic order both the (x, y) keys and the (x, y, z) keys come out sorted
+    order = np.lexsort(cells.T[::-1])
+    cells = cells[order]
+    (xRanks, xCount), (yRanks, yCount), (zRanks, zCount) = [axisRanks(cells[:, axis]) for axis in range(0, 3)]
+    columnKeys = xRanks[1] * yCount + yRanks[1]
+    starts = np.ones(len(cells), dtype=bool)
+    starts[1:] = columnKeys[1:] != columnKeys[:-1]
+    columns = columnKeys[starts]
+    cellKeys = (np.cumsum(starts) - 1) * zCount + zRanks[1]
+
+    # Half of the 26 neighbours is enough to find every pair once
+    first = []
+    second = []
+    for dx, dy, dz in np.ndindex(3, 3, 3):
+        if (dx, dy, dz) <= (1, 1, 1):
+            continue
+        present = np.flatnonzero((xRanks[dx] >= 0) & (yRanks[dy] >= 0) & (zRanks[dz] >= 0))
+        column = sortedLookup(columns, xRanks[dx][present] * yCount + yRanks[dy][present])
+        present = present[column >= 0]
+        neighbour = sortedLookup(cellKeys, column[column >= 0] * zCount + zRanks[dz][present])
+        first.append(order[present[neighbour >= 0]])
+        second.append(order[neighbour[neighbour >= 0]])
+    return np.concatenate(first), np.concatenate(second)
+
+
+def cleanCollisionMesh(vertices, triangles, epsilon):
+    """Welds close vertices on an epsilon sized grid and drops degenerate and duplicate triangles"""
+    """Returns the new vertices and triangles and the number of (welded vertices, degenerate triangles, duplicate triangles)"""
+    vertices = np.asarray(vertices)
+    triangles = np.asarray(triangles).reshape(-1, 3)
+    if len(triangles) == 0:
+        return vertices, triangles, (0, 0, 0)
+
+    # Vertices in the same epsilon sized cell become the first of them
+    numWelded = 0
+    if epsilon > 0:
+        cells = np.floor(vertices / epsilon).astype(np.int64)
+        first, inverse = uniqueRows(cells)
+
+        # Close vertices either side of a cell edge are welded too, when the first vertices of their cells are within epsilon
+        points = vertices[first].astype(np.float64)
+        a, b = neighbourCells(cells[first])
+        offsets = points[a] - points[b]
+        close = np.einsum('ij,ij->i', offsets, offsets) <= epsilon * epsilon
+        a = a[close]
+        b = b[close]
+
+        # Every cell ends up as the lowest vertex of the cells it's welded to, however long the chain
+        welded = first.copy()
+        while True:
+            lowest = welded.copy()
+            np.minimum.at(lowest, a, welded[b])
+            np.minimum.at(lowest, b, welded[a])
+            lowest = lowest[inverse[lowest]]
+            if np.array_equal(lowest, welded):
+                break
+            welded = lowest
+
+        kept, cellVertex = np.unique(welded, return_inverse=True)
+        numWelded = len(vertices) - len(kept)
+        vertices = vertices[kept]
+        triangles = cellVertex.reshape(-1)[inverse][triangles]
+
+    # A triangle is degenerate when its lowest altitude (twice the area over the longest edge) is within epsilon
+    corners = vertices[triangles].astype(np.float64)
+    ab = corners[:, 1] - corners[:, 0]
+    ac = corners[:, 2] - corners[:, 0]
+    bc = corners[:, 2] - corners[:, 1]
+    normal = np.stack((ab[:, 1] * ac[:, 2] - ab[:, 2] * ac[:, 1],
+                       ab[:, 2] * ac[:, 0] - ab[:, 0] * ac[:, 2],
+                       ab[:, 0] * ac[:, 1] - ab[:, 1] * ac[:, 0]), axis=1)
+    doubleArea = np.sqrt(np.einsum('ij,ij->i', normal, normal))
+    longestEdge = np.sqrt(np.maximum(np.maximum(np.einsum('ij,ij->i', ab, ab), np.einsum('ij,ij->i', ac, ac)),
+                                     np.einsum('ij,ij->i', bc, bc)))
+    repeated = (triangles[:, 0] == triangles[:, 1]) | (triangles[:, 1] == triangles[:, 2]) | (triangles[:, 0] == triangles[:, 2])
+    kept = np.flatnonzero(~(repeated | (doubleArea <= epsilon * longestEdge)))
+    numDegenerate = len(triangles) - len(kept)
+
+    # Duplicates use the same vertices in the same winding, rotate each so its lowest index comes first to compare
+    rotation = (np.argmin(triangles[kept], axis=1)[:, None] + np.arange(3)) % 3
+    canonical = triangles[kept[:, None], rotation]
+    first = np.sort(uniqueRows(canonical)[0]) if len(kept) else np.zeros(0, dtype=np.int64)
+    numDuplicates = len(kept) - len(first)
+
+    return vertices, triangles[kept[first]], (numWelded, numDegenerate, numDuplicates)
+
+
+def decimateCollisionMesh(vertices, triangles, ratio):
+    """Decimates a mesh down to about ratio of its triangles by vertex clustering"""
+    """Vertices move to the mean of their grid cell, the cell size is searched for the one closest to the target"""
+    vertices = np.asarray(vertices)
+    triangles = np.asarray(triangles).reshape(-1, 3)
+    if ratio >= 1.0 or len(triangles) == 0:
+        return vertices, triangles
+    target = ratio * len(triangles)
+
+    def cluster(cellSize):
+        # Every vertex moves to the mean of its cell, the triangles that collapse or coincide are dropped
+        inverse = uniqueRows(np.floor(vertices / cellSize).astype(np.int64))[1]
+        counts = np.bincount(inverse)
+        means = np.stack([np.bincount(inverse, weights=vertices[:, axis]) for axis in range(0, 3)], axis=1) / counts[:, None]
+        return cleanCollisionMesh(means.astype(vertices.dtype), inverse[triangles], 0.0)[:2]
+
+    # Bigger cells leave fewer triangles, search between a tiny cell and one covering the whole mesh
+    # The count jumps around as cells line up with the geometry, so keep whichever size came closest
+    size = max(float((vertices.max(axis=0) - vertices.min(axis=0)).max()), 1e-6)
+    low = size * 1e-6
+    high = size
+    best = None
+    for i in range(0, 20):
+        middle = math.sqrt(low * high)
+        decimated = cluster(middle)
+        remaining = len(decimated[1])
+        if best is None or abs(remaining - target) < abs(len(best[1]) - target):
+            best = decimated
+        if abs(remaining - target) <= 0.02 * target:
+            break
+        if remaining > target:
+            low = middle
+        else:
+            high = middle
+    return best
+
+
+def writeFile(filepath, data):
+    """Writes through a temporary file next to the output, anything reading the output never sees half a stage"""
+    handle, temporaryPath = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filepath)), suffix=".tmp")
+    try:
+        with os.fdopen(handle, 'wb') as file:
+            file.write(data)
+        os.replace(temporaryPath, filepath)
+    except BaseException:
+        if os.path.exists(temporaryPath):
+            os.remove(temporaryPath)
+        raise
+
+
+def runToEnd(steps):
+    """Runs a generator of steps to its end and returns what it returns"""
+    while True:
+        try:
+            next(steps)
+        except StopIteration as stop:
+            return stop.value
+
+
+def scaleVertices(vertices, scale):
+    """Returns vertices scaled along each axis, or the same array for a scale of 1"""
+    if tuple(scale) == (1.0, 1.0, 1.0):
+        return vertices
+    return (np.asarray(vertices) * np.asarray(scale, dtype=np.float64)).astype(np.float32)
+
+
+def serializeCollisionField(job):
+    """Cleans, grids and packs one collision field, runs in the worker processes"""
+    """job is (writer settings, vertices, triangles, scale, decimate ratio, whether to pack the triangles)"""
+    settings, vertices, triangles, scale, decimateRatio, packTriangles = job
+    return StageWriter(Stage(), **settings).serializeCollisionField(scaleVertices(vertices, scale), triangles, decimateRatio,
+                                                                    packTriangles)
+
+
+class Vector(object):
+    """The bit of mathutils.Vector the scalar triangle writer uses, components are stored as 32 bit floats"""
+    __slots__ = ('x', 'y', 'z')
+
+    def __init__(self, values):
+        self.x, self.y, self.z = (float(np.float32(value)) for value in values)
+
+
+class ExportTelemetry(object):
+    """Records the wall time, bytes and peak memory of each export stage"""
+
+    def __init__(self, traceMemory=False, profiler=None):
+        self.stages = []                # (name, seconds, bytes, peak memory) in the order they ran
+        self.counts = {}                # Objects, triangles, cells and so on
+        self.traceMemory = traceMemory
+        self.profiler = profiler        # Anything with enable()/disable(), e.g. cProfile.Profile()
+        self.output = None
+        self.startedTracing = False
+        self.seconds = 0.0
+        self.startTime = None
+
+    def start(self):
+        if self.traceMemory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.startedTracing = True
+        if self.profiler is not None:
+            self.profiler.enable()
+        self.startTime = time.perf_counter()
+
+    def stop(self):
+        self.seconds = time.perf_counter() - self.startTime
+        if self.profiler is not None:
+            self.profiler.disable()
+        if self.startedTracing:
+            tracemalloc.stop()
+            self.startedTracing = False
+
+    def run(self, name, size, function, *args):
+        """Runs one stage, size is the number of bytes it emits"""
+        # Without reset_peak (before Python 3.9) the peak is the highest so far, not just this stage's
+        if self.traceMemory and hasattr(tracemalloc, "reset_peak"):
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        result = function(*args)
+        seconds = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1] if self.traceMemory else None
+        self.stages.append((name, seconds, size, peak))
+        return result
+
+    def runSteps(self, name, size, steps):
+        """Runs a stage that yields as it goes, passing its steps on, only the time spent inside the stage counts"""
+        if self.traceMemory and hasattr(tracemalloc, "reset_peak"):
+            tracemalloc.reset_peak()
+        seconds = 0.0
+        while True:
+            start = time.perf_counter()
+            try:
+                step = next(steps)
+            except StopIteration as stop:
+                seconds += time.perf_counter() - start
+                result = stop.value
+                break
+            seconds += time.perf_counter() - start
+            yield step
+        peak = tracemalloc.get_traced_memory()[1] if self.traceMemory else None
+        self.stages.append((name, seconds, size, peak))
+        return result
+
+    def count(self, **counts):
+        self.counts.update(counts)
+
+    @property
+    def peakMemory(self):
+        peaks = [stage[3] for stage in self.stages if stage[3] is not None]
+        return max(peaks) if peaks else None
+
+    def toDict(self):
+        return {
+            'output': self.output,
+            'seconds': self.seconds,
+            'peakMemory': self.peakMemory,
+            'counts': self.counts,
+            'stages': [{'name': name, 'seconds': seconds, 'bytes': size, 'peakMemory': peak}
+                       for name, seconds, size, peak in self.stages],
+            }
+
+    def writeJSON(self, path):
+        with open(path, 'w') as file:
+            json.dump(self.toDict(), file, indent=2)
+
+    def summary(self):
+        """One line per stage, slowest first"""
+        lines = ["Exported %s in %.3fs" % (self.output, self.seconds)]
+        for name, seconds, size, peak in sorted(self.stages, key=lambda stage: -stage[1]):
+            line = "  %-36s %8.3fs %10d bytes" % (name, seconds, size)
+            if peak is not None:
+                line += " %8.1f MB peak" % (peak / 1048576.0)
+            lines.append(line)
+        lines.append("  " + ", ".join("%s %d" % item for item in sorted(self.counts.items())))
+        return "\n".join(lines)
+
+
+class StageAnalysis(object):
+    """Projected size and collision cost of a stage, from StageWriter.analyze()"""
+
+    # Triangles per grid cell of each histogram bin, and the heatmap characters from empty to fullest
+    histogramBins = [0, 1, 2, 4, 8, 16, 32, 64, 128]
+    heatmapRamp = " .:-=+*#%@"
+
+    def __init__(self, fileSize, sections, fields):
+        self.fileSize = fileSize
+        self.sections = sections        # Bytes per write stage
+        self.fields = fields            # One dict per collision field, see StageWriter.collisionFieldAnalysis()
+
+    @property
+    def overflowingFields(self):
+        return [field for field in self.fields if field['triangles'] > maxCollisionTriangles]
+
+    def histogram(self, cellCounts):
+        """Number of cells per histogramBins bin, the last bin holds everything past it"""
+        bins = np.searchsorted(self.histogramBins, np.asarray(cellCounts).ravel(), side='right') - 1
+        return np.bincount(bins, minlength=len(self.histogramBins)).tolist()
+
+    def binLabel(self, index):
+        low = self.histogramBins[index]
+        if index + 1 == len(self.histogramBins):
+            return "%d+" % low
+        high = self.histogramBins[index + 1] - 1
+        return "%d" % low if low == high else "%d-%d" % (low, high)
+
+    def heatmap(self, cellCounts):
+        """One line per grid row (Z), one character per cell (X), scaled to the field's fullest cell"""
+        cellCounts = np.asarray(cellCounts)
+        highest = max(int(cellCounts.max()) if cellCounts.size else 0, 1)
+        levels = np.ceil(cellCounts * (len(self.heatmapRamp) - 1) / float(highest)).astype(np.int64)
+        return ["".join(self.heatmapRamp[level] for level in row) for row in levels.tolist()]
+
+    def toDict(self):
+        return {
+            'bytes': self.fileSize,
+            'sections': self.sections,
+            'fields': [dict((key, value) for key, value in field.items() if key != 'cellCounts') for field in self.fields],
+            'histogram': dict(zip([self.binLabel(i) for i in range(0, len(self.histogramBins))],
+                                  self.histogram(np.concatenate([field['cellCounts'].ravel() for field in self.fields])
+                                                 if self.fields else []))),
+            'overflowingFields': [field['name'] for field in self.overflowingFields],
+            }
+
+    def writeJSON(self, path):
+        with open(path, 'w') as file:
+            json.dump(self.toDict(), file, indent=2)
+
+    def summary(self):
+        """Projected size, the biggest sections and any fields past the triangle index limit"""
+        lines = ["Projected size %d bytes" % self.fileSize]
+        for name, size in sorted(self.sections.items(), key=lambda item: -item[1]):
+            if size != 0:
+                lines.append("  %-36s %10d bytes" % (name, size))
+        for field in self.overflowingFields:
+            lines.append("  %s has %d triangles, only the first %d can be indexed" % (
+                    field['name'], field['triangles'], maxCollisionTriangles))
+        return "\n".join(lines)
+
+    def text(self, heatmaps=True):
+        """The summary followed by every field's triangles, grid, cell histogram and heatmap"""
+        lines = [self.summary()]
+        for field in self.fields:
+            lines.append("")
+            line = "%s (%s): %d triangles, %dx%d grid, at most %d per cell" % (
+                    field['name'], field['type'], field['triangles'], field['grid'][4], field['grid'][5], field['maxCellTriangles'])
+            if field['sharesDataWith'] is not None:
+                line += ", shares the data of %s" % field['sharesDataWith']
+            if field['triangles'] > maxCollisionTriangles:
+                line += ", TOO MANY TRIANGLES"
+            lines.append(line)
+            counts = self.histogram(field['cellCounts'])
+            lines.append("  Cells by triangles: " + ", ".join(
+                    "%s: %d" % (self.binLabel(i), count) for i, count in enumerate(counts) if count != 0))
+            if heatmaps:
+                lines += ["  |%s|" % row for row in self.heatmap(field['cellCounts'])]
+        return "\n".join(lines)
+
+
+class StageWriter(object):
+    """Lays out a Stage and serializes it into one preallocated buffer"""
+
+    sizeOfHeader = 160                                  # Size of file header (always 0xA0 (160)
+
+    # Big endian layout of one 64 byte collision triangle
+    triangleDtype = np.dtype([
+            ('position', '>f4', 3),
+            ('normal', '>f4', 3),
+            ('rotation', '>u2', 3),
+            ('padding', '>u2'),
+            ('dx2x1', '>f4'),
+            ('dy2y1', '>f4'),
+            ('dx3x1', '>f4'),
+            ('dy3y1', '>f4'),
+            ('tangent', '>f4', 2),
+            ('bitangent', '>f4', 2),
+            ])
+
+    def __init__(self, stage, autoFitCollisionGrid=True, collisionGridTargetTriangles=16, collisionGridMaxCells=64,
+                 collisionGridStart=(-256.0, -256.0), collisionGridStep=(32.0, 32.0), collisionGridStepCount=(16, 16),
+                 scalarTriangleWriter=False, cleanCollision=True, collisionWeldDistance=0.0001,
+                 animationPositionTolerance=0.01, animationRotationTolerance=0.1,
+                 shareCollisionData=True, shareGridCellLists=True, reorderCollisionTriangles=False, workers=1,
+                 exportCache=None, telemetry=None):
+        self.stage = stage
+        self.autoFitCollisionGrid = autoFitCollisionGrid
+        self.collisionGridTargetTriangles = collisionGridTargetTriangles
+        self.collisionGridMaxCells = collisionGridMaxCells
+        self.collisionGridStart = collisionGridStart
+        self.collisionGridStep = collisionGridStep
+        self.collisionGridStepCount = collisionGridStepCount
+        self.scalarTriangleWriter = scalarTriangleWriter
+        self.cleanCollision = cleanCollision
+        self.collisionWeldDistance = collisionWeldDistance
+        self.animationPositionTolerance = animationPositionTolerance      # Units
+        self.animationRotationTolerance = animationRotationTolerance      # Degrees
+        self.shareCollisionData = shareCollisionData            # Fields of linked duplicates point at one copy of their data
+        self.shareGridCellLists = shareGridCellLists            # Cells with the same triangle list point at one copy of it
+        self.reorderCollisionTriangles = reorderCollisionTriangles  # Sort each field's triangles along a Morton curve
+        self.workers = workers                                  # Processes to serialize collision fields in
+        self.dryRun = False                                     # Set by analyze(), lays the stage out without packing triangles
+        self.fieldsDone = 0                                     # Collision fields serialized (or taken from the cache) so far
+        self.trianglesDone = 0                                  # Their triangles before cleanup
+        self.numberOfInputTriangles = 0                         # Triangles of every collision field before cleanup
+        self.exportCache = exportCache                          # SMB_LZ_Cache.ExportCache or None
+        self.telemetry = telemetry if telemetry is not None else ExportTelemetry()
+
+        self.numberOfCollisionFields = len(stage.levelModels) + len(stage.reflectiveObjects)
+        self.collisionFieldsOffset = 0                          # Offset to collision fields/headers
+        self.falloutPlaneOffset = 0                             # Offset to fallout plane value
+        self.numberOfGoals = len(stage.goals) + sum(len(items) for items in stage.goalArrays)
+        self.goalsOffset = 0
+        self.numberOfBumpers = len(stage.bumpers) + sum(len(items) for items in stage.bumperArrays)
+        self.bumpersOffset = 0
+        self.numberOfJamabars = len(stage.jamabars) + sum(len(items) for items in stage.jamabarArrays)
+        self.jamabarOffset = 0
+        self.numberOfBananas = len(stage.bananas) + sum(len(items) for items in stage.bananaArrays)
+        self.bananasOffset = 0
+        self.numberOfLevelModels = len(stage.levelModels)
+        self.levelModelsOffset = 0
+        self.numberOfBackgroundModels = len(stage.backgroundModels)
+        self.backgroundModelsOffset = 0
+        self.numberOfReflectiveObjects = len(stage.reflectiveObjects)
+        self.reflectiveObjectsOffset = 0
+        self.modelNamesOffset = 0                               # Offset to model names
+        self.offsetToModelNamePointers = 0
+        self.fileSize = 0                                       # Size of the whole LZ
+
+        self.levelModelNameOffsets = []                         # List of offsets to level model name asciis
+        self.levelModelNamePointerOffsets = []                  # List of offsets to the level model name ascii offsets
+        self.levelModelTriangleOffsets = []                     # List of triangle collider offsets
+        self.levelModelCollisionGridPointers = []               # List of collision grid pointer offsets
+        self.levelModelCollisionGridPointerPointers = []        # List of pointer offsets to the collision grid pointer
+        self.numberOfLevelModelTriangles = []                   # List of the number of level model triangles
+        self.levelModelCollisionGrids = []                      # List of collision grid placements per level model
+        self.levelModelCollisionGridCells = []                  # List of (cell triangle indices, cell triangle counts) per level model
+        self.levelModelTriangleBlocks = []                      # List of serialized triangles per level model
+        self.backgroundModelNameOffsets = []                    # List of offsets to model name asciis
+        self.backgroundModelNamePointerOffsets = []             # List of offsets to model name ascii offsets
+        self.reflectiveObjectNameOffsets = []                   # List of offsets to model name asciis
+        self.reflectiveObjectNamePointerOffsets = []            # List of offsets to the model name ascii offsets
+        self.reflectiveObjectTriangleOffsets = []               # List of triangle collider offsets
+        self.reflectiveObjectCollisionGridPointers = []         # List of collision grid pointer offsets
+        self.reflectiveObjectCollisionGridPointerPointers = []  # List of pointer offsets to the collision grid pointers
+        self.numberOfReflectiveObjectTriangles = []             # List of the number of model triangles
+        self.reflectiveObjectCollisionGrids = []                # List of collision grid placements per reflective object
+        self.reflectiveObjectCollisionGridCells = []            # List of (cell triangle indices, cell triangle counts) per reflective object
+        self.reflectiveObjectTriangleBlocks = []                # List of serialized triangles per reflective object
+        self.collisionFieldCacheMisses = []                     # List of (cache key, entry) of fields serialized in this export
+        self.collisionFieldSources = []                         # Index of the field whose triangles and grid each field uses
+        self.collisionFieldKeyframes = []                       # List of reduced (times, values) per channel (or None) per collision field
+        self.collisionFieldAnimationOffsets = []                # List of animation header offsets (or 0) per collision field
+        self.collisionFieldKeyframeOffsets = []                 # List of keyframe offsets per channel per collision field
+        self.numberOfSampledKeyframes = 0                       # Keyframes before reduction
+        self.numberOfWeldedVertices = 0                         # Vertices merged into a neighbour by the collision cleanup
+        self.numberOfDegenerateTriangles = 0                    # Zero area and sliver triangles dropped by the collision cleanup
+        self.numberOfDuplicateTriangles = 0                     # Repeated triangles dropped by the collision cleanup
+        self.numberOfDecimatedTriangles = 0                     # Triangles removed by collision decimation
+        self.gridCellListPool = None                            # Every distinct grid cell list, when they're shared
+        self.gridCellListPoolOffset = 0                         # Offset to the shared grid cell lists
+        self.collisionGridCellListOffsets = []                  # Offset of every cell's list into the pool (or None) per collision field
+        self.numberOfGridCellLists = 0                          # Grid cell lists written
+
+    def build(self):
+        """Builds the SMB LZ File in memory and returns its bytes"""
+        return runToEnd(self.buildSteps())
+
+    def buildSteps(self):
+        """Same as build() one step at a time, yields a BuildProgress after every collision field and section"""
+        """Closing it early cancels any collision fields still waiting for a worker and stores nothing in the cache"""
+        telemetry = self.telemetry
+
+        # The collision data decides the size of the biggest sections, so gather it first
+        yield from telemetry.runSteps("serializeCollisionFields", 0, self.serializeCollisionFieldSteps())
+        telemetry.run("reduceAnimations", 0, self.reduceAnimations)
+        telemetry.run("poolGridCellLists", 0, self.poolGridCellLists)
+
+        # Work out where every section goes, then fill one preallocated buffer
+        telemetry.run("planLayout", 0, self.planLayout)
+        buffer = bytearray(self.fileSize)
+
+        sizes = self.sectionSizes()
+        for write in [
+                self.writeHeader,
+                self.writeStartPositions,
+                self.writeFalloutPlane,
+                self.writeGoals,
+                self.writeBumpers,
+                self.writeJamabars,
+                self.writeBananas,
+                self.writeLevelNameOffsets,
+                self.writeCollisionFields,
+                self.writeAnimations,
+                self.writeCollisionTriangles,
+                self.writeCollisionGridTriangleList,
+                self.writeCollisionGridTrianglePointers,
+                self.writeLevelModels,
+                self.writeReflectiveModels,
+                self.writeBackgroundModels,
+                self.writeobjectNames,
+                ]:
+            telemetry.run(write.__name__, sizes[write.__name__], write, buffer)
+            yield self.progress(write.__name__)
+
+        telemetry.run("storeExportCache", 0, self.storeExportCache)
+
+        telemetry.count(
+                bytes=self.fileSize,
+                startPositions=len(self.stage.startPositions),
+                goals=self.numberOfGoals,
+                bumpers=self.numberOfBumpers,
+                jamabars=self.numberOfJamabars,
+                bananas=self.numberOfBananas,
+                levelModels=self.numberOfLevelModels,
+                reflectiveObjects=self.numberOfReflectiveObjects,
+                backgroundModels=self.numberOfBackgroundModels,
+                collisionFields=self.numberOfCollisionFields,
+                overflowingFields=len(self.overflowingCollisionFields()),
+                crowdedFields=len(self.crowdedCollisionFields()),
+                sharedCollisionFields=self.numberOfCollisionFields - len(set(self.collisionFieldSources)),
+                triangles=sizes['writeCollisionTriangles'] // 64,
+                gridCells=sizes['writeCollisionGridTrianglePointers'] // 4,
+                gridCellLists=self.numberOfGridCellLists,
+                weldedVertices=self.numberOfWeldedVertices,
+                degenerateTriangles=self.numberOfDegenerateTriangles,
+                duplicateTriangles=self.numberOfDuplicateTriangles,
+                decimatedTriangles=self.numberOfDecimatedTriangles,
+                sampledKeyframes=self.numberOfSampledKeyframes,
+                keyframes=self.numberOfKeyframes())
+        return buffer
+
+    def analyze(self):
+        """Lays the stage out like build() without packing or writing anything, returns a StageAnalysis"""
+        return runToEnd(self.analyzeSteps())
+
+    def analyzeSteps(self):
+        """Same as analyze() one step at a time, yields a BuildProgress after every collision field"""
+        telemetry = self.telemetry
+        self.dryRun = True
+        yield from telemetry.runSteps("serializeCollisionFields", 0, self.serializeCollisionFieldSteps())
+        telemetry.run("reduceAnimations", 0, self.reduceAnimations)
+        telemetry.run("poolGridCellLists", 0, self.poolGridCellLists)
+        telemetry.run("planLayout", 0, self.planLayout)
+        yield self.progress("planLayout")
+        return StageAnalysis(self.fileSize, self.sectionSizes(), self.collisionFieldAnalysis())
+
+    def collisionFieldAnalysis(self):
+        """Returns the name, type, triangle count, grid and triangles per cell of every collision field"""
+        models = self.stage.levelModels + self.stage.reflectiveObjects
+        fields = []
+        for i, model in enumerate(models):
+            if i < self.numberOfLevelModels:
+                fieldType, grid = "levelModel", self.levelModelCollisionGrids[i]
+                numTriangles, cells = self.numberOfLevelModelTriangles[i], self.levelModelCollisionGridCells[i]
+            else:
+                j = i - self.numberOfLevelModels
+                fieldType, grid = "reflective", self.reflectiveObjectCollisionGrids[j]
+                numTriangles, cells = self.numberOfReflectiveObjectTriangles[j], self.reflectiveObjectCollisionGridCells[j]
+            cellCounts = np.asarray(cells[1], dtype=np.int64).reshape(grid.countZ, grid.countX)
+            source = self.collisionFieldSources[i]
+            fields.append({
+                'name': model.name,
+                'type': fieldType,
+                'triangles': int(numTriangles),
+                'grid': tuple(float(value) for value in grid[:4]) + (int(grid.countX), int(grid.countZ)),
+                'cellCounts': cellCounts,
+                'maxCellTriangles': int(cellCounts.max()) if cellCounts.size else 0,
+                'sharesDataWith': models[source].name if source != i else None,
+                })
+        return fields
+
+    def overflowingCollisionFields(self):
+        """Names of the fields with more triangles than the grid cell lists can index"""
+        models = self.stage.levelModels + self.stage.reflectiveObjects
+        counts = self.numberOfLevelModelTriangles + self.numberOfReflectiveObjectTriangles
+        return [model.name for model, numTriangles in zip(models, counts) if numTriangles > maxCollisionTriangles]
+
+    def crowdedCollisionFields(self):
+        """Names of the auto-fitted fields whose fullest grid cell is still over the target triangle count"""
+        if not self.autoFitCollisionGrid:
+            return []
+        models = self.stage.levelModels + self.stage.reflectiveObjects
+        cells = self.levelModelCollisionGridCells + self.reflectiveObjectCollisionGridCells
+        return [model.name for model, (cellTriangles, cellCounts) in zip(models, cells)
+                if cellCounts.size and int(cellCounts.max()) > self.collisionGridTargetTriangles]
+
+    def serializeCollisionFields(self):
+        """Cleans, grids and packs the triangles of every collision field"""
+        runToEnd(self.serializeCollisionFieldSteps())
+
+    def serializeCollisionFieldSteps(self):
+        """Same as serializeCollisionFields(), yields a BuildProgress after every field it serializes"""
+        """Fields of unchanged objects come straight from the export cache, the rest are spread over the worker processes"""
+        models = self.stage.levelModels + self.stage.reflectiveObjects
+        classifications = ["levelModel"] * len(self.stage.levelModels) + ["reflective"] * len(self.stage.reflectiveObjects)
+        self.findCollisionFieldSources(models)
+
+        entries = []
+        misses = []
+        for i, (model, classification) in enumerate(zip(models, classifications)):
+            source = self.collisionFieldSources[i]
+            if source != i:
+                entries.append(None)
+                continue
+            key, entry = self.cachedCollisionField(model, classification)
+            if entry is None:
+                misses.append((len(entries), key))
+            entries.append(entry)
+
+        # Progress counts the triangles going in, fields that are cached or shared are done already
+        self.numberOfInputTriangles = sum(len(model.triangles) for model in models)
+        self.trianglesDone = self.numberOfInputTriangles - sum(len(models[i].triangles) for i, key in misses)
+        self.fieldsDone = self.numberOfCollisionFields - len(misses)
+        yield self.progress("serializeCollisionFields")
+
+        settings = self.fieldSettings()
+        jobs = [(settings, models[i].vertices, models[i].triangles, tuple(models[i].scale), models[i].decimateRatio,
+                 not self.dryRun)
+                for i, key in misses]
+        if self.workers > 1 and len(jobs) > 1:
+            # Results are taken in job order, so the output doesn't depend on which worker finishes first
+            # Spawned rather than forked, forking Blender copies its threads and GPU state into the workers
+            # The workers only import this module
+            pool = concurrent.futures.ProcessPoolExecutor(max_workers=min(self.workers, len(jobs)),
+                                                          mp_context=multiprocessing.get_context('spawn'))
+            futures = [pool.submit(serializeCollisionField, job) for job in jobs]
+            try:
+                for (i, key), future in zip(misses, futures):
+                    self.storeCollisionField(entries, i, key, models[i], future.result())
+                    yield self.progress("serializeCollisionFields")
+            finally:
+                # Don't start the fields nobody is waiting for anymore when the build is closed early
+                for future in futures:
+                    future.cancel()
+                pool.shutdown()
+        else:
+            for (i, key), job in zip(misses, jobs):
+                self.storeCollisionField(entries, i, key, models[i], serializeCollisionField(job))
+                yield self.progress("serializeCollisionFields")
+        entries = [entries[source] for source in self.collisionFieldSources]
+
+        # Go through every standard level model then every reflective level model
+        for i, entry in enumerate(entries):
+            if i < len(self.stage.levelModels):
+                self.numberOfLevelModelTriangles.append(entry['numberOfTriangles'])
+                self.levelModelTriangleBlocks.append(entry['triangles'])
+                self.levelModelCollisionGrids.append(CollisionGrid(*entry['grid']))
+                self.levelModelCollisionGridCells.append(entry['cells'])
+            else:
+                self.numberOfReflectiveObjectTriangles.append(entry['numberOfTriangles'])
+                self.reflectiveObjectTriangleBlocks.append(entry['triangles'])
+                self.reflectiveObjectCollisionGrids.append(CollisionGrid(*entry['grid']))
+                self.reflectiveObjectCollisionGridCells.append(entry['cells'])
+
+    def storeCollisionField(self, entries, field, key, model, result):
+        """Takes in a freshly serialized field"""
+        welded, degenerate, duplicates, decimated = result.pop('removed')
+        self.numberOfWeldedVertices += welded
+        self.numberOfDegenerateTriangles += degenerate
+        self.numberOfDuplicateTriangles += duplicates
+        self.numberOfDecimatedTriangles += decimated
+        entries[field] = result
+        if not self.dryRun:
+            self.collisionFieldCacheMisses.append((key, result))
+        self.fieldsDone += 1
+        self.trianglesDone += len(model.triangles)
+
+    def progress(self, stage):
+        return BuildProgress(stage, self.fieldsDone, self.numberOfCollisionFields, self.trianglesDone, self.numberOfInputTriangles)
+
+    def findCollisionFieldSources(self, models):
+        """Points every field at the first field with the same vertex and triangle arrays and scale"""
+        """Linked duplicates are handed the same arrays, their triangles and grid are then serialized and written once"""
+        """Every field is placed by its header, so sharing never changes where anything collides"""
+        sources = {}
+        for i, model in enumerate(models):
+            if not self.shareCollisionData:
+                self.collisionFieldSources.append(i)
+                continue
+            # The header can't scale a field, copies at another scale need their own triangles
+            key = (id(model.vertices), id(model.triangles), tuple(model.scale), model.decimateRatio)
+            self.collisionFieldSources.append(sources.setdefault(key, i))
+
+    def ownsCollisionData(self, field):
+        """Whether a field's triangles and grid are written for it rather than shared from an earlier field"""
+        return self.collisionFieldSources[field] == field
+
+    def fieldSettings(self):
+        """The options a worker needs to serialize a collision field"""
+        return {
+            'autoFitCollisionGrid': self.autoFitCollisionGrid,
+            'collisionGridTargetTriangles': self.collisionGridTargetTriangles,
+            'collisionGridMaxCells': self.collisionGridMaxCells,
+            'collisionGridStart': tuple(self.collisionGridStart),
+            'collisionGridStep': tuple(self.collisionGridStep),
+            'collisionGridStepCount': tuple(self.collisionGridStepCount),
+            'scalarTriangleWriter': self.scalarTriangleWriter,
+            'cleanCollision': self.cleanCollision,
+            'collisionWeldDistance': self.collisionWeldDistance,
+            'reorderCollisionTriangles': self.reorderCollisionTriangles,
+            }
+
+    def serializeCollisionField(self, vertices, triangles, decimateRatio, packTriangles=True):
+        """Returns a field's packed triangles (None unless packTriangles), grid and grid cells, and how much the cleanup removed"""
+        numDecimated = 0
+        if decimateRatio < 1.0:
+            numTriangles = len(triangles)
+            vertices, triangles = decimateCollisionMesh(vertices, triangles, decimateRatio)
+            numDecimated = numTriangles - len(triangles)
+        removed = (0, 0, 0)
+        if self.cleanCollision:
+            vertices, triangles, removed = cleanCollisionMesh(vertices, triangles, self.collisionWeldDistance)
+
+        triangleVertices = gatherTriangleVertices(vertices, triangles)
+        if self.reorderCollisionTriangles:
+            # The cells are binned after the reorder, so their lists use the new triangle numbers
+            triangleVertices = triangleVertices[mortonOrder(triangleVertices)]
+        grid = self.fitCollisionGrid(triangleVertices)
+        cells = self.binCollisionTriangles(triangleVertices, grid)
+        block = None
+        if packTriangles:
+            block = bytearray(64 * len(triangleVertices))
+            self.writeTriangles(block, 0, triangleVertices)
+            block = bytes(block)
+        return {
+            'grid': tuple(grid),
+            'cells': cells,
+            'numberOfTriangles': len(triangleVertices),
+            'triangles': block,
+            'removed': removed + (numDecimated,),
+            }
+
+    def cachedCollisionField(self, model, classification):
+        """Returns the cache key of a collision field and its cached entry, or None for a miss"""
+        if self.exportCache is None:
+            return None, None
+        import SMB_LZ_Cache
+        # Everything that goes into the field's triangles, grid and cell lists
+        key = SMB_LZ_Cache.cacheKey(
+                classification,
+                np.ascontiguousarray(model.vertices, dtype=np.float32).tobytes(),
+                np.ascontiguousarray(model.triangles, dtype=np.int64).tobytes(),
+                tuple(model.scale),
+                model.decimateRatio,
+                sorted(self.fieldSettings().items()))
+        return key, self.exportCache.get(key)
+
+    def storeExportCache(self):
+        """Adds the freshly serialized collision fields to the export cache"""
+        if self.exportCache is None:
+            return
+        for key, entry in self.collisionFieldCacheMisses:
+            self.exportCache.put(key, entry)
+        self.exportCache.evict()
+
+    def poolGridCellLists(self):
+        """Gives every distinct grid cell list one place in a shared pool, cells with the same triangles point at it"""
+        """A list that is the tail of a longer one points into that one, the empty list is the tail of every list"""
+        gridCells = self.levelModelCollisionGridCells + self.reflectiveObjectCollisionGridCells
+        owned = [field for field in range(0, len(gridCells)) if self.ownsCollisionData(field)]
+        numberOfCells = sum(len(gridCells[field][1]) for field in owned)
+        if not self.shareGridCellLists or numberOfCells == 0:
+            self.numberOfGridCellLists = numberOfCells
+            return
+
+        # Every owned field's terminated lists back to back
+        cellLists = [np.insert(gridCells[field][0], np.cumsum(gridCells[field][1]), 65535).astype(np.uint16) for field in owned]
+        values = np.concatenate(cellLists)
+        lengths = np.concatenate([np.asarray(gridCells[field][1], dtype=np.int64) + 1 for field in owned])
+        starts = np.cumsum(lengths) - lengths
+        cellOf = np.repeat(np.arange(numberOfCells), lengths)
+        positions = np.arange(len(values)) - starts[cellOf]
+
+        # Group the cells by length and two polynomial hashes of their lists (wrapping 64 bit arithmetic)...
+        hashes = []
+        for base in [1000003, 2654435761]:
+            powers = np.cumprod(np.full(int(lengths.max()), base, dtype=np.uint64))
+            hashes.append(np.add.reduceat((values.astype(np.uint64) + np.uint64(1)) * powers[positions], starts).view(np.int64))
+        first, groups = uniqueRows(np.stack([lengths] + hashes, axis=1))
+        representatives = first[groups]
+
+        # ...then make sure every cell really matches its group's first cell, any that doesn't gets its own list
+        mismatched = np.unique(cellOf[values != values[starts[representatives][cellOf] + positions]])
+        for cell in mismatched.tolist():
+            representatives[cell] = cell
+        distinct = np.unique(representatives)
+        data = values.astype('>u2').tobytes()
+        reversedData = values[::-1].astype('>u2').tobytes()
+        listEnds = 2 * (starts[distinct] + lengths[distinct])
+        listStarts = 2 * starts[distinct]
+        reversedLists = [reversedData[len(data) - end:len(data) - start] for start, end in zip(listStarts.tolist(), listEnds.tolist())]
+
+        # Reversed, a tail is a prefix, and sorted, a list comes right before the lists it's a prefix of
+        hosts = list(range(0, len(distinct)))
+        order = sorted(hosts, key=reversedLists.__getitem__)
+        for shorter, longer in reversed(list(zip(order, order[1:]))):
+            if reversedLists[longer].startswith(reversedLists[shorter]):
+                hosts[shorter] = hosts[longer]
+
+        # Lists that aren't a tail of another go into the pool in the order they first appear
+        listOffsets = np.zeros(len(distinct), dtype=np.int64)
+        pool = bytearray()
+        for index, host in enumerate(hosts):
+            if host == index:
+                listOffsets[index] = len(pool)
+                pool += data[listStarts[index]:listEnds[index]]
+        for index, host in enumerate(hosts):
+            if host != index:
+                listOffsets[index] = listOffsets[host] + len(reversedLists[host]) - len(reversedLists[index])
+
+        cellOffsets = listOffsets[np.searchsorted(distinct, representatives)]
+        fieldStarts = np.cumsum([0] + [len(gridCells[field][1]) for field in owned])
+        self.collisionGridCellListOffsets = [None] * len(gridCells)
+        for i, field in enumerate(owned):
+            self.collisionGridCellListOffsets[field] = cellOffsets[fieldStarts[i]:fieldStarts[i + 1]]
+        self.gridCellListPool = bytes(pool)
+        self.numberOfGridCellLists = sum(1 for index, host in enumerate(hosts) if host == index)
+
+    def planLayout(self):
+        """Works out the offset of every section before anything is written"""
+        """Sections are laid out in the same order the game's own stages use"""
+
+        # Start positions are always right after the header
+        offset = self.sizeOfHeader
+        offset += 20 * len(self.stage.startPositions)               # (20x) Start positions
+
+        self.falloutPlaneOffset = offset
+        offset += 4                                                 # (4f) Fallout plane
+
+        if self.numberOfGoals != 0:
+            self.goalsOffset = offset
+            offset += 20 * self.numberOfGoals                       # (20x) Goals
+        if self.numberOfBumpers != 0:
+            self.bumpersOffset = offset
+            offset += 32 * self.numberOfBumpers                     # (32x) Bumpers
+        if self.numberOfJamabars != 0:
+            self.jamabarOffset = offset
+            offset += 32 * self.numberOfJamabars                    # (32x) Jamabars
+        if self.numberOfBananas != 0:
+            self.bananasOffset = offset
+            offset += 16 * self.numberOfBananas                     # (16x) Bananas
+
+        # Pointers to model names, level models then reflective then background
+        total = self.numberOfLevelModels + self.numberOfReflectiveObjects + self.numberOfBackgroundModels
+        if total != 0:
+            self.offsetToModelNamePointers = offset
+            self.levelModelNamePointerOffsets = [offset + 4 * i for i in range(0, self.numberOfLevelModels)]
+            offset += 4 * self.numberOfLevelModels
+            self.reflectiveObjectNamePointerOffsets = [offset + 4 * i for i in range(0, self.numberOfReflectiveObjects)]
+            offset += 4 * self.numberOfReflectiveObjects
+            self.backgroundModelNamePointerOffsets = [offset + 4 * i for i in range(0, self.numberOfBackgroundModels)]
+            offset += 4 * self.numberOfBackgroundModels
+
+        self.numberOfCollisionFields = self.numberOfLevelModels + self.numberOfReflectiveObjects
+        if self.numberOfCollisionFields != 0:
+            self.collisionFieldsOffset = offset
+            offset += 196 * self.numberOfCollisionFields            # (196x) Collision fields/headers
+
+        # Animation headers, each followed by its keyframes channel by channel
+        for keyframes in self.collisionFieldKeyframes:
+            if keyframes is None:
+                self.collisionFieldAnimationOffsets.append(0)
+                self.collisionFieldKeyframeOffsets.append(None)
+                continue
+            self.collisionFieldAnimationOffsets.append(offset)
+            offset += sizeOfAnimationHeader                         # (64) Animation header
+            channelOffsets = []
+            for times, values in keyframes:
+                channelOffsets.append(offset if len(times) != 0 else 0)
+                offset += sizeOfKeyframe * len(times)               # (20x) Keyframes
+            self.collisionFieldKeyframeOffsets.append(channelOffsets)
+
+        # Collision triangles, level models then reflective objects, fields sharing data reuse their source's offsets
+        triangleOffsets = []
+        for field, numTriangles in enumerate(self.numberOfLevelModelTriangles + self.numberOfReflectiveObjectTriangles):
+            if not self.ownsCollisionData(field):
+                triangleOffsets.append(triangleOffsets[self.collisionFieldSources[field]])
+                continue
+            triangleOffsets.append(offset)
+            offset += 64 * numTriangles                             # (64x) Triangles
+
+        # Collision grid triangle lists, each cell is terminated and every field is 4 byte aligned
+        listOffsets = []
+        gridCells = self.levelModelCollisionGridCells + self.reflectiveObjectCollisionGridCells
+        if self.gridCellListPool is not None:
+            # Or all of them are in one pool of distinct lists
+            self.gridCellListPoolOffset = offset
+            for field, cellOffsets in enumerate(self.collisionGridCellListOffsets):
+                if not self.ownsCollisionData(field):
+                    listOffsets.append(listOffsets[self.collisionFieldSources[field]])
+                    continue
+                listOffsets.append(offset + (int(cellOffsets[0]) if len(cellOffsets) != 0 else 0))
+            offset = self.alignOffset(offset + len(self.gridCellListPool))
+        else:
+            for field, (cellTriangles, cellCounts) in enumerate(gridCells):
+                if not self.ownsCollisionData(field):
+                    listOffsets.append(listOffsets[self.collisionFieldSources[field]])
+                    continue
+                listOffsets.append(offset)
+                offset = self.alignOffset(offset + 2 * (len(cellTriangles) + len(cellCounts)))
+
+        # Collision grid triangle list pointers
+        pointerOffsets = []
+        for field, (cellTriangles, cellCounts) in enumerate(gridCells):
+            if not self.ownsCollisionData(field):
+                pointerOffsets.append(pointerOffsets[self.collisionFieldSources[field]])
+                continue
+            pointerOffsets.append(offset)
+            offset += 4 * len(cellCounts)                           # (4i) Offset per cell
+
+        numLevelModels = self.numberOfLevelModels
+        self.levelModelTriangleOffsets = triangleOffsets[:numLevelModels]
+        self.reflectiveObjectTriangleOffsets = triangleOffsets[numLevelModels:]
+        self.levelModelCollisionGridPointers = listOffsets[:numLevelModels]
+        self.reflectiveObjectCollisionGridPointers = listOffsets[numLevelModels:]
+        self.levelModelCollisionGridPointerPointers = pointerOffsets[:numLevelModels]
+        self.reflectiveObjectCollisionGridPointerPointers = pointerOffsets[numLevelModels:]
+
+        if self.numberOfLevelModels != 0:
+            self.levelModelsOffset = offset
+            offset += 12 * self.numberOfLevelModels                 # (12x) Level model headers
+        if self.numberOfReflectiveObjects != 0:
+            self.reflectiveObjectsOffset = offset
+            offset += 8 * self.numberOfReflectiveObjects            # (8x) Reflective model headers
+        if self.numberOfBackgroundModels != 0:
+            self.backgroundModelsOffset = offset
+            offset += 56 * self.numberOfBackgroundModels            # (56x) Background model headers
+
+        # Model names follow 4 zero bytes, each name is null terminated and 4 byte aligned
+        offset = self.alignOffset(offset) + 4
+        self.modelNamesOffset = offset
+        for model in self.stage.levelModels:
+            self.levelModelNameOffsets.append(offset)
+            offset = self.alignOffset(offset + len(model.name.encode()) + 1)
+        for model in self.stage.backgroundModels:
+            self.backgroundModelNameOffsets.append(offset)
+            offset = self.alignOffset(offset + len(model.name.encode()) + 1)
+        for model in self.stage.reflectiveObjects:
+            self.reflectiveObjectNameOffsets.append(offset)
+            offset = self.alignOffset(offset + len(model.name.encode()) + 1)
+
+        self.fileSize = offset
+
+    def sectionSizes(self):
+        """Returns the number of bytes each write stage fills in, once the layout is planned"""
+        # Fields sharing another field's data write none of their own
+        owned = [self.ownsCollisionData(field) for field in range(0, self.numberOfCollisionFields)]
+        gridCells = [cells for cells, owns in zip(self.levelModelCollisionGridCells + self.reflectiveObjectCollisionGridCells, owned) if owns]
+        listSizes = [self.alignOffset(2 * (len(cellTriangles) + len(cellCounts))) for cellTriangles, cellCounts in gridCells]
+        numberOfCells = sum(len(cellCounts) for cellTriangles, cellCounts in gridCells)
+        numberOfTriangles = sum(numTriangles for numTriangles, owns in
+                                zip(self.numberOfLevelModelTriangles + self.numberOfReflectiveObjectTriangles, owned) if owns)
+        return {
+            'writeHeader': self.sizeOfHeader,
+            'writeStartPositions': 20 * len(self.stage.startPositions),
+            'writeFalloutPlane': 4,
+            'writeGoals': 20 * self.numberOfGoals,
+            'writeBumpers': 32 * self.numberOfBumpers,
+            'writeJamabars': 32 * self.numberOfJamabars,
+            'writeBananas': 16 * self.numberOfBananas,
+            'writeLevelNameOffsets': 4 * (self.numberOfLevelModels + self.numberOfReflectiveObjects + self.numberOfBackgroundModels),
+            'writeCollisionFields': 196 * self.numberOfCollisionFields,
+            'writeAnimations': sum(sizeOfAnimationHeader for keyframes in self.collisionFieldKeyframes if keyframes is not None)
+                               + sizeOfKeyframe * self.numberOfKeyframes(),
+            'writeCollisionTriangles': 64 * numberOfTriangles,
+            'writeCollisionGridTriangleList': sum(listSizes) if self.gridCellListPool is None else self.alignOffset(len(self.gridCellListPool)),
+            'writeCollisionGridTrianglePointers': 4 * numberOfCells,
+            'writeLevelModels': 12 * self.numberOfLevelModels,
+            'writeReflectiveModels': 8 * self.numberOfReflectiveObjects,
+            'writeBackgroundModels': 56 * self.numberOfBackgroundModels,
+            'writeobjectNames': self.fileSize - self.modelNamesOffset,
+            }
+
+
+    def writeStartPositions(self, buffer):
+        """Writes the start positions to the file"""
+        """(1 for levels, 1+ for some many games)"""
+
+        # Start positions are always right after the header
+        offset = self.sizeOfHeader
+
+        # Go through start positions and write them in
+        for start in self.stage.startPositions:
+            struct.pack_into('>fffHHH2x', buffer, offset,
+                    start.position[0],                          # (4f) X location
+                    start.position[1],                          # (4f) Y location
+                    start.position[2],                          # (4f) Z Location
+                    self.packAngle(start.rotation[0]),          # (2i) X rotation
+                    self.packAngle(start.rotation[1]),          # (2i) Y rotation
+                    self.packAngle(start.rotation[2]))          # (2i) Z rotation
+            offset += 20
+
+    def writeGoals(self, buffer):
+        """Writes the goals into the lz"""
+        """Every goal is written at once, single goals first and then the goal arrays"""
+
+        goals = np.frombuffer(buffer, dtype=goalDtype, count=self.numberOfGoals, offset=self.goalsOffset)
+        items, arrays = self.stage.goals, self.stage.goalArrays
+        goals['position'] = self.itemColumn(items, arrays, 'position', 'positions', 0.0)    # (12f) X, Y, Z location
+        goals['rotation'] = self.packAngles(self.itemColumn(items, arrays, 'rotation', 'rotations', 0.0))   # (6i) X, Y, Z rotation
+        goals['goalType'] = self.itemTypeCodes(items, arrays, 'goalType', goalTypes, "blue")   # (2i) Goal type
+
+    def writeBumpers(self, buffer):
+        """Writes the bumpers into the LZ"""
+        self.writeScaledItems(buffer, self.bumpersOffset, self.numberOfBumpers, self.stage.bumpers, self.stage.bumperArrays)
+
+    def writeJamabars(self, buffer):
+        """Writes the jamabars into the LZ"""
+        self.writeScaledItems(buffer, self.jamabarOffset, self.numberOfJamabars, self.stage.jamabars, self.stage.jamabarArrays)
+
+    def writeScaledItems(self, buffer, offset, count, items, arrays):
+        """Writes bumpers or jamabars, both share the same layout"""
+        records = np.frombuffer(buffer, dtype=scaledItemDtype, count=count, offset=offset)
+        records['position'] = self.itemColumn(items, arrays, 'position', 'positions', 0.0)  # (12f) X, Y, Z location
+        records['rotation'] = self.packAngles(self.itemColumn(items, arrays, 'rotation', 'rotations', 0.0))  # (6i) X, Y, Z rotation
+        records['scale'] = self.itemColumn(items, arrays, 'scale', 'scales', 1.0)           # (12f) X, Y, Z scale
+
+    def writeBananas(self, buffer):
+        """Write the bananas into the LZ"""
+        bananas = np.frombuffer(buffer, dtype=bananaDtype, count=self.numberOfBananas, offset=self.bananasOffset)
+        items, arrays = self.stage.bananas, self.stage.bananaArrays
+        bananas['position'] = self.itemColumn(items, arrays, 'position', 'positions', 0.0)  # (12f) X, Y, Z location
+        bananas['bananaType'] = self.itemTypeCodes(items, arrays, 'bananaType', bananaTypes, "single")     # (4i) Banana Type
+
+    def itemColumn(self, items, arrays, attribute, arrayAttribute, default):
+        """Returns an (N, 3) array of one attribute of the single items followed by the item arrays"""
+        columns = [np.array([getattr(item, attribute) for item in items], dtype=np.float64).reshape(-1, 3)]
+        for array in arrays:
+            values = getattr(array, arrayAttribute)
+            columns.append(np.full((len(array), 3), default) if values is None else values)
+        return np.concatenate(columns)
+
+    def itemTypeCodes(self, items, arrays, attribute, codes, default):
+        """Returns the goal or banana type code of the single items followed by the item arrays"""
+        singles = [codes[getattr(item, attribute)] for item in items]
+        return np.concatenate([np.array(singles, dtype=np.int64)]
+                              + [np.full(len(array), codes[array.itemType or default], dtype=np.int64) for array in arrays])
+
+    def writeLevelNameOffsets(self, buffer):
+        # Go through every standard level model and write the pointer to its name
+        for i in range(0, len(self.levelModelNameOffsets)):
+            struct.pack_into('>I', buffer, self.levelModelNamePointerOffsets[i], self.levelModelNameOffsets[i])               # (4i) Offset to model name ascii
+
+        # Go through every reflective level model and write the pointer to its name
+        for i in range(0, len(self.reflectiveObjectNameOffsets)):
+            struct.pack_into('>I', buffer, self.reflectiveObjectNamePointerOffsets[i], self.reflectiveObjectNameOffsets[i])   # (4i) Offset to model name ascii
+
+        # Go through every background level model and write the pointer to its name
+        for i in range(0, len(self.backgroundModelNameOffsets)):
+            struct.pack_into('>I', buffer, self.backgroundModelNamePointerOffsets[i], self.backgroundModelNameOffsets[i])     # (4i) Offset to model name ascii
+
+    def writeLevelModels(self, buffer):
+        """Write the level model headers into the file"""
+
+        offset = self.levelModelsOffset
+        # Go through every standard level model and write its header
+        for i in range(0, len(self.levelModelNameOffsets)):
+            struct.pack_into('>III', buffer, offset,
+                    1,                                          # (4i) One
+                    self.levelModelNameOffsets[i],              # (4i) Offset to model name ascii
+                    0)                                          # (4i) Zero
+            offset += 12
+
+    def writeReflectiveModels(self, buffer):
+        """Write the reflective model headers into the file"""
+
+        offset = self.reflectiveObjectsOffset
+        # Go through every reflective level model and write its header
+        for i in range(0, len(self.reflectiveObjectNameOffsets)):
+            struct.pack_into('>II', buffer, offset,
+                    self.reflectiveObjectNameOffsets[i],        # (4i) Offset to model name ascii
+                    0)                                          # (4i) Zero
+            offset += 8
+
+    def writeBackgroundModels(self, buffer):
+        """Write the background model headers into the file"""
+
+        offset = self.backgroundModelsOffset
+        # Go through every background level model and write its header
+        for i in range(0, len(self.backgroundModelNameOffsets)):
+            model = self.stage.backgroundModels[i]
+            struct.pack_into('>IIIfffHHH2xfff12x', buffer, offset,
+                    31,                                         # (4i) 0x1F
+                    self.backgroundModelNameOffsets[i],         # (4i) Offset to model name ascii
+                    0,                                          # (4i) Zero
+                    model.position[0],                          # (4f) X location
+                    model.position[1],                          # (4f) Y location
+                    model.position[2],                          # (4f) Z location
+                    self.packAngle(model.rotation[0]),          # (2i) X rotation
+                    self.packAngle(model.rotation[1]),          # (2i) Y rotation
+                    self.packAngle(model.rotation[2]),          # (2i) Z rotation
+                    model.scale[0],                             # (4f) X scale
+                    model.scale[1],                             # (4f) Y scale
+                    model.scale[2])                             # (4f) Z scale
+            offset += 56
+
+    def writeCollisionTriangles(self, buffer):
+        """Write the collision triangles into the LZ"""
+
+        # The triangles are already serialized, copy every standard level model's block to its offset
+        for i in range(0, len(self.stage.levelModels)):
+            if not self.ownsCollisionData(i):
+                continue
+            offset = self.levelModelTriangleOffsets[i]
+            block = self.levelModelTriangleBlocks[i]
+            buffer[offset:offset + len(block)] = block
+
+        # Then every reflective level model's block
+        for i in range(0, len(self.stage.reflectiveObjects)):
+            if not self.ownsCollisionData(self.numberOfLevelModels + i):
+                continue
+            offset = self.reflectiveObjectTriangleOffsets[i]
+            block = self.reflectiveObjectTriangleBlocks[i]
+            buffer[offset:offset + len(block)] = block
+
+    def writeobjectNames(self, buffer):
+        """Write the model names into the file"""
+
+        # Go through every standard level model and write their name in
+        for i in range(0, len(self.stage.levelModels)):
+            self.writeObjectName(buffer, self.levelModelNameOffsets[i], self.stage.levelModels[i])
+
+        # Go through every background level model and write their name in
+        for i in range(0, len(self.stage.backgroundModels)):
+            self.writeObjectName(buffer, self.backgroundModelNameOffsets[i], self.stage.backgroundModels[i])
+
+        # Go through every reflective level model and write their name in
+        for i in range(0, len(self.stage.reflectiveObjects)):
+            self.writeObjectName(buffer, self.reflectiveObjectNameOffsets[i], self.stage.reflectiveObjects[i])
+
+    def writeObjectName(self, buffer, offset, model):
+        """Writes a model name, the buffer already holds its \\0 and alignment padding"""
+        nameBytes = model.name.encode()
+        buffer[offset:offset + len(nameBytes)] = nameBytes      # (ascii) Model name
+
+    def alignOffset(self, offset):
+        """Rounds an offset up to the next multiple of 4"""
+        return (offset + 3) & ~3
+
+    def writeZeroBytes(self, file, numZeros):
+        """Writes a set number of 0 bytes to a file"""
+        file.write(bytes(numZeros))
+
+    def writeHeader(self, buffer):
+        """Writes the SMB LZ Header"""
+        struct.pack_into('>4xIIIIIIII4xIIIIII16xIIII8xIIIIIIII24x', buffer, 0,
+                100,                                # (4i) Unknown/100
+                self.numberOfCollisionFields,       # (4i) Number of collision fields
+                self.collisionFieldsOffset,         # (4i) Offset to to collision fields
+                self.sizeOfHeader,                  # (4i) Size of head/offset to start position (always 0xA0)
+                self.falloutPlaneOffset,            # (4i) Offset to fallout plane Y coordinate
+                self.numberOfGoals,                 # (4i) Number of goals
+                self.goalsOffset,                   # (4i) Offset to goals
+                self.numberOfGoals,                 # (4i) Number of goals
+                self.numberOfBumpers,               # (4i) Number of bumpers
+                self.bumpersOffset,                 # (4i) Offset to bumpers
+                self.numberOfJamabars,              # (4i) Number of jamabars
+                self.jamabarOffset,                 # (4i) Offset to jamabars
+                self.numberOfBananas,               # (4i) Number of bananas
+                self.bananasOffset,                 # (4i) Offset to bananas
+                0,                                  # (4i) Number of something?
+                0,                                  # (4i) Offset to something?
+                self.numberOfLevelModels,           # (4i) Number of level models
+                self.levelModelsOffset,             # (4i) Offset to level models
+                self.numberOfBackgroundModels,      # (4i) Number of background models
+                self.backgroundModelsOffset,        # (4i) Offset to background models
+                0,                                  # (4i) Number of something?
+                0,                                  # (4i) Offset to something
+                0,                                  # (4i) Zero
+                1,                                  # (4i) One
+                self.numberOfReflectiveObjects,     # (4i) Number of reflective objects
+                self.reflectiveObjectsOffset)       # (4i) Offset to reflective objects
+
+    def writeFalloutPlane(self, buffer):
+        struct.pack_into('>f', buffer, self.falloutPlaneOffset, self.stage.falloutPlaneY)     # (4f) Fallout Y coordinate
+
+    def writeTriangles(self, buffer, offset, triangleVertices):
+        """Writes a block of triangles into the LZ"""
+
+        if len(triangleVertices) == 0:
+            return
+
+        if self.scalarTriangleWriter:
+            file = io.BytesIO()
+            for vertices in triangleVertices:
+                vertices = [Vector(vertex) for vertex in vertices]
+                self.writeTriangle(file, vertices[0], vertices[1], vertices[2], vertices[0])
+            buffer[offset:offset + file.tell()] = file.getvalue()
+        else:
+            # Pack straight into the output buffer
+            block = np.frombuffer(buffer, dtype=self.triangleDtype, count=len(triangleVertices), offset=offset)
+            self.packTriangles(triangleVertices, block)
+
+    def manualCollisionGrid(self):
+        """Returns the collision grid set by hand in the operator options"""
+        return CollisionGrid(self.collisionGridStart[0], self.collisionGridStart[1],
+                             self.collisionGridStep[0], self.collisionGridStep[1],
+                             self.collisionGridStepCount[0], self.collisionGridStepCount[1])
+
+    def fitCollisionGrid(self, triangleVertices):
+        """Picks the collision grid for a field from the XZ bounds of its triangles"""
+        """Uses the fewest cells that keep the fullest cell at or under the target triangle count"""
+        """When no grid gets there, uses the fewest cells (up to the manual grid's) that get the fullest cell as low as possible"""
+
+        if not self.autoFitCollisionGrid or len(triangleVertices) == 0:
+            return self.manualCollisionGrid()
+
+        minX = float(triangleVertices[:, :, 0].min())
+        minZ = float(triangleVertices[:, :, 2].min())
+        sizeX = max(float(triangleVertices[:, :, 0].max()) - minX, 0.001)
+        sizeZ = max(float(triangleVertices[:, :, 2].max()) - minZ, 0.001)
+
+        def gridWithCells(cells):
+            # Keep the cells roughly square by splitting the longer axis into `cells` steps
+            if sizeX >= sizeZ:
+                countX, countZ = cells, max(1, min(cells, int(round(cells * sizeZ / sizeX))))
+            else:
+                countX, countZ = max(1, min(cells, int(round(cells * sizeX / sizeZ)))), cells
+            # Round through float32 so cells are binned exactly where the game will look for them
+            return CollisionGrid(float(np.float32(minX)), float(np.float32(minZ)),
+                                 float(np.float32(sizeX / countX)), float(np.float32(sizeZ / countZ)),
+                                 countX, countZ)
+
+        def fullestCell(grid):
+            return int(self.binCollisionTriangles(triangleVertices, grid)[1].max())
+
+        # Finer grids rarely make the fullest cell worse, so binary search for the coarsest grid on target
+        low = 1
+        high = self.collisionGridMaxCells
+        target = self.collisionGridTargetTriangles
+        if fullestCell(gridWithCells(high)) > target:
+            # Stacked or large triangles can't be split up by more cells, and every cell they cover lists them again
+            # Don't go finer than the manual grid then, and only as fine as it takes to get the fullest cell its lowest
+            high = min(high, max(self.collisionGridStepCount))
+            target = fullestCell(gridWithCells(high))
+        while low < high:
+            middle = (low + high) // 2
+            if fullestCell(gridWithCells(middle)) <= target:
+                high = middle
+            else:
+                low = middle + 1
+        return gridWithCells(low)
+
+    def binCollisionTriangles(self, triangleVertices, grid):
+        """Sorts triangles into the collision grid cells their XZ footprint overlaps"""
+        """Returns the triangle indices ordered by cell and the number of triangles in each cell"""
+
+        countX = grid.countX
+        countZ = grid.countZ
+        numTriangles = len(triangleVertices)
+        if numTriangles == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(countX * countZ, dtype=np.int64)
+
+        # Range of cells covered by each triangle's XZ bounding box, clamped to the grid
+        xs = triangleVertices[:, :, 0]
+        zs = triangleVertices[:, :, 2]
+        firstX = np.clip(np.floor((xs.min(axis=1) - grid.startX) / grid.stepX), 0, countX - 1).astype(np.int64)
+        lastX = np.clip(np.floor((xs.max(axis=1) - grid.startX) / grid.stepX), 0, countX - 1).astype(np.int64)
+        firstZ = np.clip(np.floor((zs.min(axis=1) - grid.startZ) / grid.stepZ), 0, countZ - 1).astype(np.int64)
+        lastZ = np.clip(np.floor((zs.max(axis=1) - grid.startZ) / grid.stepZ), 0, countZ - 1).astype(np.int64)
+
+        # Expand every triangle into one entry per covered cell
+        widths = lastX - firstX + 1
+        spans = widths * (lastZ - firstZ + 1)
+        triangles = np.repeat(np.arange(numTriangles), spans)
+        local = np.arange(len(triangles)) - np.repeat(np.cumsum(spans) - spans, spans)
+        cellX = np.repeat(firstX, spans) + local % np.repeat(widths, spans)
+        cellZ = np.repeat(firstZ, spans) + local // np.repeat(widths, spans)
+        cells = cellZ * countX + cellX
+
+        # Group the entries by cell, a stable sort keeps each cell's triangles in ascending order
+        order = np.argsort(cells, kind='stable')
+        return triangles[order], np.bincount(cells, minlength=countX * countZ)
+
+    def writeCollisionGridCells(self, buffer, offset, cellTriangles, cellCounts):
+        """Writes every cell's triangle list followed by its terminator"""
+
+        cellEnds = np.cumsum(cellCounts)
+        cellList = np.insert(cellTriangles, cellEnds, 65535)
+        # (2i) Offsets to collision triangles in list, (2i) Triangle List terminator
+        np.frombuffer(buffer, dtype='>u2', count=len(cellList), offset=offset)[:] = cellList.astype(np.uint16)
+
+    def writeCollisionGridTriangleList(self, buffer):
+        """Writes the list of triangles used for each objects collider"""
+
+        # Shared lists are already laid out in their pool
+        if self.gridCellListPool is not None:
+            offset = self.gridCellListPoolOffset
+            buffer[offset:offset + len(self.gridCellListPool)] = self.gridCellListPool
+            return
+
+        # Go through every standard level model and write its collision grid list
+        for i in range(0, len(self.stage.levelModels)):
+            if not self.ownsCollisionData(i):
+                continue
+            cellTriangles, cellCounts = self.levelModelCollisionGridCells[i]
+            self.writeCollisionGridCells(buffer, self.levelModelCollisionGridPointers[i], cellTriangles, cellCounts)
+
+        # Go through every reflective level model and write its collision grid list
+        for i in range(0, len(self.stage.reflectiveObjects)):
+            if not self.ownsCollisionData(self.numberOfLevelModels + i):
+                continue
+            cellTriangles, cellCounts = self.reflectiveObjectCollisionGridCells[i]
+            self.writeCollisionGridCells(buffer, self.reflectiveObjectCollisionGridPointers[i], cellTriangles, cellCounts)
+
+    def collisionGridCellOffsets(self, listOffset, cellCounts):
+        """Returns the offset of every cell's triangle list"""
+
+        # Each cell takes 2 bytes per triangle plus its 2 byte terminator
+        cellStarts = np.cumsum(cellCounts) - cellCounts
+        return listOffset + 2 * (cellStarts + np.arange(len(cellCounts)))
+
+    def collisionGridCellPointers(self, field):
+        """Returns the offset of each of a field's cell lists, in the pool or in the field's own lists"""
+        if self.gridCellListPool is not None:
+            return self.gridCellListPoolOffset + self.collisionGridCellListOffsets[field]
+        if field < self.numberOfLevelModels:
+            return self.collisionGridCellOffsets(self.levelModelCollisionGridPointers[field],
+                                                 self.levelModelCollisionGridCells[field][1])
+        field -= self.numberOfLevelModels
+        return self.collisionGridCellOffsets(self.reflectiveObjectCollisionGridPointers[field],
+                                             self.reflectiveObjectCollisionGridCells[field][1])
+
+    def writeCollisionGridTrianglePointers(self, buffer):
+        """Writes pointers to the triangle grid list"""
+
+        # Go through every standard level model and write its collision grid list pointer
+        for i in range(0, len(self.stage.levelModels)):
+            if not self.ownsCollisionData(i):
+                continue
+            cellOffsets = self.collisionGridCellPointers(i)
+            # (4i) Offset to each cell's triangle list
+            np.frombuffer(buffer, dtype='>u4', count=len(cellOffsets), offset=self.levelModelCollisionGridPointerPointers[i])[:] = cellOffsets
+
+        # Go through every reflective level model and write its collision grid list
+        for i in range(0, len(self.stage.reflectiveObjects)):
+            if not self.ownsCollisionData(self.numberOfLevelModels + i):
+                continue
+            cellOffsets = self.collisionGridCellPointers(self.numberOfLevelModels + i)
+            # (4i) Offset to each cell's triangle list
+            np.frombuffer(buffer, dtype='>u4', count=len(cellOffsets), offset=self.reflectiveObjectCollisionGridPointerPointers[i])[:] = cellOffsets
+
+    def writeCollisionFields(self, buffer):
+        """Write the collision field headers into the LZ"""
+
+        offset = self.collisionFieldsOffset
+
+        # Go through every standard level model and write its collision header
+        for i in range(0, len(self.stage.levelModels)):
+            grid = self.levelModelCollisionGrids[i]
+            center, rotation = self.fieldPlacement(self.stage.levelModels[i])
+            struct.pack_into('>fffHHH2xIIIIffffII', buffer, offset,
+                    center[0],                                  # (4f) X center for animation
+                    center[1],                                  # (4f) Y center for animation
+                    center[2],                                  # (4f) Z center for animation
+                    self.packAngle(rotation[0]),                # (2i) X rotation for animation
+                    self.packAngle(rotation[1]),                # (2i) Y rotation for animation
+                    self.packAngle(rotation[2]),                # (2i) Z rotation for animation
+                    self.collisionFieldAnimationOffsets[i],     # (4i) Offset to animation frame header
+                    self.levelModelNamePointerOffsets[i],       # (4i) Offset to level model name pointer
+                    self.levelModelTriangleOffsets[i],          # (4i) Offset to triangle colliders
+                    self.levelModelCollisionGridPointerPointers[i],     # (4i) Offset to collision grid list pointers
+                    grid.startX,                                # (4f) Start X value for collision grid
+                    grid.startZ,                                # (4f) Start Z value for collision grid
+                    grid.stepX,                                 # (4f) Step X value for collision grid
+                    grid.stepZ,                                 # (4f) Step Z value for collision grid
+                    grid.countX,                                # (4i) Number of collision grid cells along X
+                    grid.countZ)                                # (4i) Number of collision grid cells along Z
+            self.writePartialHeader(buffer, offset + 60)        # (136)Partial Header
+            offset += 196
+
+        # Go through every reflective level model and write its collision header
+        for i in range(0, len(self.stage.reflectiveObjects)):
+            grid = self.reflectiveObjectCollisionGrids[i]
+            center, rotation = self.fieldPlacement(self.stage.reflectiveObjects[i])
+            struct.pack_into('>fffHHH2xIIIIffffII', buffer, offset,
+                    center[0],                                  # (4f) X center for animation
+                    center[1],                                  # (4f) Y center for animation
+                    center[2],                                  # (4f) Z center for animation
+                    self.packAngle(rotation[0]),                # (2i) X rotation for animation
+                    self.packAngle(rotation[1]),                # (2i) Y rotation for animation
+                    self.packAngle(rotation[2]),                # (2i) Z rotation for animation
+                    self.collisionFieldAnimationOffsets[self.numberOfLevelModels + i],     # (4i) Offset to animation frame header
+                    self.reflectiveObjectNamePointerOffsets[i], # (4i) Offset to level model name pointer
+                    self.reflectiveObjectTriangleOffsets[i],    # (4i) Offset to triangle colliders
+                    self.reflectiveObjectCollisionGridPointerPointers[i],   # (4i) Offset to collision grid list pointers
+                    grid.startX,                                # (4f) Start X value for collision grid
+                    grid.startZ,                                # (4f) Start Z value for collision grid
+                    grid.stepX,                                 # (4f) Step X value for collision grid
+                    grid.stepZ,                                 # (4f) Step Z value for collision grid
+                    grid.countX,                                # (4i) Number of collision grid cells along X
+                    grid.countZ)                                # (4i) Number of collision grid cells along Z
+            self.writePartialHeader(buffer, offset + 60)        # (136)Partial Header
+            offset += 196
+
+    def fieldPlacement(self, model):
+        """Returns the center and starting rotation of a field"""
+        """Every field's triangles are in its object's space, animated or not and shared or not"""
+        return model.position, model.rotation
+
+    def reduceAnimations(self):
+        """Drops the keyframes of every animated field that interpolation between the others reproduces"""
+        for model in self.stage.levelModels + self.stage.reflectiveObjects:
+            if model.animation is None:
+                self.collisionFieldKeyframes.append(None)
+                continue
+            keyframes = []
+            for name in animationChannels:
+                channel = getattr(model.animation, name)
+                if channel is None:
+                    keyframes.append((np.zeros(0), np.zeros(0)))
+                    continue
+                times = np.asarray(channel[0], dtype=np.float64)
+                values = np.asarray(channel[1], dtype=np.float64)
+                # The game animates rotations in degrees
+                if name.startswith("rotation"):
+                    values = self.toDegrees(values)
+                    tolerance = self.animationRotationTolerance
+                else:
+                    tolerance = self.animationPositionTolerance
+                keep = reduceKeyframes(times, values, tolerance)
+                keyframes.append((times[keep], values[keep]))
+                self.numberOfSampledKeyframes += len(times)
+            self.collisionFieldKeyframes.append(keyframes)
+
+    def numberOfKeyframes(self):
+        return sum(len(times) for keyframes in self.collisionFieldKeyframes if keyframes is not None
+                   for times, values in keyframes)
+
+    def writeAnimations(self, buffer):
+        """Writes the animation header and keyframes of every animated field"""
+
+        for i in range(0, self.numberOfCollisionFields):
+            keyframes = self.collisionFieldKeyframes[i]
+            if keyframes is None:
+                continue
+            channelOffsets = self.collisionFieldKeyframeOffsets[i]
+            header = []
+            for (times, values), channelOffset in zip(keyframes, channelOffsets):
+                header += [len(times), channelOffset]
+            # (4i) Keyframe count and (4i) offset to keyframes for X, Y, Z rotation then X, Y, Z position
+            struct.pack_into('>12I16x', buffer, self.collisionFieldAnimationOffsets[i], *header)
+
+            for (times, values), channelOffset in zip(keyframes, channelOffsets):
+                if len(times) == 0:
+                    continue
+                block = np.frombuffer(buffer, dtype=keyframeDtype, count=len(times), offset=channelOffset)
+                block['easing'] = linearEasing                  # (4i) Easing
+                block['time'] = times                           # (4f) Time in seconds
+                block['value'] = values                         # (4f) Value
+                block['tangentIn'] = 0                          # (4f) Incoming tangent
+                block['tangentOut'] = 0                         # (4f) Outgoing tangent
+
+    def writePartialHeader(self, buffer, offset):
+        """Writes the copy of the stage header that ends each collision field"""
+        """Only the level models are filled in, the rest stays zero"""
+        struct.pack_into('>64xII64x', buffer, offset,
+                                                    # (64i)Goals, bumpers, jamabars, bananas and unknowns
+                self.numberOfLevelModels,           # (4i) Number of level models
+                self.levelModelsOffset)             # (4i) Offset to level models
+                                                    # (64i)Background models, reflective objects and unknowns
+
+    def toBigI(self, number):
+        return struct.pack('>I', number)
+
+    def toBigF(self, number):
+        return struct.pack('>f', number)
+
+    def toShortI(self, number):
+        return struct.pack('>H', int(number) & 0xFFFF)
+
+    def cross(self, a, b):
+        return Vector(((a.y * b.z) - (a.z * b.y),
+                      (a.z * b.x) - (a.x * b.z),
+                      (a.x * b.y) - (a.y * b.x)))
+
+    def dot(self, a, b):
+        return (a.x * b.x) + (a.y * b.y) + (a.z + b.z)
+
+    def dotm(self, a, r0, r1, r2):
+        return Vector(((a.x * r0.x) + (a.y * r1.x) + (a.z * r2.x),
+                      (a.x * r0.y) + (a.y * r1.y) + (a.z * r2.y),
+                      (a.x * r0.z) + (a.y * r1.z) + (a.z * r2.z)))
+
+    def normalize(self, v):
+        magnitude = math.sqrt(v.x * v.x + v.y * v.y + v.z * v.z)
+        if magnitude == 0:
+            return Vector((0, 0, 0))
+        return Vector((v.x / magnitude, v.y / magnitude, v.z / magnitude))
+
+    def hat(self, v):
+        return Vector((-v.y, v.x, 0.0))
+
+    def toDegrees(self, theta):
+        return 57.2957795130824*theta
+
+    def cnvAngle(self, theta):
+        return int(65536.0 * theta / 360.0)
+
+    def packAngle(self, radians):
+        """Converts a Blender rotation to the game's 16 bit angle"""
+        return self.cnvAngle(self.toDegrees(radians)) & 0xFFFF
+
+    def packAngles(self, radians):
+        """packAngle() of a whole array at once"""
+        # Same float operations in the same order as packAngle(), so the angles come out identical
+        degrees = 57.2957795130824 * np.asarray(radians, dtype=np.float64)
+        return np.trunc(65536.0 * degrees / 360.0).astype(np.int64) & 0xFFFF
+
+    def reverse_angle(self, c, s):
+        if c > 1.0:
+            c = 1.0
+        elif c < -1.0:
+            c = -1.0
+        if s > 1.0:
+            s = 1.0
+        elif s < -1.0:
+            s = -1.0
+        a = self.toDegrees(math.asin(s))
+        if c < 0:
+            a -= 180.0
+        if abs(c) < abs(s):
+            a = self.toDegrees(math.acos(c))
+            if s < 0.0:
+                a = -a
+        if a < 0.0:
+            if a > -0.001:
+                a = 0.0
+            else:
+                a += 360.0
+        return a
+
+    def writeTriangle(self, file, vertex, vertex2, vertex3, normal):
+        """Writes a triangle into the LZ"""
+        """Mostly duplicated from Yoshimaster's original code"""
+
+        normal = Vector((normal.x, normal.z, normal.y))
+
+        ba = Vector(((vertex2.x - vertex.x, vertex2.y - vertex.y, vertex2.z - vertex.z)))
+        ca = Vector(((vertex3.x - vertex.x, vertex3.y - vertex.y, vertex3.z - vertex.z)))
+
+        normal = self.normalize(self.cross(self.normalize(ba), self.normalize(ca)))
+
+        l = math.sqrt(normal.x * normal.x + normal.z * normal.z)
+
+        if abs(l) < 0.001:
+            cy = 1.0
+            sy = 0.0
+        else:
+            cy = normal.z / l
+            sy = -normal.x / l
+        cx = l
+        sx = normal.y
+
+        Rxr0 = Vector((1.0, 0.0, 0.0))
+        Rxr1 = Vector((0.0, cx, sx))
+        Rxr2 = Vector((0.0, -sx, cx))
+        Ryr0 = Vector((cy, 0.0, -sy))
+        Ryr1 = Vector((0.0, 1.0, 0.0))
+        Ryr2 = Vector((sy, 0.0, cy))
+        dotry = self.dotm(ba, Ryr0, Ryr1, Ryr2)
+        dotrxry = self.dotm(dotry, Rxr0, Rxr1, Rxr2)
+        l = math.sqrt(dotrxry.x * dotrxry.x + dotrxry.y * dotrxry.y)
+        cz = dotrxry.x / l
+        sz = -dotrxry.y / l
+        Rzr0 = Vector((cz, sz, 0.0))
+        Rzr1 = Vector((-sz, cz, 0.0))
+        Rzr2 = Vector((0.0, 0.0, 1.0))
+        dotrz = self.dotm(dotrxry, Rzr0, Rzr1, Rzr2)
+        dotry = self.dotm(ca, Ryr0, Ryr1, Ryr2)
+        dotrzrxry = self.dotm(dotrxry, Rzr0, Rzr1, Rzr2)
+
+        n0v = Vector((dotrzrxry.x - dotrz.x, dotrzrxry.y - dotrz.y, dotrzrxry.z - dotrz.z))
+        n1v = Vector((-dotrzrxry.x, -dotrzrxry.y, -dotrzrxry.z))
+        n0 = self.normalize(self.hat(n0v))
+        n1 = self.normalize(self.hat(n1v))
+
+        rot_x = 360.0 - self.reverse_angle(cx, sx)
+        rot_y = 360.0 - self.reverse_angle(cy, sy)
+        rot_z = 360.0 - self.reverse_angle(cz, sz)
+
+        file.write(self.toBigF(vertex.x))              # (4f) X1 position
+        file.write(self.toBigF(vertex.y))              # (4f) Y1 position
+        file.write(self.toBigF(vertex.z))              # (4f) Z1 position
+        file.write(self.toBigF(normal.x))              # (4f) X normal
+        file.write(self.toBigF(normal.y))              # (4f) Y normal
+        file.write(self.toBigF(normal.z))              # (4f) Z normal
+        file.write(self.toShortI(self.cnvAngle(rot_x))) # (2i) X rotation from XY plane
+        file.write(self.toShortI(self.cnvAngle(rot_y))) # (2i) Y rotation from XY plane
+        file.write(self.toShortI(self.cnvAngle(rot_z))) # (2i) Z rotation from XY plane
+        self.writeZeroBytes(file, 2)                    # (2i) Zero
+        file.write(self.toBigF(dotrz.x))               # (4f) DX2X1
+        file.write(self.toBigF(dotrz.y))               # (4f) DY2Y1
+        file.write(self.toBigF(dotrzrxry.x))           # (4f) DX3X1
+        file.write(self.toBigF(dotrzrxry.y))           # (4f) DY3Y1
+        file.write(self.toBigF(n0.x))                  # (4f) Tangent X
+        file.write(self.toBigF(n0.y))                  # (4f) Tangent Y
+        file.write(self.toBigF(n1.x))                  # (4f) Bitangent X
+        file.write(self.toBigF(n1.y))                  # (4f) Bitangent Y
+
+    def packTriangles(self, triangleVertices, block=None):
+        """Serializes a whole (N, 3, 3) array of triangles at once into a triangleDtype array"""
+        """Matches writeTriangle byte for byte, including mathutils' float32 storage of every Vector"""
+
+        def f32(values):
+            # mathutils.Vector keeps its components as 32 bit floats
+            return values.astype(np.float32).astype(np.float64)
+
+        def normalize(v):
+            magnitude = np.sqrt(v[:, 0] * v[:, 0] + v[:, 1] * v[:, 1] + v[:, 2] * v[:, 2])[:, None]
+            return np.where(magnitude == 0, 0.0, f32(v / np.where(magnitude == 0, 1.0, magnitude)))
+
+        def dotm(a, r0, r1, r2):
+            return f32(np.stack((a[:, 0] * r0[:, 0] + a[:, 1] * r1[:, 0] + a[:, 2] * r2[:, 0],
+                                 a[:, 0] * r0[:, 1] + a[:, 1] * r1[:, 1] + a[:, 2] * r2[:, 1],
+                                 a[:, 0] * r0[:, 2] + a[:, 1] * r1[:, 2] + a[:, 2] * r2[:, 2]), axis=1))
+
+        def rows(x, y, z):
+            return f32(np.stack(np.broadcast_arrays(x, y, z), axis=1).astype(np.float64))
+
+        def reverseAngle(c, s):
+            c = np.clip(c, -1.0, 1.0)
+            s = np.clip(s, -1.0, 1.0)
+            a = self.toDegrees(np.arcsin(s))
+            a = np.where(c < 0, a - 180.0, a)
+            a = np.where(np.abs(c) < np.abs(s), np.where(s < 0.0, -self.toDegrees(np.arccos(c)), self.toDegrees(np.arccos(c))), a)
+            return np.where(a < 0.0, np.where(a > -0.001, 0.0, a + 360.0), a)
+
+        def cnvAngles(theta):
+            angles = np.trunc(65536.0 * theta / 360.0)
+            return np.where(np.isfinite(angles), angles, 0).astype(np.int64) & 0xFFFF
+
+        numTriangles = len(triangleVertices)
+        vertices = f32(triangleVertices)
+        zeros = np.zeros(numTriangles)
+        ones = np.ones(numTriangles)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ba = f32(vertices[:, 1] - vertices[:, 0])
+            ca = f32(vertices[:, 2] - vertices[:, 0])
+            na = normalize(ba)
+            nc = normalize(ca)
+            normal = normalize(f32(np.stack((na[:, 1] * nc[:, 2] - na[:, 2] * nc[:, 1],
+                                             na[:, 2] * nc[:, 0] - na[:, 0] * nc[:, 2],
+                                             na[:, 0] * nc[:, 1] - na[:, 1] * nc[:, 0]), axis=1)))
+
+            l = np.sqrt(normal[:, 0] * normal[:, 0] + normal[:, 2] * normal[:, 2])
+            flat = np.abs(l) < 0.001
+            cy = np.where(flat, 1.0, normal[:, 2] / l)
+            sy = np.where(flat, 0.0, -normal[:, 0] / l)
+            cx = l
+            sx = normal[:, 1]
+
+            dotry = dotm(ba, rows(cy, zeros, -sy), rows(zeros, ones, zeros), rows(sy, zeros, cy))
+            dotrxry = dotm(dotry, rows(ones, zeros, zeros), rows(zeros, cx, sx), rows(zeros, -sx, cx))
+            l = np.sqrt(dotrxry[:, 0] * dotrxry[:, 0] + dotrxry[:, 1] * dotrxry[:, 1])
+            cz = dotrxry[:, 0] / l
+            sz = -dotrxry[:, 1] / l
+            dotrz = dotm(dotrxry, rows(cz, sz, zeros), rows(-sz, cz, zeros), rows(zeros, zeros, ones))
+            dotrzrxry = dotrz
+
+            # writeTriangle's tangent comes from dotrzrxry - dotrz, which is always the zero vector
+            n0 = np.zeros((numTriangles, 3))
+            n1 = normalize(np.stack((dotrzrxry[:, 1], -dotrzrxry[:, 0], zeros), axis=1))
+
+            rotX = cnvAngles(360.0 - reverseAngle(cx, sx))
+            rotY = cnvAngles(360.0 - reverseAngle(cy, sy))
+            rotZ = cnvAngles(360.0 - reverseAngle(cz, sz))
+
+        if block is None:
+            block = np.zeros(numTriangles, dtype=self.triangleDtype)
+        block['position'] = vertices[:, 0]                          # (4f) X1, Y1, Z1 position
+        block['normal'] = normal                                    # (4f) X, Y, Z normal
+        block['rotation'] = np.stack((rotX, rotY, rotZ), axis=1)    # (2i) X, Y, Z rotation from XY plane
+        block['padding'] = 0                                        # (2i) Zero
+        block['dx2x1'] = dotrz[:, 0]                                # (4f) DX2X1
+        block['dy2y1'] = dotrz[:, 1]                                # (4f) DY2Y1
+        block['dx3x1'] = dotrzrxry[:, 0]                            # (4f) DX3X1
+        block['dy3y1'] = dotrzrxry[:, 1]                            # (4f) DY3Y1
+        block['tangent'] = n0[:, :2]                                # (4f) Tangent X, Y
+        block['bitangent'] = n1[:, :2]                              # (4f) Bitangent X, Y
+        return block
@@ -4,20 +4,149 @@ bl_info = {
     "description": "Exports to the SMB LZ format",
     "version": (0, 0, 1)}
 import os    
+import sys
+import time
 import bpy
-import mathutils
-import bpy_extras.io_utils
-import struct
-from array import array
-import math
+import numpy as np
 
 from bpy.props import (
         BoolProperty,
         FloatProperty,
+        IntProperty,
+        FloatVectorProperty,
+        IntVectorProperty,
         StringProperty,
         EnumProperty,
         )
 
+# SMB_LZ_Core.py and the other SMB_LZ_*.py modules sit next to this addon
+addonDirectory = os.path.dirname(os.path.abspath(__file__))
+if addonDirectory not in sys.path:
+    sys.path.append(addonDirectory)
+import SMB_LZ_Core
+
+# Seconds of export work between UI updates while exporting modally
+modalTimeSlice = 0.05
+
+# A level model's collision proxy is named after it with one of these suffixes, or named in its collisionProxy property
+collisionProxySuffixes = ["_collision", ".collision"]
+collisionProxyProperty = "collisionProxy"
+
+# What an object is exported as: its smbType property, else its collection's, else the first keyword in its name
+objectTypeProperty = "smbType"
+objectTypeKeywords = ["start", "goal", "bumper", "jamabar", "banana", "background", "reflective"]
+objectTypes = objectTypeKeywords + ["level", "ignore"]
+
+# Cameras, lights and the like are never exported, only objects of these types are
+exportableObjectTypes = {'MESH', 'CURVE', 'SURFACE', 'FONT', 'META', 'EMPTY'}
+# Empties have no geometry, so they can only stand for items (they're usually helpers or parents otherwise)
+itemObjectTypes = {"start", "goal", "bumper", "jamabar", "banana"}
+# Objects of these types can place many items from particles or instances (see itemArray())
+emitterObjectTypes = {"goal", "bumper", "jamabar", "banana"}
+
+class LiveExport(object):
+    """Exports the stage again a moment after the scene stops changing, until it's stopped"""
+    """Evaluated meshes and serialized collision fields are kept between exports, so only changed objects cost anything"""
+
+    def __init__(self, settings, delay, cacheBytes):
+        import SMB_LZ_Cache
+        self.settings = settings                        # Operator options of every export
+        self.delay = delay                              # Seconds without changes before exporting
+        self.meshBuffers = {}                           # Evaluated mesh buffers, dropped when their object's geometry changes
+        self.exportCache = SMB_LZ_Cache.MemoryCache(cacheBytes)
+        self.lastChange = None                          # Time of the latest change that hasn't been exported yet
+        self.exporting = False
+        self.timerRunning = False
+        self.exports = 0
+        # Timers are matched by identity and every self.onTimer is a new bound method, so keep one
+        self.timerCallback = self.onTimer
+
+    def start(self):
+        if hasattr(bpy.app, "timers"):
+            bpy.app.handlers.depsgraph_update_post.append(self.onDepsgraphUpdate)
+        else:
+            # 2.7x has no timers, scene_update_post runs all the time and does the waiting as well
+            bpy.app.handlers.scene_update_post.append(self.onSceneUpdate)
+
+    def stop(self):
+        for handlers in [getattr(bpy.app.handlers, "depsgraph_update_post", []), bpy.app.handlers.scene_update_post
+                         if hasattr(bpy.app.handlers, "scene_update_post") else []]:
+            for handler in list(handlers):
+                if getattr(handler, "__self__", None) is self:
+                    handlers.remove(handler)
+        if self.timerRunning and bpy.app.timers.is_registered(self.timerCallback):
+            bpy.app.timers.unregister(self.timerCallback)
+        self.timerRunning = False
+
+    def changed(self, obj, geometry):
+        """Notes a change, a geometry change also drops the object's evaluated mesh"""
+        if geometry:
+            self.meshBuffers.pop(("object", obj.name), None)
+            if obj.data is not None:
+                self.meshBuffers.pop(("mesh", obj.data.name), None)
+        self.lastChange = time.time()
+
+    def onDepsgraphUpdate(self, scene, depsgraph=None):
+        if self.exporting:
+            return
+        if depsgraph is None:
+            depsgraph = bpy.context.evaluated_depsgraph_get()
+        for update in depsgraph.updates:
+            # Selection and UI updates change neither, only geometry and transforms get exported
+            if not (update.is_updated_geometry or update.is_updated_transform):
+                continue
+            if isinstance(update.id, bpy.types.Object):
+                self.changed(update.id.original, update.is_updated_geometry)
+            elif isinstance(update.id, (bpy.types.Mesh, bpy.types.Collection)):
+                if isinstance(update.id, bpy.types.Mesh):
+                    self.meshBuffers.pop(("mesh", update.id.original.name), None)
+                self.lastChange = time.time()
+        if self.lastChange is not None and not self.timerRunning:
+            self.timerRunning = True
+            bpy.app.timers.register(self.timerCallback, first_interval=self.delay)
+
+    def onTimer(self):
+        # Keep waiting while the scene is still changing
+        remaining = self.lastChange + self.delay - time.time()
+        if remaining > 0:
+            return remaining
+        self.timerRunning = False
+        self.export()
+        return None
+
+    def onSceneUpdate(self, scene):
+        if self.exporting:
+            return
+        if bpy.data.objects.is_updated:
+            for obj in scene.objects:
+                if obj.is_updated or obj.is_updated_data:
+                    self.changed(obj, obj.is_updated_data)
+        if self.lastChange is not None and time.time() - self.lastChange >= self.delay:
+            self.export()
+
+    def export(self):
+        self.lastChange = None
+        self.exporting = True
+        try:
+            bpy.ops.export_smb.lz('EXEC_DEFAULT', liveUpdate=True, **self.settings)
+            self.exports += 1
+        except Exception as error:
+            # Keep watching, the next change may well fix it
+            print("Live SMB LZ export failed: %s" % error)
+        finally:
+            self.exporting = False
+
+
+liveExport = None                                       # The running LiveExport, if any
+
+
+def stopLiveExport():
+    global liveExport
+    if liveExport is not None:
+        liveExport.stop()
+        liveExport = None
+
+
 class SMBLZExporter(bpy.types.Operator):
     """Export to an SMB LZ File"""      # blender will use this as a tooltip for menu items and buttons.
     bl_idname = "export_smb.lz"        # unique identifier for buttons and menu items to reference.
@@ -28,897 +157,928 @@ class SMBLZExporter(bpy.types.Operator):
     filepath = bpy.props.StringProperty(subtype='FILE_PATH')
     
     startPositionObjects = []                           # list of start position objects
-    numberOfCollisionFields = 0;                        # Number of collision fields/headers
-    collisionFieldsOffset = 0                           # Offset to collision fields/headers
-    sizeOfHeader = 160                                  # Size of file header (always 0xA0 (160)
-
-    falloutPlaneOffset = 0                              # Offset to fallout plane value
-    falloutPlaneY = -32                                   # Fallout plane value
-    numberOfGoals = 0                                   # Number of goals
-    goalsOffset = 0                                     # Offset to goals
     goalObjects = []                                    # List of goal objects
-    numberOfBumpers = 0                                 # Number of bumpers
-    bumpersOffset = 0                                   # Offset to bumpers
     bumperObjects = []                                  # List of bumper objects
-    numberOfJamabars = 0                                # Number of jamabars
-    jamabarOffset = 0                                   # Offset to jamabars
     jamabarObjects = []                                 # List of jamabar objects
-    numberOfBananas = 0                                 # Number of bananas
-    bananasOffset = 0                                   # Offset to bananas
     bananaObjects = []                                  # List of banana objects
-    numberOfLevelModels = 0                             # Number of level models
-    levelModelsOffset = 0                               # Offset to level models
     levelModelObjects = []                              # List of level model objects
-    levelModelNameOffsets = []                          # List of offsets to level model name asciis
-    levelModelNamePointerOffsets = []                   # List of offsets to the level model name ascii offsets
-    levelModelAnimationFrameOffsets = []                # List of animation frame offsets
-    levelModelTriangleOffsets = []                      # List of triangle collider offsets
-    levelModelCollisionGridPointers = []                # List of collision grid pointer offsets
-    numberOfLevelModelTriangles = []                    # List of the number of level model triangles
-    levelModelCollisionGridPointerPointers = []         # List of pointer offsets to the collision grid pointer
-    numberOfBackgroundModels = 0                        # Number of background models
-    backgroundModelsOffset = 0                          # Offset to background models
     backgroundModelObjects = []                         # List of background model offsets
-    backgroundModelNameOffsets = []                     # List of offsets to model name asciis
-    backgroundModelNamePointerOffsets = []              # List of offsets to model name ascii offsets
-    backgroundModelCollisionGridPointerPointers = []    # List of pointer offsets to the collision grid pointers
-    numberOfReflectiveObjects = 0                       # Number of Reflective objects
-    reflectiveObjectsOffset = 0                         # Offset to reflective objects
     reflectiveObjects = []                              # List of reflective objects
-    reflectiveObjectNameOffsets = []                    # List of offsets to model name asciis
-    reflectiveObjectNamePointerOffsets = []             # List of offsets to the model name ascii offsets
-    reflectiveObjectAnimationFrameOffsets = []          # List of animation frame offsets
-    reflectiveObjectTriangleOffsets = []                # List of triangle collider offsets
-    reflectiveObjectCollisionGridPointers = []          # List of collision grid pointer offsets
-    numberOfReflectiveObjectTriangles = []              # List of the number of model triangles
-    reflectiveObjectCollisionGridPointerPointers = []   # List of pointer offsets to the collision grid pointers
-    modelNamesOffset = 0                                # Offset to model names
-    offsetToModelNamePointers = 0
+    collisionProxies = {}                               # Collision proxy objects by the name of the model they stand in for
+    collectionTypes = {}                                # Object type (or None) of each collection/group seen so far
+    evaluatedTriangleCache = {}                         # Vertex and triangle buffers of already evaluated meshes/objects
+    instanceMatrixCache = None                          # World matrices of the scene's instances by instancer name
+    instanceSourceCache = None                          # Names of the objects the scene's instances are copies of by instancer name
+    exportCache = None                                  # Persistent cache of per object collision data
+    telemetry = None                                    # Stage timings of the last export, kept after it finishes
+    analysis = None                                     # StageAnalysis of the last dry run
+    steps = None                                        # The export's remaining steps while it runs modally
+    timer = None                                        # Timer driving a modal export
+    timerDuration = 0.0                                 # The timer's duration when it last fired
     
     filename_ext = ".lz.raw"
     filter_glob = StringProperty(
             default="*.lz.raw",
             options={'HIDDEN'},
             )
+    
+    exportSelectedOnly = BoolProperty(
+            name="Selected Only",
+            description="Only export selected objects",
+            default=False,
+            )
+    exportVisibleOnly = BoolProperty(
+            name="Visible Only",
+            description="Only export objects that are visible in the viewport and enabled for rendering",
+            default=False,
+            )
+    exportCollections = StringProperty(
+            name="Collections",
+            description="Only export objects in these collections (groups before 2.80), comma separated, empty exports all",
+            default="",
+            )
+    autoFitCollisionGrid = BoolProperty(
+            name="Auto-fit Collision Grid",
+            description="Fit each collision field's grid to its triangles instead of using the manual grid below",
+            default=True,
+            )
+    collisionGridTargetTriangles = IntProperty(
+            name="Target Triangles Per Cell",
+            description="Auto-fit uses the coarsest grid whose fullest cell holds at most this many triangles",
+            default=16,
+            min=1,
+            )
+    collisionGridMaxCells = IntProperty(
+            name="Max Grid Cells Per Axis",
+            description="Upper bound on the auto-fitted number of grid cells along X and Z",
+            default=64,
+            min=1,
+            max=256,
+            )
+    collisionGridStart = FloatVectorProperty(
+            name="Grid Start",
+            description="Manual X and Z start of the collision grid",
+            size=2,
+            default=(-256.0, -256.0),
+            )
+    collisionGridStep = FloatVectorProperty(
+            name="Grid Step",
+            description="Manual X and Z size of a collision grid cell",
+            size=2,
+            default=(32.0, 32.0),
+            min=0.001,
+            )
+    collisionGridStepCount = IntVectorProperty(
+            name="Grid Cells",
+            description="Manual number of collision grid cells along X and Z",
+            size=2,
+            default=(16, 16),
+            min=1,
+            )
+    cleanCollision = BoolProperty(
+            name="Clean Up Collision",
+            description="Weld close vertices and drop zero area, sliver and duplicate collision triangles",
+            default=True,
+            )
+    collisionWeldDistance = FloatProperty(
+            name="Weld Distance",
+            description="Vertices within this distance (on a grid of this size) are welded, triangles thinner than this are dropped",
+            default=0.0001,
+            min=0.0,
+            precision=5,
+            )
+    decimateCollision = BoolProperty(
+            name="Decimate Collision",
+            description="Decimate the collision of models that have no collision proxy object",
+            default=False,
+            )
+    collisionDecimateRatio = FloatProperty(
+            name="Decimate Ratio",
+            description="Fraction of its triangles a decimated model's collision keeps",
+            default=0.5,
+            min=0.01,
+            max=1.0,
+            subtype='FACTOR',
+            )
+    exportAnimation = BoolProperty(
+            name="Export Animation",
+            description="Animate the collision fields of models with location or rotation keyframes",
+            default=True,
+            )
+    animationPositionTolerance = FloatProperty(
+            name="Position Tolerance",
+            description="Keyframes are dropped while the animation stays within this distance of them",
+            default=0.01,
+            min=0.0,
+            )
+    animationRotationTolerance = FloatProperty(
+            name="Rotation Tolerance",
+            description="Keyframes are dropped while the animation stays within this many degrees of them",
+            default=0.1,
+            min=0.0,
+            )
+    scalarTriangleWriter = BoolProperty(
+            name="Scalar Triangle Writer",
+            description="Write triangles one at a time with the slow reference writer",
+            default=False,
+            options={'HIDDEN'},
+            )
+    shareCollisionData = BoolProperty(
+            name="Share Linked Duplicates",
+            description="Write the collision triangles and grid of objects sharing one mesh once, each field header places its object",
+            default=True,
+            )
+    shareGridCellLists = BoolProperty(
+            name="Share Grid Cell Lists",
+            description="Write each distinct collision grid cell list once and point every cell with the same triangles at it",
+            default=True,
+            )
+    reorderCollisionTriangles = BoolProperty(
+            name="Reorder Triangles",
+            description="Sort each collision field's triangles so neighbouring triangles are stored together (Morton order over XZ)",
+            default=False,
+            )
+    workerProcesses = IntProperty(
+            name="Worker Processes",
+            description="Serialize collision fields in this many processes at once (1 serializes them in Blender)",
+            default=1,
+            min=1,
+            max=64,
+            )
+    compressionLevel = EnumProperty(
+            name="Compression",
+            description="Compress the stage into a game ready .lz instead of writing an .lz.raw",
+            items=(('NONE', "None", "Write the uncompressed .lz.raw"),
+                   ('FAST', "Fast", "Compress quickly with a short match search"),
+                   ('NORMAL', "Normal", "Balance compression speed and size"),
+                   ('BEST', "Best", "Search hardest for the smallest file")),
+            default='NONE',
+            )
+    verifyCompression = BoolProperty(
+            name="Verify Compression",
+            description="Decompress the compressed stage again and check it matches",
+            default=False,
+            )
+    writePatch = BoolProperty(
+            name="Write Patch",
+            description="Write a delta from the previous export of this file to the new one, apply it with SMB_LZ_Patch.py",
+            default=False,
+            )
+    useExportCache = BoolProperty(
+            name="Reuse Unchanged Objects",
+            description="Cache each object's collision data next to the output and reuse it while the object is unchanged",
+            default=False,
+            )
+    exportCacheSize = IntProperty(
+            name="Cache Size (MB)",
+            description="Least recently used cache entries are removed past this size",
+            default=256,
+            min=1,
+            )
+    reportTelemetry = BoolProperty(
+            name="Report Export Stages",
+            description="Report how long each export stage took and how many bytes it wrote",
+            default=True,
+            )
+    traceMemory = BoolProperty(
+            name="Trace Memory",
+            description="Record the peak memory of each export stage (slows the export down)",
+            default=False,
+            )
+    writeTelemetry = BoolProperty(
+            name="Write Telemetry",
+            description="Write the stage timings, sizes and counts as JSON next to the output",
+            default=False,
+            )
+    profileExport = BoolProperty(
+            name="Profile Export",
+            description="Run the export under cProfile and save the stats next to the output",
+            default=False,
+            )
+    liveExport = BoolProperty(
+            name="Live Export",
+            description="Keep exporting to this file whenever the scene changes, export again with this off to stop",
+            default=False,
+            )
+    liveExportDelay = FloatProperty(
+            name="Live Export Delay",
+            description="Seconds the scene has to stay unchanged before it's exported again",
+            default=0.25,
+            min=0.0,
+            )
+    liveUpdate = BoolProperty(
+            default=False,
+            options={'HIDDEN', 'SKIP_SAVE'},
+            )
+    modalExport = BoolProperty(
+            default=False,
+            options={'HIDDEN', 'SKIP_SAVE'},
+            )
+    dryRun = BoolProperty(
+            name="Dry Run",
+            description="Only analyze the stage: report its projected size and save each collision field's triangles per grid cell next to the output, without writing the stage",
+            default=False,
+            )
 
 
     def execute(self, context):        # execute() is called by blender when running the operator.
         """Called when the addon is run after selecting a save file"""
         self.clearData()
-        
+        if self.liveUpdate and liveExport is not None:
+            # Reuse the evaluated meshes of objects that haven't changed since the last live export
+            self.evaluatedTriangleCache = liveExport.meshBuffers
+        elif not self.dryRun:
+            # A normal export replaces any running live export
+            stopLiveExport()
+            
         scene = context.scene
-        # Go through each object in the scene and put it into its related list
-        for obj in scene.objects:
-            lowerName = obj.name.lower()
-            if "start" in lowerName:
-                self.startPositionObjects.append(obj)
-            elif "goal" in lowerName:
-                self.goalObjects.append(obj)
-            elif "bumper" in lowerName:
-                self.bumperObjects.append(obj)
-            elif "jamabar" in lowerName:
-                self.jamabarObjects.append(obj)
-            elif "banana" in lowerName:
-                self.bananaObjects.append(obj)
-            elif "background" in lowerName:
-                self.backgroundModelObjects.append(obj)
-            elif "reflective" in lowerName:
-                self.reflectiveObjects.append(obj)
-            else:
-                self.levelModelObjects.append(obj)
+        # Collision proxies only stand in for other objects, they aren't exported themselves
+        # (they're usually hidden, so they're looked up among all of the scene's objects)
+        self.collisionProxies = self.findCollisionProxies(scene.objects)
+        proxyNames = set(proxy.name for proxy in self.collisionProxies.values())
+        objects = self.scopedObjects(context)
+        # The objects item emitters make copies of are only there to be copied
+        instancedNames = self.findInstancedObjects(objects, context)
+        
+        objectLists = {
+            "start": self.startPositionObjects,
+            "goal": self.goalObjects,
+            "bumper": self.bumperObjects,
+            "jamabar": self.jamabarObjects,
+            "banana": self.bananaObjects,
+            "background": self.backgroundModelObjects,
+            "reflective": self.reflectiveObjects,
+            "level": self.levelModelObjects,
+            }
+        
+        # Go through each object in the export scope and put it into its related list
+        for obj in objects:
+            if obj.name in proxyNames or obj.name in instancedNames:
+                continue
+            objectType = self.objectType(obj)
+            if obj.type == 'EMPTY' and objectType not in itemObjectTypes:
+                continue
+            if objectType in objectLists:
+                objectLists[objectType].append(obj)
+                
+        profiler = None
+        if self.profileExport:
+            import cProfile
+            profiler = cProfile.Profile()
+        self.telemetry = SMB_LZ_Core.ExportTelemetry(self.traceMemory, profiler)
+        
+        # Begin writing the LZ file (or just lay it out)
+        self.telemetry.start()
+        try:
+            # The context is only valid during execute(), so the scene is always read right away
+            stage = self.telemetry.run("extractStage", 0, self.extractStage, context)
+            # From the file browser the rest runs a slice at a time so Blender stays usable
+            if self.modalExport and context.window is not None and not bpy.app.background:
+                return self.startModal(context, stage)
+            SMB_LZ_Core.runToEnd(self.exportSteps(stage))
+        finally:
+            if self.steps is None:
+                # A modal export keeps timing until its last step
+                self.telemetry.stop()
+        return self.finishExport()
+        
+    def finishExport(self):
+        """Reports how the export went once it's done"""
+        profiler = self.telemetry.profiler
+        if self.dryRun:
+            analysis = self.analysis
+            self.report({'INFO'}, analysis.summary())
+            self.report({'INFO'}, "Saved the collision analysis to %s" % self.telemetry.output)
+            if analysis.overflowingFields:
+                self.report({'WARNING'}, "%d collision fields have more than %d triangles" % (
+                        len(analysis.overflowingFields), SMB_LZ_Core.maxCollisionTriangles))
+            self.clearData()
+            return {'FINISHED'}
             
-        # Get the length of each list for the file header
-        self.numberOfGoals = len(self.goalObjects)
-        self.numberOfBumpers = len(self.bumperObjects)
-        self.numberOfJamabars = len(self.jamabarObjects)
-        self.numberOfBananas = len(self.bananaObjects)
-        self.numberOfLevelModels = len(self.levelModelObjects)
-        self.numberOfBackgroundModels = len(self.backgroundModelObjects)
-        self.numberOfReflectiveObjects = len(self.reflectiveObjects)
-        # Begin writing the LZ file
-        self.writeLZ(context)
+        if self.exportCache is not None:
+            self.report({'INFO'}, "Reused %d of %d collision fields from the export cache" % (
+                    self.exportCache.hits, self.exportCache.hits + self.exportCache.misses))
+        counts = self.telemetry.counts
+        if counts.get('weldedVertices') or counts.get('degenerateTriangles') or counts.get('duplicateTriangles'):
+            self.report({'INFO'}, "Collision cleanup welded %d vertices and removed %d degenerate and %d duplicate triangles" % (
+                    counts['weldedVertices'], counts['degenerateTriangles'], counts['duplicateTriangles']))
+        if counts.get('decimatedTriangles'):
+            self.report({'INFO'}, "Collision decimation removed %d triangles" % counts['decimatedTriangles'])
+        if counts.get('overflowingFields'):
+            self.report({'WARNING'}, "%d collision fields have more than %d triangles, the rest can't be collided with (Dry Run lists them)" % (
+                    counts['overflowingFields'], SMB_LZ_Core.maxCollisionTriangles))
+        if counts.get('crowdedFields'):
+            self.report({'WARNING'}, "%d collision fields have grid cells with more than %d triangles at any grid size, they use the coarsest grid that does as well as the finest" % (
+                    counts['crowdedFields'], self.collisionGridTargetTriangles))
+        if counts.get('sharedCollisionFields'):
+            self.report({'INFO'}, "%d linked duplicates share another field's collision data" % counts['sharedCollisionFields'])
+        if self.writePatch:
+            if 'patchBytes' in counts:
+                self.report({'INFO'}, "Wrote a %d byte patch from the previous export to %s.patch" % (
+                        counts['patchBytes'], self.telemetry.output))
+            else:
+                self.report({'INFO'}, "No previous export to write a patch from, the next export will write one")
+        if self.reportTelemetry:
+            self.report({'INFO'}, self.telemetry.summary())
+        if self.writeTelemetry:
+            self.telemetry.writeJSON(self.telemetry.output + ".telemetry.json")
+        if profiler is not None:
+            profiler.dump_stats(self.telemetry.output + ".prof")
+        if self.liveExport and not self.liveUpdate:
+            self.startLiveExport()
         self.clearData()
         return {'FINISHED'}            # this lets blender know the operator finished successfully.
         
     def invoke(self, context, event):
+        self.modalExport = True
         context.window_manager.fileselect_add(self)
         return {'RUNNING_MODAL'}
         
-    def writeLZ(self, context):
-        """Save an SMB LZ File"""
-        with open(self.filepath, 'wb') as file:
-            # Written in semi-reverse order so that all needed offsets are known by each method
-            self.writeStartPositions(file)
-            
-            self.writeFalloutPlane(file)
-            
-            self.writeGoals(file)
-            self.writeBumpers(file)
-            self.writeJamabars(file)
-            self.writeBananas(file)
-            
-            self.levelModelNameSpacer(file)
-
-            
-            self.collisionFieldSpacer(file)
-            
-            self.writeCollisionTriangles(file, context)
-            self.writeCollisionGridTriangleList(file)
-            self.writeCollisionGridTrianglePointers(file)
-            
-            self.levelModelsSpacer(file)
-            self.reflectiveModelsSpacer(file)
-            self.backgroundModelsSpacer(file)
-            
-            self.writeobjectNames(file)
-            self.writeLevelNameOffsets(file)
-
-            self.writeLevelModels(file)
-            
-            self.writeReflectiveModels(file)
-            self.writeBackgroundModels(file)
-
-            #self.writeAnimationFrameHeaders(file)
-            self.writeCollisionFields(file)
-            self.writeHeader(file)
-            
-                
-    def writeZeroBytes(self, file, numZeros):
-        """Writes a set number of 0 bytes to a file"""
-        byteArray = []
-        for i in range(0, numZeros):
-            byteArray.append(0)
-        file.write(bytes(byteArray))
+    def startModal(self, context, stage):
+        """Runs the rest of the export from a timer, a slice at a time, with a progress bar and Esc to cancel"""
+        windowManager = context.window_manager
+        self.timer = windowManager.event_timer_add(0.01, window=context.window)
+        self.timerDuration = self.timer.time_duration
+        windowManager.modal_handler_add(self)
+        windowManager.progress_begin(0, 100)
+        self.steps = self.exportSteps(stage)
+        return {'RUNNING_MODAL'}
+        
+    def modal(self, context, event):
+        if event.type == 'ESC':
+            self.cancel(context)
+            return {'CANCELLED'}
+        # Timer events don't say which timer fired, only ours moves its duration on when it's its turn
+        if event.type != 'TIMER' or self.timer.time_duration == self.timerDuration:
+            return {'PASS_THROUGH'}
+        self.timerDuration = self.timer.time_duration
             
-    def writeHeader(self, file):
-        """Writes the SMB LZ Header"""
-        file.seek(0, 0)
-        self.writeZeroBytes(file, 4)                            # (4i) Unknown
-        file.write(self.toBigI(100))                            # (4i) Unknown/100  
-        file.write(self.toBigI(self.numberOfCollisionFields))   # (4i) Number of collision fields
-        file.write(self.toBigI(self.collisionFieldsOffset))     # (4i) Offset to to collision fields
-        file.write(self.toBigI(160))                            # (4i) Size of head/offset to start position (always 0xA0)
-        file.write(self.toBigI(self.falloutPlaneOffset))        # (4i) Offset to fallout plane Y coordinate
-        file.write(self.toBigI(self.numberOfGoals))             # (4i) Number of goals
-        file.write(self.toBigI(self.goalsOffset))               # (4i) Offset to goals
-        file.write(self.toBigI(self.numberOfGoals));            # (4i) Number of goals
-        self.writeZeroBytes(file, 4)                            # (4i) Zero
-        file.write(self.toBigI(self.numberOfBumpers))           # (4i) Number of bumpers
-        file.write(self.toBigI(self.bumpersOffset))             # (4i) Offset to bumpers
-        file.write(self.toBigI(self.numberOfJamabars))          # (4i) Number of jamabars
-        file.write(self.toBigI(self.jamabarOffset))             # (4i) Offset to jamabars
-        file.write(self.toBigI(self.numberOfBananas))           # (4i) Number of bananas
-        file.write(self.toBigI(self.bananasOffset))             # (4i) Offset to bananas
-        self.writeZeroBytes(file, 16)                           # (16i)Zero
-        file.write(self.toBigI(0))                              # (4i) Number of something?
-        file.write(self.toBigI(0))                              # (4i) Offset to something?
-        file.write(self.toBigI(self.numberOfLevelModels))       # (4i) Number of level models
-        file.write(self.toBigI(self.levelModelsOffset))         # (4i) Offset to level models
-        self.writeZeroBytes(file, 8)                            # (8i) Zero
-        file.write(self.toBigI(self.numberOfBackgroundModels))  # (4i) Number of background models
-        file.write(self.toBigI(self.backgroundModelsOffset))    # (4i) Offset to background models
-        file.write(self.toBigI(0))                              # (4i) Number of something?
-        file.write(self.toBigI(0))                              # (4i) Offset to something
-        file.write(self.toBigI(0))                              # (4i) Zero
-        file.write(self.toBigI(1))                              # (4i) One
-        file.write(self.toBigI(self.numberOfReflectiveObjects))                              # (4i) Number of reflective objects
-        file.write(self.toBigI(self.reflectiveObjectsOffset))   # (4i) Offset to reflective objects
-        self.writeZeroBytes(file, 24)                           # (24i)Unknown
-        
-    def writeStartPositions(self, file):
-        """Writes the start positions to the file"""
-        """(1 for levels, 1+ for some many games)"""
-        
-        
-        # Make sure we write into the right position
-        # Start positions are always right after the header
-        file.seek(self.sizeOfHeader, 0)
+        # Work for a slice of time, then give Blender its turn
+        sliceEnd = time.perf_counter() + modalTimeSlice
+        running = False
+        try:
+            fraction, status = next(self.steps)
+            while time.perf_counter() < sliceEnd:
+                fraction, status = next(self.steps)
+            running = True
+        except StopIteration:
+            pass
+        except Exception:
+            self.clearData()
+            raise
+        finally:
+            if not running:
+                # Finished or failed, the timer and progress bar go either way
+                self.endModal(context)
+        if not running:
+            return self.finishExport()
+        context.window_manager.progress_update(int(100 * fraction))
+        self.setStatusText(context, "Exporting %s (Esc to cancel): %s" % (os.path.basename(self.filepath), status))
+        return {'PASS_THROUGH'}
+        
+    def cancel(self, context):
+        """Stops a running export, the output is only ever written by its last step so nothing is left behind"""
+        if self.steps is None:
+            return
+        try:
+            # Closing the steps also cancels collision fields still waiting for a worker
+            self.steps.close()
+        finally:
+            self.endModal(context)
+            self.clearData()
+        self.report({'WARNING'}, "Export cancelled, %s was not written" % self.filepath)
+        
+    def endModal(self, context):
+        self.steps = None
+        windowManager = context.window_manager
+        try:
+            self.telemetry.stop()
+            self.setStatusText(context, None)
+        finally:
+            windowManager.event_timer_remove(self.timer)
+            windowManager.progress_end()
+        
+    def setStatusText(self, context, text):
+        """Shows text in the status bar (2.80+) or the header of the area the export started from"""
+        if getattr(context, "workspace", None) is not None:
+            context.workspace.status_text_set(text)
+        elif context.area is not None:
+            if text is None:
+                context.area.header_text_set()
+            else:
+                context.area.header_text_set(text)
+        
+    def exportSteps(self, stage):
+        """Saves an SMB LZ File (or its analysis for a dry run) of an extracted stage one step at a time"""
+        """Yields (fraction done, status text) along the way, the output is written by the very last step"""
+        telemetry = self.telemetry
+        self.exportCache = self.openExportCache()
+        writer = self.stageWriter(stage)
+        if self.dryRun:
+            self.analysis = yield from self.buildProgress(writer.analyzeSteps())
+            text = self.analysis.text().encode()
+            telemetry.output = self.filepath + ".analysis.txt"
+            telemetry.run("writeAnalysis", len(text), SMB_LZ_Core.writeFile, telemetry.output, text)
+            return
+        data = yield from self.buildProgress(writer.buildSteps())
+        filepath = self.filepath
+        raw = data
+        
+        if self.compressionLevel != 'NONE':
+            # SMB_LZ_Compress.py sits next to this addon
+            import SMB_LZ_Compress
+            data = telemetry.run("compress", len(raw), SMB_LZ_Compress.compress, raw, self.compressionLevel)
+            if self.verifyCompression:
+                decompressed = telemetry.run("verifyCompression", len(raw), SMB_LZ_Compress.decompress, data)
+                if decompressed != raw:
+                    raise RuntimeError("Compressed stage does not decompress back to the exported stage")
+            # The compressed file is the .lz the game loads
+            if filepath.endswith(".lz.raw"):
+                filepath = filepath[:-len(".raw")]
                 
-        # Go through start position objects and write them in
-        for obj in self.startPositionObjects:
-            file.write(self.toBigF(obj.location.x))             # (4f) X location
-            file.write(self.toBigF(obj.location.z))             # (4f) Y location
-            file.write(self.toBigF(obj.location.y))             # (4f) Z Location
-            file.write(self.toShortI(self.cnvAngle(self.toDegrees(obj.rotation_euler.x))))     # (2i) X rotation
-            file.write(self.toShortI(self.cnvAngle(self.toDegrees(obj.rotation_euler.z))))     # (2i) Y rotation
-            file.write(self.toShortI(self.cnvAngle(self.toDegrees(obj.rotation_euler.y))))     # (2i) Z rotation
-            self.writeZeroBytes(file, 2)                        # (2i) Zero
-                        
-    def writeFalloutPlane(self, file):
-        self.falloutPlaneOffset = file.tell()
-        file.write(self.toBigF(self.falloutPlaneY))             # (4i) Fallout Y coordinate
-        
-    def writeGoals(self, file):
-        """Writes the goals into the lz"""
-        
-        if self.numberOfGoals == 0:
+        telemetry.output = filepath
+        if self.writePatch:
+            # The previous export is about to be replaced, so the patch has to be made first
+            telemetry.run("writePatch", 0, self.writePatchFile, filepath, raw)
+        telemetry.run("writeFile", len(data), SMB_LZ_Core.writeFile, filepath, data)
+        
+    def writePatchFile(self, filepath, raw):
+        """Writes filepath.patch, the delta from the stage currently at filepath to raw"""
+        # SMB_LZ_Patch.py sits next to this addon
+        import SMB_LZ_Patch
+        if not os.path.exists(filepath):
             return
+        previous = SMB_LZ_Patch.readStage(filepath)
+        patch = SMB_LZ_Patch.diff(previous, raw, self.compressionLevel)
+        SMB_LZ_Core.writeFile(filepath + ".patch", patch)
+        self.telemetry.count(patchBytes=len(patch))
+        
+    def buildProgress(self, steps):
+        """Passes a StageWriter's steps on as (fraction done, status text)"""
+        try:
+            while True:
+                try:
+                    progress = next(steps)
+                except StopIteration as stop:
+                    return stop.value
+                if progress.stage == "serializeCollisionFields":
+                    fraction = 0.9 * progress.trianglesDone / max(progress.triangles, 1)
+                else:
+                    fraction = 0.9
+                yield fraction, "%d of %d collision fields, %d of %d triangles" % (
+                        progress.fieldsDone, progress.fields, progress.trianglesDone, progress.triangles)
+        finally:
+            steps.close()
+        
+    def stageWriter(self, stage):
+        """A StageWriter with the export options"""
+        return SMB_LZ_Core.StageWriter(stage,
+                autoFitCollisionGrid=self.autoFitCollisionGrid,
+                collisionGridTargetTriangles=self.collisionGridTargetTriangles,
+                collisionGridMaxCells=self.collisionGridMaxCells,
+                collisionGridStart=tuple(self.collisionGridStart),
+                collisionGridStep=tuple(self.collisionGridStep),
+                collisionGridStepCount=tuple(self.collisionGridStepCount),
+                scalarTriangleWriter=self.scalarTriangleWriter,
+                cleanCollision=self.cleanCollision,
+                collisionWeldDistance=self.collisionWeldDistance,
+                animationPositionTolerance=self.animationPositionTolerance,
+                animationRotationTolerance=self.animationRotationTolerance,
+                shareCollisionData=self.shareCollisionData,
+                shareGridCellLists=self.shareGridCellLists,
+                reorderCollisionTriangles=self.reorderCollisionTriangles,
+                workers=self.workerProcesses,
+                exportCache=self.exportCache,
+                telemetry=self.telemetry)
+        
+    def extractStage(self, context):
+        """Reads everything the stage needs out of the classified objects"""
+        """Blender is Z up and the game is Y up, so Y and Z swap places"""
+        stage = SMB_LZ_Core.Stage()
         
-        self.goalsOffset = file.tell()
-        
-        # Go through goal objects and write them in
+        for obj in self.startPositionObjects:
+            stage.startPositions.append(SMB_LZ_Core.StartPosition(self.gameVector(obj.location), self.gameVector(obj.rotation_euler)))
+            
         for obj in self.goalObjects:
-            file.write(self.toBigF(obj.location.x))             # (4f) X location
-            file.write(self.toBigF(obj.location.z))             # (4f) Y location
-            file.write(self.toBigF(obj.location.y))             # (4f) Z location
-            file.write(self.toShortI(self.cnvAngle(self.toDegrees(obj.rotation_euler.x))))     # (2i) X rotation
-            file.write(self.toShortI(self.cnvAngle(self.toDegrees(obj.rotation_euler.z))))     # (2i) Y rotation
-            file.write(self.toShortI(self.cnvAngle(self.toDegrees(obj.rotation_euler.y))))     # (2i) Z rotation
             # Determine the goal type (blue = default)
-            # Red = 0x5200, Green = 0x4700, Blue = 0x4200
             lowerName = obj.name.lower()
             if "red" in lowerName:
-                file.write(self.toShortI(0x5200))               # (2i) Goal type (Red)  
+                goalType = "red"
             elif "green" in lowerName:
-                file.write(self.toShortI(0x4700))               # (2i) Goal type (Green)
+                goalType = "green"
+            else:
+                goalType = "blue"
+            items = self.itemArray(obj, context, goalType)
+            if items is not None:
+                stage.goalArrays.append(items)
             else:
-                file.write(self.toShortI(0x4200))               # (2i) Goal type (Blue)
+                stage.goals.append(SMB_LZ_Core.Goal(self.gameVector(obj.location), self.gameVector(obj.rotation_euler), goalType))
             
-        
-    def writeBumpers(self, file):
-        """Writes the bumpers into the LZ"""
-        
-        if self.numberOfBumpers == 0:
-            return
-        
-        self.bumpersOffset = file.tell()
-          
-        # Go through bumper objects and write them in
-        for obj in self.goalObjects:
-            file.write(self.toBigF(obj.location.x))             # (4f) X location
-            file.write(self.toBigF(obj.location.z))             # (4f) Y location
-            file.write(self.toBigF(obj.location.y))             # (4f) Z location
-            file.write(self.toShortI(self.cnvAngle(self.toDegrees(obj.rotation_euler.x))))     # (2i) X rotation
-            file.write(self.toShortI(self.cnvAngle(self.toDegrees(obj.rotation_euler.z))))     # (2i) Y rotation
-            file.write(self.toShortI(self.cnvAngle(self.toDegrees(obj.rotation_euler.y))))     # (2i) Z rotation
-            self.writeZeroBytes(file, 2)                        # (2i) Zero
-            file.write(self.toBigF(obj.scale.x))                # (4f) X scale
-            file.write(self.toBigF(obj.scale.z))                # (4f) Y scale
-            file.write(self.toBigF(obj.scale.y))                # (4f) Z scale
+        for obj in self.bumperObjects:
+            items = self.itemArray(obj, context)
+            if items is not None:
+                stage.bumperArrays.append(items)
+            else:
+                stage.bumpers.append(SMB_LZ_Core.ScaledItem(self.gameVector(obj.location), self.gameVector(obj.rotation_euler), self.gameVector(obj.scale)))
+        for obj in self.jamabarObjects:
+            items = self.itemArray(obj, context)
+            if items is not None:
+                stage.jamabarArrays.append(items)
+            else:
+                stage.jamabars.append(SMB_LZ_Core.ScaledItem(self.gameVector(obj.location), self.gameVector(obj.rotation_euler), self.gameVector(obj.scale)))
             
-        
-    def writeJamabars(self, file):
-        """Writes the bumpers into the LZ"""
-        
-        if self.numberOfJamabars == 0:
-            return
-        
-        self.jamabarOffset = file.tell()
-        
-        # Go through the jamabar objects and write them in
-        for obj in self.goalObjects:
-            file.write(self.toBigF(obj.location.x))             # (4f) X location
-            file.write(self.toBigF(obj.location.z))             # (4f) Y location
-            file.write(self.toBigF(obj.location.y))             # (4f) Z location
-            file.write(self.toShortI(self.cnvAngle(self.toDegrees(obj.rotation_euler.x))))     # (2i) X rotation
-            file.write(self.toShortI(self.cnvAngle(self.toDegrees(obj.rotation_euler.z))))     # (2i) Y rotation
-            file.write(self.toShortI(self.cnvAngle(self.toDegrees(obj.rotation_euler.y))))     # (2i) Z rotation
-            self.writeZeroBytes(file, 2)                        # (2i) Zero
-            file.write(self.toBigF(obj.scale.x))                # (4f) X scale
-            file.write(self.toBigF(obj.scale.z))                # (4f) Y scale
-            file.write(self.toBigF(obj.scale.y))                # (4f) Z 
-        
-        
-    def writeBananas(self, file):
-        """Write the bananas into the LZ"""
-        
-        if self.numberOfBananas == 0:
-            return
-        
-        self.bananasOffset = file.tell()
-        
-        # Go through the banana objects and write them in
-        for obj in self.goalObjects:
-            file.write(self.toBigF(obj.location.x))             # (4f) X location
-            file.write(self.toBigF(obj.location.z))             # (4f) Y location
-            file.write(self.toBigF(obj.location.y))             # (4f) Z location
+        for obj in self.bananaObjects:
             # Determine the banana type (single/nanner = default)
-            # Bunch = 1, Single.Nanner = 1
-            if "bunch" in obj.name.lower():
-                file.write(self.toBigI(1))                      # (4i) Banana Type (Bunch)
+            bananaType = "bunch" if "bunch" in obj.name.lower() else "single"
+            items = self.itemArray(obj, context, bananaType)
+            if items is not None:
+                stage.bananaArrays.append(items)
             else:
-                file.write(self.toBigI(0))                      # (4i) Banana Type (Single/Nanner)
-        
-        
-    def collisionFieldSpacer(self, file):
-        """Pad space for the collision fields"""
-        
-        self.numberOfCollisionFields = self.numberOfLevelModels + self.numberOfReflectiveObjects
-
-        if self.numberOfCollisionFields == 0:
-            return
-        
-        # Save where the collision fields offset is
-        self.collisionFieldsOffset = file.tell()
-        file.seek(self.numberOfCollisionFields * 196, 1)           # (196x) Make space for each collision field/header
-        
-        
-    
-    def writeobjectNames(self, file):
-        """Write the model names into the file"""
-        
-        alignment = file.tell() % 4
-        if alignment != 0:
-            self.writeZeroBytes(file, 4 - alignment)
+                stage.bananas.append(SMB_LZ_Core.Banana(self.gameVector(obj.location), bananaType))
             
-        self.writeZeroBytes(file, 4)
-        self.modelNamesOffset = file.tell()
-        
-
-        # Go through every standard level model and write their name in
         for obj in self.levelModelObjects:
-            # Add this name to the list of name offsets
-            self.levelModelNameOffsets.append(file.tell())
-            # Encode the name into bytes and write it in
-            nameBytes = bytearray()
-            nameBytes.extend(obj.name.encode())
-            file.write(nameBytes)                               # (ascii) Model name
-            self.writeZeroBytes(file, 1)                        # (1i) \0 Char
-            alignment = file.tell() % 4;                        # Get number of bytes that would align the file
-            if alignment != 0:
-                self.writeZeroBytes(file, 4 - alignment)         
-                
-        # Go through every background level model and write their name in
-        for obj in self.backgroundModelObjects:
-            # Add this name to the list of name offsets
-            self.backgroundModelNameOffsets.append(file.tell())
-            # Encode the name into bytes and write it in
-            nameBytes = bytearray()
-            nameBytes.extend(obj.name.encode())
-            file.write(nameBytes)                               # (ascii) Model name
-            self.writeZeroBytes(file, 1)                        # (1i) \0 Char
-            alignment = file.tell() % 4;                        # Get number of bytes that would align the file
-            if alignment != 0:
-                self.writeZeroBytes(file, 4 - alignment)        
-            
-        # Go through every reflective level model and write their name in
+            stage.levelModels.append(self.collisionModel(obj, context))
         for obj in self.reflectiveObjects:
-            # Add this name to the list of name offsets
-            self.reflectiveObjectNameOffsets.append(file.tell())
-            # Encode the name into bytes and write it in
-            nameBytes = bytearray()
-            nameBytes.extend(obj.name.encode())
-            file.write(nameBytes)                               # (ascii) Model name
-            self.writeZeroBytes(file, 1)                        # (1i) \0 Char
-            alignment = file.tell() % 4;                        # Get number of bytes that would align the file
-            if alignment != 0:
-                self.writeZeroBytes(file, 4 - alignment)            
-        
-    def levelModelNameSpacer(self, file):
-        total = self.numberOfLevelModels + self.numberOfReflectiveObjects + self.numberOfBackgroundModels
-        if total == 0:
-            return
-        self.offsetToModelNamePointers = file.tell()
-        file.seek(4 * total, 1)
-        
-        
-    def writeLevelNameOffsets(self, file):
-        savePos = file.tell()
-        file.seek(self.offsetToModelNamePointers, 0)
-        # Go through every standard level model and write its header
-        for i in range(0, len(self.levelModelNameOffsets)):
-            # Add the offset the list of pointers to level name asciis
-            self.levelModelNamePointerOffsets.append(file.tell())
-            file.write(self.toBigI(self.levelModelNameOffsets[i]))          # (4i) Offset to model name ascii
-    
-        # Go through every standard level model and write its header
-        for i in range(0, len(self.reflectiveObjectNameOffsets)):
-            # Add the offset the list of pointers to level name asciis
-            self.reflectiveObjectNamePointerOffsets.append(file.tell())
-            file.write(self.toBigI(self.reflectiveObjectNameOffsets[i]))    # (4i) Offset to model name ascii   
-    
-        # Go through every standard level model and write its header
-        for i in range(0, len(self.backgroundModelNameOffsets)):
-            # Add the offset the list of pointers to level name asciis
-            self.backgroundModelNamePointerOffsets.append(file.tell())
-            file.write(self.toBigI(self.backgroundModelNameOffsets[i]))  
-        file.seek(savePos, 0)
-        
-        
-    def levelModelsSpacer(self, file):
-        if self.numberOfLevelModels == 0:
-                return
-            
-        self.levelModelsOffset = file.tell()
-        
-        file.seek(4 * 3 * self.numberOfLevelModels, 1)
-        
-    
-    
-    def writeLevelModels(self, file):
-        """Write the level model headers into the file"""
-        
-        if self.numberOfLevelModels == 0:
-            return
-        
-        savePos = file.tell()
-        
-        file.seek(self.levelModelsOffset, 0)
-        # Go through every standard level model and write its header
-        for i in range(0, len(self.levelModelNameOffsets)):
-   
-            file.write(self.toBigI(1))                                      # (4i) Zero
-            file.write(self.toBigI(self.levelModelNameOffsets[i]))          # (4i) Offset to model name ascii
-            file.write(self.toBigI(0))                                      # (4i) Zero
-                 
-        file.seek(savePos, 0)
-                 
-    def reflectiveModelsSpacer(self, file):
-        if self.numberOfReflectiveObjects == 0:
-            return
-        
-        # Save where the reflective level models headers start
-        self.reflectiveObjectsOffset = file.tell()
-        
-        file.seek(4 * 2 * self.numberOfReflectiveObjects, 1)
-    
-    def writeReflectiveModels(self, file):
-        """Write the reflective model headers into the file"""
-        
-        if self.numberOfReflectiveObjects == 0:
-            return
-        
-        savePos = file.tell()
-        
-        file.seek(self.reflectiveObjectsOffset, 0)
-        # Go through every standard level model and write its header
-        for i in range(0, len(self.reflectiveObjectNameOffsets)):
-            # Add the offset the list of pointers to level name asciis
-            file.write(self.toBigI(self.reflectiveObjectNameOffsets[i]))    # (4i) Offset to model name ascii   
-            file.write(self.toBigI(0))                                      # (4i) Zero
-    
-        file.seek(savePos, 0)
-    
-    def backgroundModelsSpacer(self, file):
-        if self.numberOfBackgroundModels == 0:
-            return
-        
-        # Save where the background level models headers start
-        self.backgroundModelsOffset = file.tell()
-        
-        file.seek(56 * self.numberOfBackgroundModels, 1)
-    
-    def writeBackgroundModels(self, file):
-        """Write the background model headers into the file"""
-        
-        if self.numberOfBackgroundModels == 0:
-            return
+            stage.reflectiveObjects.append(self.collisionModel(obj, context))
+        for obj in self.backgroundModelObjects:
+            stage.backgroundModels.append(SMB_LZ_Core.BackgroundModel(obj.name, self.gameVector(obj.location),
+                    self.gameVector(obj.rotation_euler), self.gameVector(obj.scale)))
+        return stage
         
-        savePos = file.tell()
-        
-        file.seek(self.backgroundModelsOffset, 0)
-        # Go through every standard level model and write its header
-        for i in range(0, len(self.backgroundModelNameOffsets)):
-            obj = self.backgroundModelObjects[i]
-            file.write(self.toBigI(31))                                     # (31i)0x1F
-            file.write(self.toBigI(self.backgroundModelNameOffsets[i]))     # (4i) Offset to model name ascii
-            file.write(self.toBigI(0))                                      # (4i) Zero
-            file.write(self.toBigF(obj.location.x))                         # (4f) X location
-            file.write(self.toBigF(obj.location.z))                         # (4f) Y location
-            file.write(self.toBigF(obj.location.y))                         # (4f) Z location
-            file.write(self.toShortI(self.cnvAngle(self.toDegrees(obj.rotation_euler.x))))                 # (2i) X rotation
-            file.write(self.toShortI(self.cnvAngle(self.toDegrees(obj.rotation_euler.z))))                 # (2i) Z rotation
-            file.write(self.toShortI(self.cnvAngle(self.toDegrees(obj.rotation_euler.y))))                 # (2i) Y rotation
-            self.writeZeroBytes(file, 2)                                    # (2i) Zero
-            file.write(self.toBigF(obj.scale.x))                            # (4f) X scale
-            file.write(self.toBigF(obj.scale.z))                            # (4f) Y scale
-            file.write(self.toBigF(obj.scale.y))                            # (4f) Z scale
-            self.writeZeroBytes(file, 12)                                   # (12i)Zero
-        
-        file.seek(savePos, 0)
-        
-    def writeCollisionTriangles(self, file, context):
-        """Write the collision triangles into the LZ"""
-        from mathutils import Vector
-        
-        # Go through every standard level model and write its triangles
-        for i in range(0, len(self.levelModelObjects)):
-            # Add this offset to the list of triangle offsets
-            self.levelModelTriangleOffsets.append(file.tell())
-            # Duplicate the object to avoid modifying the actual blender scene
-            obj = self.duplicateObject(self.levelModelObjects[i])
-            # Triangulate the object
-            self.triangulate_object(obj)
-            # Add the number of faces to the list of triangle counts
-            self.numberOfLevelModelTriangles.append(len(obj.data.polygons))
-            
-            # Go through every triangle face
-            for face in obj.data.polygons:
-                vertices = []
-                # Collect the face's vertices
-                for vert in face.vertices:
-                    vertices.append(Vector((obj.data.vertices[vert].co.x, obj.data.vertices[vert].co.z, obj.data.vertices[vert].co.y)))
-                # Write the triangle to the LZ
-                self.writeTriangle(file, vertices[0], vertices[1], vertices[2], face.normal)
-            
-        # Go through every reflective level model and write its triangles
-        for i in range(0, len(self.reflectiveObjects)):
-            # Add this offset to the list of triangle offsets
-            self.reflectiveObjectTriangleOffsets.append(file.tell())
-            # Duplicate the object to avoid modifying the actual blender scene
-            obj = self.duplicateObject(self.reflectiveObjects[i])
-            # Triangulate the object
-            self.triangulate_object(obj)
-             # Add the number of faces to the list of triangle counts
-            self.numberOfReflectiveObjectTriangles.append(len(obj.data.polygons))
-            
-            # Go through every triangle face
-            for face in obj.data.polygons:
-                vertices = []
-                # Collect the face's vertices
-                for vert in face.vertices:
-                    vertices.append(Vector((obj.data.vertices[vert].co.x, obj.data.vertices[vert].co.z, obj.data.vertices[vert].co.y)))
-                # Write the triangle to the LZ
-                self.writeTriangle(file, vertices[0], vertices[1], vertices[2], face.normal)
-            
+    def scopedObjects(self, context):
+        """Returns the scene's objects that pass the selection, visibility and collection filters"""
+        scene = context.scene
+        collectionObjects = None
+        if self.exportCollections.strip():
+            # 2.80+ has collections (including their child collections), 2.7x has groups
+            collections = bpy.data.collections if hasattr(bpy.data, "collections") else bpy.data.groups
+            collectionObjects = set()
+            for name in self.exportCollections.split(","):
+                collection = collections.get(name.strip())
+                if collection is None:
+                    self.report({'WARNING'}, "No collection named %s to export" % name.strip())
+                    continue
+                members = collection.all_objects if hasattr(collection, "all_objects") else collection.objects
+                collectionObjects.update(obj.name for obj in members)
                 
-    def writeCollisionGridTriangleList(self, file):
-        """Writes the list of triangles used for each objects collider"""
-        
-        # Go through every standard level model and write its collision grid list
-        for i in range(0, len(self.levelModelObjects)):
-            # Add this offset to the collision grid pointers list
-            self.levelModelCollisionGridPointers.append(file.tell())
-            
-            numTriangles = self.numberOfLevelModelTriangles[i]
-            # Triangles are ordered, so just writing 0-numTriangles
-            for j in range(0, 256):
-                for i in range(0, numTriangles):
-                    file.write(self.toShortI(i))                    # (2i) Offset to collision triangle in list
-                file.write(self.toShortI(65535))                    # (2i) Triangle List terminator
-            alignment = file.tell() % 4
-            if alignment != 0:
-                self.writeZeroBytes(file, 4 - alignment)
-        
-        # Go through every reflective level model and write its collision grid list
-        for i in range(0, len(self.reflectiveObjects)):
-            # Add this offset to the collision grid pointers list
-            self.reflectiveObjectCollisionGridPointers.append(file.tell())
-            
-            numTriangles = self.numberOfReflectiveObjectTriangles[i]
-            # Triangles are ordered, so just writing 0-numTriangles
-            for j in range(0, 256):
-                for i in range(0, numTriangles):
-                    file.write(self.toShortI(i))                    # (2i) Offset to collision triangle in list
-                file.write(self.toShortI(65535))                    # (2i) Triangle List terminator
-            alignment = file.tell() % 4
-            if alignment != 0:
-                self.writeZeroBytes(file, 4 - alignment)
-            
-    def writeCollisionGridTrianglePointers(self, file):
-        """Writes pointers to the triangle grid list"""
+        objects = []
+        for obj in scene.objects:
+            if obj.type not in exportableObjectTypes:
+                continue
+            if collectionObjects is not None and obj.name not in collectionObjects:
+                continue
+            if self.exportSelectedOnly and not (obj.select_get() if hasattr(obj, "select_get") else obj.select):
+                continue
+            if self.exportVisibleOnly:
+                visible = obj.visible_get() if hasattr(obj, "visible_get") else obj.is_visible(scene)
+                if not visible or obj.hide_render:
+                    continue
+            objects.append(obj)
+        return objects
+        
+    def objectType(self, obj):
+        """Returns what an object is exported as, one of objectTypes"""
+        objectType = self.declaredObjectType(obj)
+        if objectType is not None:
+            return objectType
+        
+        # Objects in a collection named after a type (Goals, Bananas, Level Models, ...) are that type
+        collections = getattr(obj, "users_collection", None) or getattr(obj, "users_group", None) or []
+        for collection in collections:
+            if collection not in self.collectionTypes:
+                self.collectionTypes[collection] = self.collectionType(collection)
+            if self.collectionTypes[collection] is not None:
+                return self.collectionTypes[collection]
                 
-        # Go through every standard level model and write its collision grid list pointer
-        for i in range(0, len(self.levelModelObjects)):
-            numTriangles = self.numberOfLevelModelTriangles[i]
-            # Add this offset to the collision grid pointers list
-            self.levelModelCollisionGridPointerPointers.append(file.tell())
-
-            for j in range(0, 256):
-                file.write(self.toBigI(self.levelModelCollisionGridPointers[i] + (j * (2 + (2 * numTriangles)))))
-            
-        # Go through every reflective level model and write its collision grid list
-        for i in range(0, len(self.reflectiveObjects)):
-            numTriangles = self.numberOfReflectiveObjectTriangles[i]
-            # Add this offset to the collision grid pointers list
-            self.reflectiveObjectCollisionGridPointerPointers.append(file.tell())
-
-            for j in range(0, 256):
-                file.write(self.toBigI(self.reflectiveObjectCollisionGridPointers[i]+ (j * (2 + (2 * numTriangles)))))
-
-
-    def writeAnimationFrameHeaders(self, file):
-        """Writes a stub of animation frame headers for objects"""
-        
-        # Go through every standard level model and write its collision grid list
-        for i in range(0, len(self.levelModelObjects)):
-            self.levelModelAnimationFrameOffsets.append(file.tell())
-            # Writing stub with 0 animation frames for now
-            file.write(self.toBigI(0))                          # (4i) Number of X frames
-            file.write(self.toBigI(0))                          # (4i) Offset to X frames
-            file.write(self.toBigI(0))                          # (4i) Number of Y frames
-            file.write(self.toBigI(0))                          # (4i) Offset to Y frames
-            file.write(self.toBigI(0))                          # (4i) Number of Z frames
-            file.write(self.toBigI(0))                          # (4i) Offset to Z frames
-            self.writeZeroBytes(file, 24)                       # (24i)Zero
-            
-        # Go through every reflective level model and write its collision grid list
-        for i in range(0, len(self.reflectiveObjects)):
-            self.reflectiveObjectAnimationFrameOffsets.append(file.tell())
-            # Writing stub with 0 animation frames for now
-            file.write(self.toBigI(0))                          # (4i) Number of X frames
-            file.write(self.toBigI(0))                          # (4i) Offset to X frames
-            file.write(self.toBigI(0))                          # (4i) Number of Y frames
-            file.write(self.toBigI(0))                          # (4i) Offset to Y frames
-            file.write(self.toBigI(0))                          # (4i) Number of Z frames
-            file.write(self.toBigI(0))                          # (4i) Offset to Z frames
-            self.writeZeroBytes(file, 24)                       # (24i)Zero
-                        
-    def writeCollisionFields(self, file):
-        """Write the collision field headers into the LZ"""
-        
-        if self.numberOfCollisionFields == 0:
-            return
-        
-        savePos = file.tell()
-        file.seek(self.collisionFieldsOffset, 0)
-        
-        # Go through every standard level model and write its collision header
-        for i in range(0, len(self.levelModelObjects)):
-            obj = self.levelModelObjects[i]
-            file.write(self.toBigF(0))#obj.location.x))                                 # (4f) X center for animation
-            file.write(self.toBigF(0))#obj.location.z))                                 # (4f) Y center for animation
-            file.write(self.toBigF(0))#obj.location.y))                                 # (4f) Z center for animation
-            file.write(self.toShortI(0))#self.cnvAngle(self.toDegrees(obj.rotation_euler.x))))                         # (2i) X rotation for animation
-            file.write(self.toShortI(0))#self.cnvAngle(self.toDegrees(obj.rotation_euler.z))))                         # (2i) Y rotation for animation
-            file.write(self.toShortI(0))#self.cnvAngle(self.toDegrees(obj.rotation_euler.y))))                         # (2i) Z rotation for animation
-            self.writeZeroBytes(file, 2)                                            # (2i) Zero
-            file.write(self.toBigI(0))        # (4i) Offset to animation frame header
-            file.write(self.toBigI(self.levelModelNamePointerOffsets[i]))           # (4i) Offset to level model name pointer
-            file.write(self.toBigI(self.levelModelTriangleOffsets[i]))              # (4i) Offset to triangle colliders
-            file.write(self.toBigI(self.levelModelCollisionGridPointerPointers[i])) # (4i) Offset to collision grid list pointers
-            file.write(self.toBigF(-256))                                              # (4i) Start X value for collision grid
-            file.write(self.toBigF(-256))                                              # (4i) Start Z value for collision grid
-            file.write(self.toBigF(32))                                              # (4i) Step X value for collision grid
-            file.write(self.toBigF(32))                                              # (4i) Step X value for collision grid
-            file.write(self.toBigI(16))                                             # (4i) 16
-            file.write(self.toBigI(16))                                             # (4i) 16
-
-            self.writePartialHeader(file, i)                                           # (136)Partial Header
-            
-        # Go through every reflective level model and write its collision header
-        for i in range(0, len(self.reflectiveObjects)):
-            obj = self.reflectiveObjects[i]
-            file.write(self.toBigF(0))                                         # (4f) X center for animation
-            file.write(self.toBigF(0))                                         # (4f) Y center for animation
-            file.write(self.toBigF(0))                                         # (4f) Z center for animation
-            file.write(self.toShortI(0))                                 # (2i) X rotation for animation
-            file.write(self.toShortI(0))                                 # (2i) Y rotation for animation
-            file.write(self.toShortI(0))                                 # (2i) Z rotation for animation
-            self.writeZeroBytes(file, 2)                                                    # (2i) Zero
-            file.write(self.toBigI(0))          # (4i) Offset to animation frame header
-            file.write(self.toBigI(self.reflectiveObjectNamePointerOffsets[i]))             # (4i) Offset to level model name pointer
-            file.write(self.toBigI(self.reflectiveObjectTriangleOffsets[i]))                # (4i) Offset to triangle colliders
-            file.write(self.toBigI(self.reflectiveObjectCollisionGridPointerPointers[i]))   # (4i) Offset to collision grid list pointers
-            file.write(self.toBigF(-256))                                                   # (4i) Start X value for collision grid
-            file.write(self.toBigF(-256))                                                   # (4i) Start Z value for collision grid
-            file.write(self.toBigF(32))                                                    # (4i) Step X value for collision grid
-            file.write(self.toBigF(32))                                                    # (4i) Step X value for collision grid
-            file.write(self.toBigI(16))                                                     # (4i) 16
-            file.write(self.toBigI(16))                                                     # (4i) 16
-
-            self.writePartialHeader(file, i)                                                   # (136)Partial Header
-            
-        file.seek(savePos, 0)
-            
-    def writePartialHeader(self, file, index):
-        file.write(self.toBigI(0))             # (4i) Number of goals
-        file.write(self.toBigI(0))               # (4i) Offset to goals
-        file.write(self.toBigI(0));            # (4i) Number of goals
-        self.writeZeroBytes(file, 4)                            # (4i) Zero
-        file.write(self.toBigI(0))           # (4i) Number of bumpers
-        file.write(self.toBigI(0))             # (4i) Offset to bumpers
-        file.write(self.toBigI(0))          # (4i) Number of jamabars
-        file.write(self.toBigI(0))             # (4i) Offset to jamabars
-        file.write(self.toBigI(0))           # (4i) Number of bananas
-        file.write(self.toBigI(0))             # (4i) Offset to bananas
-        self.writeZeroBytes(file, 16)                           # (16i)Zero
-        file.write(self.toBigI(0))                              # (4i) Number of something?
-        file.write(self.toBigI(0))                              # (4i) Offset to something?
-        file.write(self.toBigI(self.numberOfLevelModels))       # (4i) Number of level models
-        file.write(self.toBigI(self.levelModelsOffset))         # (4i) Offset to level models
-        self.writeZeroBytes(file, 8)                            # (8i) Zero
-        file.write(self.toBigI(0))                              # (4i) Number of background models
-        file.write(self.toBigI(0))                              # (4i) Offset to background models
-        file.write(self.toBigI(0))                              # (4i) Number of something?
-        file.write(self.toBigI(0))                              # (4i) Offset to something
-        file.write(self.toBigI(0))                              # (4i) Zero
-        file.write(self.toBigI(0))                              # (4i) One
-        file.write(self.toBigI(0))                              # (4i) Number of reflective objects
-        file.write(self.toBigI(0))   # (4i) Offset to reflective objects
-        self.writeZeroBytes(file, 24)                           # (24i)Unknown
-        
-    
-    def toBigI(self, number):
-        return struct.pack('>I', number)
-        
-    def toBigF(self, number):
-        return struct.pack('>f', number)
-        
-    def toShortI(self, number):
-        return struct.pack('>H', int(number) & 0xFFFF)
-        
-    def cross(self, a, b):
-        from mathutils import Vector
-        return Vector(((a.y * b.z) - (a.z * b.y),
-                      (a.z * b.x) - (a.x * b.z),
-                      (a.x * b.y) - (a.y * b.x)))
-                      
-    def dot(self, a, b):
-        return (a.x * b.x) + (a.y * b.y) + (a.z + b.z)
-        
-    def dotm(self, a, r0, r1, r2):
-        from mathutils import Vector
-        return Vector(((a.x * r0.x) + (a.y * r1.x) + (a.z * r2.x),
-                      (a.x * r0.y) + (a.y * r1.y) + (a.z * r2.y),
-                      (a.x * r0.z) + (a.y * r1.z) + (a.z * r2.z)))
-        
-    def normalize(self, v):
-        from mathutils import Vector
-        magnitude = math.sqrt(v.x * v.x + v.y * v.y + v.z * v.z)
-        if magnitude == 0:
-            return Vector((0, 0, 0))
-        return Vector((v.x / magnitude, v.y / magnitude, v.z / magnitude))
-      
-    def hat(self, v):
-        from mathutils import Vector
-        return Vector((-v.y, v.x, 0.0))
-        
-    def toDegrees(self, theta):
-        return 57.2957795130824*theta
-        
-    def cnvAngle(self, theta):
-        return int(65536.0 * theta / 360.0)
-        
-    def reverse_angle(self, c, s):
-        if c > 1.0:
-            c = 1.0
-        elif c < -1.0:
-            c = -1.0
-        if s > 1.0:
-            s = 1.0
-        elif s < -1.0:
-            s = -1.0
-        a = self.toDegrees(math.asin(s))
-        if c < 0:
-            a -= 180.0
-        if abs(c) < abs(s):
-            a = self.toDegrees(math.acos(c))
-            if s < 0.0:
-                a = -a
-        if a < 0.0:
-            if a > -0.001:
-                a = 0.0
-            else:
-                a += 360.0
-        return a
-    
-    def duplicateObject(self, object):
-        from mathutils import Vector
-        copy = object.copy()
-        copy.location += Vector((0, 0, 0))
-        copy.data = copy.data.copy()
-        return copy
-            
-    def triangulate_object(self, obj):
-        import bmesh
-        me = obj.data
-        # Get a BMesh representation
-        bm = bmesh.new()
-        bm.from_mesh(me)
-
-        bmesh.ops.triangulate(bm, faces=bm.faces[:], quad_method=0, ngon_method=0)
-
-        # Finish up, write the bmesh back to the mesh
-        bm.to_mesh(me)
-        bm.free()
-        
-    def writeTriangle(self, file, vertex, vertex2, vertex3, normal):
-        """Writes a triangle into the LZ"""
-        """Mostly duplicated from Yoshimaster's original code"""
-        from mathutils import Vector
+        lowerName = obj.name.lower()
+        for keyword in objectTypeKeywords:
+            if keyword in lowerName:
+                return keyword
+        return "level"
+        
+    def declaredObjectType(self, idBlock):
+        """Returns the type set in an object's or collection's smbType property, or None"""
+        objectType = idBlock.get(objectTypeProperty)
+        if objectType is None:
+            return None
+        objectType = str(objectType).strip().lower()
+        if objectType not in objectTypes:
+            self.report({'WARNING'}, "%s has an unknown %s %s, expected one of %s" % (
+                    idBlock.name, objectTypeProperty, objectType, ", ".join(objectTypes)))
+            return None
+        return objectType
+        
+    def collectionType(self, collection):
+        """Returns the type of every object in a collection, from its smbType property or its name, or None"""
+        objectType = self.declaredObjectType(collection)
+        if objectType is not None:
+            return objectType
+        # Singular or plural, in any case, with or without spaces ("Level Models", "bananas", "Start")
+        name = collection.name.lower().replace(" ", "").replace("_", "")
+        if name.endswith("s"):
+            name = name[:-1]
+        if name == "levelmodel":
+            return "level"
+        if name in objectTypeKeywords:
+            return name
+        return None
+        
+    def findCollisionProxies(self, objects):
+        """Pairs models with the lower poly objects whose triangles are used for their collision instead"""
+        objectsByName = dict((obj.name, obj) for obj in objects)
+        proxies = {}
+        for obj in objects:
+            lowerName = obj.name.lower()
+            for suffix in collisionProxySuffixes:
+                if lowerName.endswith(suffix) and obj.name[:-len(suffix)] in objectsByName:
+                    proxies[obj.name[:-len(suffix)]] = obj
+        # A property on the model wins over the naming convention
+        for obj in objects:
+            proxyName = obj.get(collisionProxyProperty)
+            if proxyName in objectsByName and proxyName != obj.name:
+                proxies[obj.name] = objectsByName[proxyName]
+        return proxies
+        
+    def collisionModel(self, obj, context):
+        proxy = self.collisionProxies.get(obj.name)
+        if proxy is not None:
+            vertices, triangles = self.objectMeshBuffers(proxy, context)
+            vertices = self.proxyVertices(obj, proxy, vertices)
+            decimateRatio = 1.0
+        else:
+            vertices, triangles = self.objectMeshBuffers(obj, context)
+            decimateRatio = self.collisionDecimateRatio if self.decimateCollision else 1.0
+        return SMB_LZ_Core.CollisionModel(obj.name, vertices, triangles,
+                self.gameVector(obj.location), self.gameVector(obj.rotation_euler), self.objectAnimation(obj, context),
+                decimateRatio, self.gameVector(obj.scale))
+        
+    def findInstancedObjects(self, objects, context):
+        """Names of the objects that item emitters place copies of"""
+        """Their particles or instances are exported as items, the objects themselves aren't exported"""
+        names = set()
+        for obj in objects:
+            if self.objectType(obj) not in emitterObjectTypes:
+                continue
+            for system in getattr(obj, "particle_systems", ()):
+                settings = system.settings
+                if settings.render_type == 'OBJECT':
+                    instanceObject = getattr(settings, "instance_object", getattr(settings, "dupli_object", None))
+                    if instanceObject is not None:
+                        names.add(instanceObject.name)
+                elif settings.render_type in {'COLLECTION', 'GROUP'}:
+                    collection = getattr(settings, "instance_collection", getattr(settings, "dupli_group", None))
+                    if collection is not None:
+                        members = collection.all_objects if hasattr(collection, "all_objects") else collection.objects
+                        names.update(member.name for member in members)
+            if obj.type == 'MESH' and getattr(obj, "instance_type", getattr(obj, "dupli_type", None)) == 'VERTS':
+                # Vertex instancing copies the object's children
+                names.update(child.name for child in obj.children)
+            if any(modifier.type == 'NODES' for modifier in obj.modifiers):
+                names.update(self.instanceSources(context).get(obj.name, ()))
+        return names
+        
+    def itemArray(self, obj, context, itemType=None):
+        """Returns the items an emitter object places as an ItemArray, or None for an object that's a single item"""
+        """Emitters are objects with particle systems (an item per living particle), vertex instancing
+        (an item per vertex) or geometry nodes that make instances (an item per instance)"""
+        if len(getattr(obj, "particle_systems", ())) != 0:
+            positions, rotations, scales = self.particlePlacements(obj, context)
+        elif obj.type == 'MESH' and getattr(obj, "instance_type", getattr(obj, "dupli_type", None)) == 'VERTS':
+            positions, rotations, scales = self.vertexPlacements(obj, context)
+        elif any(modifier.type == 'NODES' for modifier in obj.modifiers) and obj.name in self.instanceMatrices(context):
+            positions, rotations, scales = self.matrixPlacements(np.array(self.instanceMatrices(context)[obj.name]))
+        else:
+            return None
+        # Blender is Z up and the game is Y up, the same swap as gameVector()
+        return SMB_LZ_Core.ItemArray(positions[:, [0, 2, 1]], rotations[:, [0, 2, 1]], scales[:, [0, 2, 1]], itemType)
+        
+    def particlePlacements(self, obj, context):
+        """Reads the world space location, rotation and size of every particle there is at the current frame"""
+        evaluated = obj.evaluated_get(context.evaluated_depsgraph_get()) if hasattr(obj, "evaluated_get") else obj
+        frame = context.scene.frame_current
+        positions, rotations, scales = [], [], []
+        for system in evaluated.particle_systems:
+            particles = system.particles
+            count = len(particles)
+            locations = np.empty(count * 3, dtype=np.float32)
+            particles.foreach_get("location", locations)
+            quaternions = np.empty(count * 4, dtype=np.float32)
+            particles.foreach_get("rotation", quaternions)
+            sizes = np.empty(count, dtype=np.float32)
+            particles.foreach_get("size", sizes)
+            alive = np.ones(count, dtype=bool)
+            if system.settings.type == 'EMITTER':
+                # Particles that aren't born yet or have already died aren't placed
+                # (alive_state is an enum, which foreach_get can't read)
+                births = np.empty(count, dtype=np.float32)
+                particles.foreach_get("birth_time", births)
+                deaths = np.empty(count, dtype=np.float32)
+                particles.foreach_get("die_time", deaths)
+                alive = (births <= frame) & (frame < deaths)
+            positions.append(locations.reshape(-1, 3)[alive])
+            rotations.append(self.quaternionEulers(quaternions.reshape(-1, 4)[alive]))
+            scales.append(np.repeat(sizes[alive, np.newaxis], 3, axis=1))
+        return np.concatenate(positions), np.concatenate(rotations), np.concatenate(scales)
+        
+    def vertexPlacements(self, obj, context):
+        """Places an item on every world space vertex, with the object's own rotation and scale"""
+        vertices, triangles = self.objectMeshBuffers(obj, context)
+        matrix = np.array(obj.matrix_world)
+        # The buffers are in game space, the matrix is in Blender's axes
+        positions = np.dot(vertices[:, [0, 2, 1]], matrix[:3, :3].T) + matrix[:3, 3]
+        count = len(positions)
+        return positions, np.tile(tuple(obj.rotation_euler), (count, 1)), np.tile(tuple(obj.scale), (count, 1))
+        
+    def instanceMatrices(self, context):
+        """World matrices of every instance in the scene by the name of the object that made it"""
+        """Instances can only be read one at a time, so they're all read once per export"""
+        if self.instanceMatrixCache is None:
+            self.instanceMatrixCache = {}
+            self.instanceSourceCache = {}
+            if hasattr(context, "evaluated_depsgraph_get"):
+                for instance in context.evaluated_depsgraph_get().object_instances:
+                    if instance.is_instance and instance.parent is not None:
+                        self.instanceMatrixCache.setdefault(instance.parent.name, []).append(
+                                [tuple(row) for row in instance.matrix_world])
+                        self.instanceSourceCache.setdefault(instance.parent.name, set()).add(instance.object.name)
+        return self.instanceMatrixCache
+        
+    def instanceSources(self, context):
+        """Names of the objects the scene's instances are copies of by the name of the object that made them"""
+        self.instanceMatrices(context)
+        return self.instanceSourceCache
+        
+    def matrixPlacements(self, matrices):
+        """Splits (N, 4, 4) world matrices into locations, XYZ euler rotations and scales"""
+        rotations = matrices[:, :3, :3]
+        scales = np.linalg.norm(rotations, axis=1)
+        rotations = rotations / np.where(scales == 0, 1.0, scales)[:, np.newaxis, :]
+        return matrices[:, :3, 3], self.matrixEulers(rotations), scales
+        
+    def quaternionEulers(self, quaternions):
+        """Converts (N, 4) WXYZ quaternions to XYZ euler rotations, a zero quaternion is no rotation"""
+        lengths = np.linalg.norm(quaternions, axis=1)
+        quaternions = np.where(lengths[:, np.newaxis] == 0, (1.0, 0.0, 0.0, 0.0),
+                               quaternions / np.where(lengths == 0, 1.0, lengths)[:, np.newaxis])
+        w, x, y, z = quaternions.astype(np.float64).T
+        matrices = np.stack((
+                1 - 2 * (y * y + z * z), 2 * (x * y - w * z), 2 * (x * z + w * y),
+                2 * (x * y + w * z), 1 - 2 * (x * x + z * z), 2 * (y * z - w * x),
+                2 * (x * z - w * y), 2 * (y * z + w * x), 1 - 2 * (x * x + y * y)), axis=1).reshape(-1, 3, 3)
+        return self.matrixEulers(matrices)
+        
+    def matrixEulers(self, matrices):
+        """Converts (N, 3, 3) rotation matrices to XYZ euler rotations the way Blender's to_euler() does"""
+        cosY = np.hypot(matrices[:, 0, 0], matrices[:, 1, 0])
+        regular = cosY > 16 * np.finfo(np.float32).eps
+        x = np.where(regular, np.arctan2(matrices[:, 2, 1], matrices[:, 2, 2]), np.arctan2(-matrices[:, 1, 2], matrices[:, 1, 1]))
+        y = np.arctan2(-matrices[:, 2, 0], cosY)
+        z = np.where(regular, np.arctan2(matrices[:, 1, 0], matrices[:, 0, 0]), 0.0)
+        return np.stack((x, y, z), axis=1)
+        
+    def proxyVertices(self, obj, proxy, vertices):
+        """Moves a proxy's game space vertices into the space of the model it stands in for"""
+        toModel = np.dot(np.linalg.inv(np.array(obj.matrix_world)), np.array(proxy.matrix_world))
+        # The matrices are in Blender's axes, swap Y and Z to apply them to game space vertices
+        swap = [0, 2, 1, 3]
+        toModel = toModel[swap][:, swap]
+        return (np.dot(vertices, toModel[:3, :3].T) + toModel[:3, 3]).astype(np.float32)
+        
+    def objectAnimation(self, obj, context):
+        """Samples an object's location and rotation keyframes once per frame over the scene's frame range"""
+        """Returns None for objects that don't move"""
+        
+        if not self.exportAnimation or obj.animation_data is None or obj.animation_data.action is None:
+            return None
+        action = obj.animation_data.action
+        
+        # Blender's X, Y, Z become the game's X, Z, Y
+        channelNames = {
+            ('location', 0): 'positionX', ('location', 2): 'positionY', ('location', 1): 'positionZ',
+            ('rotation_euler', 0): 'rotationX', ('rotation_euler', 2): 'rotationY', ('rotation_euler', 1): 'rotationZ',
+            }
+        fcurves = [fcurve for fcurve in action.fcurves if (fcurve.data_path, fcurve.array_index) in channelNames]
+        if not fcurves:
+            return None
+        
+        # Every field's times count from the scene's first frame so they all play in step
+        scene = context.scene
+        framesPerSecond = scene.render.fps / scene.render.fps_base
+        frames = np.arange(scene.frame_start, scene.frame_end + 1)
+        times = (frames - scene.frame_start) / framesPerSecond
+        
+        channels = {}
+        for fcurve in fcurves:
+            values = np.array([fcurve.evaluate(frame) for frame in frames])
+            channels[channelNames[(fcurve.data_path, fcurve.array_index)]] = (times, values)
+        return SMB_LZ_Core.Animation(**channels)
+        
+    def gameVector(self, v):
+        """Swaps a Blender (x, y, z) location, rotation or scale into the game's (x, z, y)"""
+        return (v.x, v.z, v.y)
+        
+    def emptyMeshBuffers(self):
+        return np.zeros((0, 3), dtype=np.float32), np.zeros((0, 3), dtype=np.int32)
+        
+    def objectMeshBuffers(self, obj, context):
+        """Returns the game space (vertices, triangles) buffers of an object with its modifiers applied"""
+        """Reads a temporary evaluated mesh, the scene itself is never modified"""
+        
+        if obj.type not in {'MESH', 'CURVE', 'SURFACE', 'FONT', 'META'}:
+            return self.emptyMeshBuffers()
+        
+        # Linked duplicates without modifiers evaluate to the same mesh
+        # (keyed by name so live exports can keep the buffers across scene changes)
+        if len(obj.modifiers) == 0 and obj.type == 'MESH':
+            cacheKey = ("mesh", obj.data.name)
+        else:
+            cacheKey = ("object", obj.name)
+        if cacheKey in self.evaluatedTriangleCache:
+            return self.evaluatedTriangleCache[cacheKey]
+        
+        if hasattr(obj, "evaluated_get"):
+            # 2.80+ evaluates modifiers through the depsgraph and owns the temporary mesh
+            evaluated = obj.evaluated_get(context.evaluated_depsgraph_get())
+            mesh = evaluated.to_mesh()
+            try:
+                buffers = self.meshBuffers(mesh) if mesh is not None else self.emptyMeshBuffers()
+            finally:
+                evaluated.to_mesh_clear()
+        else:
+            # 2.7x creates a new mesh datablock that has to be removed again
+            mesh = obj.to_mesh(context.scene, True, 'PREVIEW')
+            try:
+                buffers = self.meshBuffers(mesh)
+            finally:
+                bpy.data.meshes.remove(mesh)
+                
+        self.evaluatedTriangleCache[cacheKey] = buffers
+        return buffers
         
-        normal = Vector((normal.x, normal.z, normal.y))
+    def meshBuffers(self, mesh):
+        """Returns a mesh's game space vertices and the vertex indices of its triangles"""
         
-        ba = Vector(((vertex2.x - vertex.x, vertex2.y - vertex.y, vertex2.z - vertex.z)))
-        ca = Vector(((vertex3.x - vertex.x, vertex3.y - vertex.y, vertex3.z - vertex.z)))
-
-        normal = self.normalize(self.cross(self.normalize(ba), self.normalize(ca)))
+        coordinates = np.empty(len(mesh.vertices) * 3, dtype=np.float32)
+        mesh.vertices.foreach_get("co", coordinates)
         
-        l = math.sqrt(normal.x * normal.x + normal.z * normal.z)
-
-        if abs(l) < 0.001:
-            cy = 1.0
-            sy = 0.0
+        if hasattr(mesh, "loop_triangles"):
+            mesh.calc_loop_triangles()
+            indices = np.empty(len(mesh.loop_triangles) * 3, dtype=np.int32)
+            mesh.loop_triangles.foreach_get("vertices", indices)
+            indices = indices.reshape(-1, 3)
         else:
-            cy = normal.z / l
-            sy = -normal.x / l
-        cx = l
-        sx = normal.y
-        
-        Rxr0 = Vector((1.0, 0.0, 0.0))
-        Rxr1 = Vector((0.0, cx, sx))
-        Rxr2 = Vector((0.0, -sx, cx))
-        Ryr0 = Vector((cy, 0.0, -sy))
-        Ryr1 = Vector((0.0, 1.0, 0.0))
-        Ryr2 = Vector((sy, 0.0, cy))
-        dotry = self.dotm(ba, Ryr0, Ryr1, Ryr2)
-        dotrxry = self.dotm(dotry, Rxr0, Rxr1, Rxr2)
-        l = math.sqrt(dotrxry.x * dotrxry.x + dotrxry.y * dotrxry.y)
-        cz = dotrxry.x / l
-        sz = -dotrxry.y / l
-        Rzr0 = Vector((cz, sz, 0.0))
-        Rzr1 = Vector((-sz, cz, 0.0))
-        Rzr2 = Vector((0.0, 0.0, 1.0))
-        dotrz = self.dotm(dotrxry, Rzr0, Rzr1, Rzr2)
-        dotry = self.dotm(ca, Ryr0, Ryr1, Ryr2)
-        dotrzrxry = self.dotm(dotrxry, Rzr0, Rzr1, Rzr2)
-        
-        n0v = Vector((dotrzrxry.x - dotrz.x, dotrzrxry.y - dotrz.y, dotrzrxry.z - dotrz.z))
-        n1v = Vector((-dotrzrxry.x, -dotrzrxry.y, -dotrzrxry.z))
-        n0 = self.normalize(self.hat(n0v))
-        n1 = self.normalize(self.hat(n1v))
-        
-        rot_x = 360.0 - self.reverse_angle(cx, sx)
-        rot_y = 360.0 - self.reverse_angle(cy, sy)
-        rot_z = 360.0 - self.reverse_angle(cz, sz)
-        
-        file.write(self.toBigF(vertex.x))              # (4f) X1 position
-        file.write(self.toBigF(vertex.y))              # (4f) Y1 position
-        file.write(self.toBigF(vertex.z))              # (4f) Z1 position
-        file.write(self.toBigF(normal.x))              # (4f) X normal
-        file.write(self.toBigF(normal.y))              # (4f) Y normal
-        file.write(self.toBigF(normal.z))              # (4f) Z normal
-        file.write(self.toShortI(self.cnvAngle(rot_x))) # (2i) X rotation from XY plane
-        file.write(self.toShortI(self.cnvAngle(rot_y))) # (2i) Y rotation from XY plane
-        file.write(self.toShortI(self.cnvAngle(rot_z))) # (2i) Z rotation from XY plane
-        self.writeZeroBytes(file, 2)                    # (2i) Zero
-        file.write(self.toBigF(dotrz.x))               # (4f) DX2X1
-        file.write(self.toBigF(dotrz.y))               # (4f) DY2Y1
-        file.write(self.toBigF(dotrzrxry.x))           # (4f) DX3X1
-        file.write(self.toBigF(dotrzrxry.y))           # (4f) DY3Y1
-        file.write(self.toBigF(n0.x))                  # (4f) Tangent X
-        file.write(self.toBigF(n0.y))                  # (4f) Tangent Y
-        file.write(self.toBigF(n1.x))                  # (4f) Bitangent X
-        file.write(self.toBigF(n1.y))                  # (4f) Bitangent Y
+            # Tessellated faces are triangles or quads, Blender never puts index 0 last in a quad
+            mesh.calc_tessface()
+            faces = np.empty(len(mesh.tessfaces) * 4, dtype=np.int32)
+            mesh.tessfaces.foreach_get("vertices_raw", faces)
+            faces = faces.reshape(-1, 4)
+            isQuad = faces[:, 3] != 0
+            # Split quads into (0, 1, 2) and (0, 2, 3), keeping the face order
+            pairs = np.stack((faces[:, [0, 1, 2]], faces[:, [0, 2, 3]]), axis=1)
+            keep = np.stack((np.ones(len(faces), dtype=bool), isQuad), axis=1)
+            indices = pairs[keep]
+            
+        # Blender is Z up, the game is Y up
+        return coordinates.reshape(-1, 3)[:, [0, 2, 1]], indices
+        
+    def startLiveExport(self):
+        """Starts exporting again with the same options whenever the scene changes"""
+        global liveExport
+        settings = dict((prop.identifier, getattr(self, prop.identifier)) for prop in self.bl_rna.properties
+                        if prop.identifier not in {'rna_type', 'liveExport', 'liveUpdate', 'modalExport'})
+        settings = dict((key, tuple(value) if hasattr(value, "__len__") and not isinstance(value, str) else value)
+                        for key, value in settings.items())
+        liveExport = LiveExport(settings, self.liveExportDelay, self.exportCacheSize * 1024 * 1024)
+        liveExport.start()
+        self.report({'INFO'}, "Live export to %s, export again with Live Export off to stop" % self.telemetry.output)
+        
+    def openExportCache(self):
+        """Opens the export cache next to the output file if it's enabled"""
+        """Live exports keep their fields in memory unless the cache on disk is enabled"""
+        if self.liveUpdate and liveExport is not None and not self.useExportCache:
+            liveExport.exportCache.hits = liveExport.exportCache.misses = 0
+            return liveExport.exportCache
+        if not self.useExportCache:
+            return None
+        # SMB_LZ_Cache.py sits next to this addon
+        import SMB_LZ_Cache
+        return SMB_LZ_Cache.ExportCache(self.filepath + ".cache", self.exportCacheSize * 1024 * 1024)
         
     def clearData(self):
         self.startPositionObjects = []                           # list of start position objects
-        self.numberOfCollisionFields = 0;                        # Number of collision fields/headers
-        self.collisionFieldsOffset = 0                           # Offset to collision fields/headers
-        self.sizeOfHeader = 160                                  # Size of file header (always 0xA0 (160)
-        self.falloutPlaneOffset = 0                              # Offset to fallout plane value
-        self.falloutPlaneY = -32                                   # Fallout plane value
-        self.numberOfGoals = 0                                   # Number of goals
-        self.goalsOffset = 0                                     # Offset to goals
         self.goalObjects = []                                    # List of goal objects
-        self.numberOfBumpers = 0                                 # Number of bumpers
-        self.bumpersOffset = 0                                   # Offset to bumpers
         self.bumperObjects = []                                  # List of bumper objects
-        self.numberOfJamabars = 0                                # Number of jamabars
-        self.jamabarOffset = 0                                   # Offset to jamabars
         self.jamabarObjects = []                                 # List of jamabar objects
-        self.numberOfBananas = 0                                 # Number of bananas
-        self.bananasOffset = 0                                   # Offset to bananas
         self.bananaObjects = []                                  # List of banana objects
-        self.numberOfLevelModels = 0                             # Number of level models
-        self.levelModelsOffset = 0                               # Offset to level models
         self.levelModelObjects = []                              # List of level model objects
-        self.levelModelNameOffsets = []                          # List of offsets to level model name asciis
-        self.levelModelNamePointerOffsets = []                   # List of offsets to the level model name ascii offsets
-        self.levelModelAnimationFrameOffsets = []                # List of animation frame offsets
-        self.levelModelTriangleOffsets = []                      # List of triangle collider offsets
-        self.levelModelCollisionGridPointers = []                # List of collision grid pointer offsets
-        self.numberOfLevelModelTriangles = []                    # List of the number of level model triangles
-        self.levelModelCollisionGridPointerPointers = []         # List of pointer offsets to the collision grid pointer
-        self.numberOfBackgroundModels = 0                        # Number of background models
-        self.backgroundModelsOffset = 0                          # Offset to background models
         self.backgroundModelObjects = []                         # List of background model offsets
-        self.backgroundModelNameOffsets = []                     # List of offsets to model name asciis
-        self.backgroundModelNamePointerOffsets = []              # List of offsets to model name ascii offsets
-        self.backgroundModelCollisionGridPointerPointers = []    # List of pointer offsets to the collision grid pointers
-        self.numberOfReflectiveObjects = 0                       # Number of Reflective objects
-        self.reflectiveObjectsOffset = 0                         # Offset to reflective objects
         self.reflectiveObjects = []                              # List of reflective objects
-        self.reflectiveObjectNameOffsets = []                    # List of offsets to model name asciis
-        self.reflectiveObjectNamePointerOffsets = []             # List of offsets to the model name ascii offsets
-        self.reflectiveObjectAnimationFrameOffsets = []          # List of animation frame offsets
-        self.reflectiveObjectTriangleOffsets = []                # List of triangle collider offsets
-        self.reflectiveObjectCollisionGridPointers = []          # List of collision grid pointer offsets
-        self.numberOfReflectiveObjectTriangles = []              # List of the number of model triangles
-        self.reflectiveObjectCollisionGridPointerPointers = []   # List of pointer offsets to the collision grid pointers
-        self.modelNamesOffset = 0                                # Offset to model names
-        self.offsetToModelNamePointers = 0
+        self.collisionProxies = {}                               # Collision proxy objects by the name of the model they stand in for
+        self.collectionTypes = {}                                # Object type (or None) of each collection/group seen so far
+        self.evaluatedTriangleCache = {}                         # Vertex and triangle buffers of already evaluated meshes/objects
+        self.instanceMatrixCache = None                          # World matrices of the scene's instances by instancer name
+        self.instanceSourceCache = None                          # Names of the objects the scene's instances are copies of by instancer name
+        self.exportCache = None                                  # Persistent cache of per object collision data
         
 
 def menu_func_export(self, context):
@@ -932,6 +1092,7 @@ def register():
 
 
 def unregister():
+    stopLiveExport()
     bpy.utils.unregister_class(SMBLZExporter)
     bpy.types.INFO_MT_file_export.remove(menu_func_export)
 
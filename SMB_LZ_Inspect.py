@@ -0,0 +1,334 @@
+"""SMB LZ inspector
+
+Reads back stages written by the exporter without needing Blender.
+Raw (.lz.raw) files are memory mapped and every section is a lazy view
+over the mapping, nothing is unpacked until it's accessed. Compressed
+(.lz) files have to be decompressed into memory first.
+
+    python SMB_LZ_Inspect.py stage.lz.raw
+    python SMB_LZ_Inspect.py stage.lz --field 0 --cells
+"""
+import argparse
+import mmap
+import struct
+import sys
+
+import SMB_LZ_Compress
+
+sizeOfHeader = 160              # Size of file header (always 0xA0 (160)
+sizeOfCollisionField = 196      # Size of a collision field/header
+sizeOfTriangle = 64             # Size of a collision triangle
+terminatorBytes = b"\xff\xff"   # (2i) Ends each collision grid cell's triangle list
+animationChannels = ['rotationX', 'rotationY', 'rotationZ', 'positionX', 'positionY', 'positionZ']
+
+
+def toDegrees(angle):
+    """Converts a 16 bit game angle to degrees"""
+    return angle * 360.0 / 65536.0
+
+
+class RecordList(object):
+    """Lazy sequence of fixed size records, each one is only built when indexed"""
+    __slots__ = ('stage', 'offset', 'count', 'size', 'record')
+
+    def __init__(self, stage, offset, count, size, record):
+        self.stage = stage
+        self.offset = offset
+        self.count = count
+        self.size = size
+        self.record = record
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self.count))]
+        if index < 0:
+            index += self.count
+        if index < 0 or index >= self.count:
+            raise IndexError("record index out of range")
+        return self.record(self.stage, self.offset + index * self.size)
+
+    def __iter__(self):
+        for i in range(0, self.count):
+            yield self.record(self.stage, self.offset + i * self.size)
+
+
+class Record(object):
+    """View of one record in the stage data"""
+    __slots__ = ('stage', 'offset')
+
+    def __init__(self, stage, offset):
+        self.stage = stage
+        self.offset = offset
+
+    def unpack(self, format, offset=0):
+        return struct.unpack_from(format, self.stage.data, self.offset + offset)
+
+
+class StartPosition(Record):
+    """(20) Start position"""
+    __slots__ = ()
+    position = property(lambda self: self.unpack('>fff'))
+    rotation = property(lambda self: tuple(toDegrees(a) for a in self.unpack('>HHH', 12)))
+
+
+class Goal(Record):
+    """(20) Goal"""
+    __slots__ = ()
+    goalTypes = {0x4200: "blue", 0x4700: "green", 0x5200: "red"}
+    position = property(lambda self: self.unpack('>fff'))
+    rotation = property(lambda self: tuple(toDegrees(a) for a in self.unpack('>HHH', 12)))
+    goalType = property(lambda self: self.goalTypes.get(self.unpack('>H', 18)[0], "unknown"))
+
+
+class ScaledItem(Record):
+    """(32) Bumper or jamabar"""
+    __slots__ = ()
+    position = property(lambda self: self.unpack('>fff'))
+    rotation = property(lambda self: tuple(toDegrees(a) for a in self.unpack('>HHH', 12)))
+    scale = property(lambda self: self.unpack('>fff', 20))
+
+
+class Banana(Record):
+    """(16) Banana"""
+    __slots__ = ()
+    position = property(lambda self: self.unpack('>fff'))
+    bananaType = property(lambda self: "bunch" if self.unpack('>I', 12)[0] == 1 else "single")
+
+
+class LevelModel(Record):
+    """(12) Level model header"""
+    __slots__ = ()
+    name = property(lambda self: self.stage.readName(self.unpack('>I', 4)[0]))
+
+
+class ReflectiveModel(Record):
+    """(8) Reflective model header"""
+    __slots__ = ()
+    name = property(lambda self: self.stage.readName(self.unpack('>I')[0]))
+
+
+class BackgroundModel(Record):
+    """(56) Background model header"""
+    __slots__ = ()
+    name = property(lambda self: self.stage.readName(self.unpack('>I', 4)[0]))
+    position = property(lambda self: self.unpack('>fff', 12))
+    rotation = property(lambda self: tuple(toDegrees(a) for a in self.unpack('>HHH', 24)))
+    scale = property(lambda self: self.unpack('>fff', 32))
+
+
+class Triangle(Record):
+    """(64) Collision triangle"""
+    __slots__ = ()
+    position = property(lambda self: self.unpack('>fff'))
+    normal = property(lambda self: self.unpack('>fff', 12))
+    rotation = property(lambda self: tuple(toDegrees(a) for a in self.unpack('>HHH', 24)))
+    deltas = property(lambda self: self.unpack('>ffff', 32))
+    tangent = property(lambda self: self.unpack('>ff', 48))
+    bitangent = property(lambda self: self.unpack('>ff', 56))
+
+
+class CollisionField(Record):
+    """(196) Collision field/header"""
+    __slots__ = ()
+    center = property(lambda self: self.unpack('>fff'))
+    rotation = property(lambda self: tuple(toDegrees(a) for a in self.unpack('>HHH', 12)))
+    animationOffset = property(lambda self: self.unpack('>I', 20)[0])
+    namePointerOffset = property(lambda self: self.unpack('>I', 24)[0])
+    triangleOffset = property(lambda self: self.unpack('>I', 28)[0])
+    gridPointersOffset = property(lambda self: self.unpack('>I', 32)[0])
+    gridStart = property(lambda self: self.unpack('>ff', 36))
+    gridStep = property(lambda self: self.unpack('>ff', 44))
+    gridCount = property(lambda self: self.unpack('>II', 52))
+
+    @property
+    def name(self):
+        if self.namePointerOffset == 0:
+            return ""
+        return self.stage.readName(struct.unpack_from('>I', self.stage.data, self.namePointerOffset)[0])
+
+    @property
+    def animation(self):
+        """Keyframes (easing, time, value, tangent in, tangent out) of each animated channel, empty without animation"""
+        if self.animationOffset == 0:
+            return {}
+        header = struct.unpack_from('>12I', self.stage.data, self.animationOffset)
+        channels = {}
+        for i, name in enumerate(animationChannels):
+            count, offset = header[2 * i], header[2 * i + 1]
+            if count != 0:
+                channels[name] = [struct.unpack_from('>Iffff', self.stage.data, offset + 20 * k) for k in range(0, count)]
+        return channels
+
+    @property
+    def numberOfCells(self):
+        countX, countZ = self.gridCount
+        return countX * countZ
+
+    def cellOffset(self, index):
+        """Returns the offset of a grid cell's triangle list"""
+        return struct.unpack_from('>I', self.stage.data, self.gridPointersOffset + 4 * index)[0]
+
+    def cell(self, x, z):
+        """Returns the triangle indices listed in grid cell (x, z)"""
+        countX, countZ = self.gridCount
+        return self.cellAt(z * countX + x)
+
+    def cellAt(self, index):
+        """Returns the triangle indices listed in the grid cell with a flat index"""
+        offset = self.cellOffset(index)
+        if offset == 0:
+            return ()
+        data = self.stage.data
+        # Search for the terminator rather than unpacking short by short, it has to be 2 byte aligned
+        end = offset
+        while True:
+            end = data.find(terminatorBytes, end)
+            if end < 0:
+                raise ValueError("Grid cell %d has no terminator" % index)
+            if (end - offset) % 2 == 0:
+                break
+            end += 1
+        return struct.unpack_from('>%dH' % ((end - offset) // 2), data, offset)
+
+    @property
+    def cells(self):
+        # Each "record" is a cell index, the list reads the cell when it's indexed
+        return RecordList(self, 0, self.numberOfCells, 1, lambda field, index: field.cellAt(index))
+
+    @property
+    def numberOfTriangles(self):
+        """The format doesn't store a triangle count, it's one past the highest index any cell uses"""
+        highest = -1
+        for triangles in self.cells:
+            if triangles:
+                highest = max(highest, max(triangles))
+        return highest + 1
+
+    @property
+    def triangles(self):
+        return RecordList(self.stage, self.triangleOffset, self.numberOfTriangles, sizeOfTriangle, Triangle)
+
+
+class Stage(object):
+    """Lazy view over the bytes of an uncompressed SMB LZ stage"""
+
+    def __init__(self, data):
+        self.data = data
+
+    @classmethod
+    def open(cls, path):
+        """Memory maps a stage file, compressed files are decompressed into memory"""
+        with open(path, 'rb') as file:
+            data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        if SMB_LZ_Compress.isCompressed(data):
+            compressed = data
+            data = SMB_LZ_Compress.decompress(compressed)
+            compressed.close()
+        return cls(data)
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def headerInt(self, offset):
+        return struct.unpack_from('>I', self.data, offset)[0]
+
+    def readName(self, offset):
+        """Reads a null terminated model name"""
+        end = self.data.find(b'\0', offset)
+        return bytes(self.data[offset:end]).decode(errors='replace')
+
+    def records(self, countOffset, offsetOffset, size, record):
+        return RecordList(self, self.headerInt(offsetOffset), self.headerInt(countOffset), size, record)
+
+    @property
+    def falloutPlaneY(self):
+        return struct.unpack_from('>f', self.data, self.headerInt(0x14))[0]
+
+    @property
+    def startPositions(self):
+        # The header doesn't count start positions, they fill the gap up to the fallout plane
+        return RecordList(self, sizeOfHeader, (self.headerInt(0x14) - sizeOfHeader) // 20, 20, StartPosition)
+
+    collisionFields = property(lambda self: self.records(0x08, 0x0C, sizeOfCollisionField, CollisionField))
+    goals = property(lambda self: self.records(0x18, 0x1C, 20, Goal))
+    bumpers = property(lambda self: self.records(0x28, 0x2C, 32, ScaledItem))
+    jamabars = property(lambda self: self.records(0x30, 0x34, 32, ScaledItem))
+    bananas = property(lambda self: self.records(0x38, 0x3C, 16, Banana))
+    levelModels = property(lambda self: self.records(0x58, 0x5C, 12, LevelModel))
+    backgroundModels = property(lambda self: self.records(0x68, 0x6C, 56, BackgroundModel))
+    reflectiveModels = property(lambda self: self.records(0x80, 0x84, 8, ReflectiveModel))
+
+
+def printSummary(stage):
+    print("Size:              %d bytes" % len(stage.data))
+    print("Fallout plane Y:   %g" % stage.falloutPlaneY)
+    print("Start positions:   %d" % len(stage.startPositions))
+    print("Collision fields:  %d" % len(stage.collisionFields))
+    print("Goals:             %d" % len(stage.goals))
+    print("Bumpers:           %d" % len(stage.bumpers))
+    print("Jamabars:          %d" % len(stage.jamabars))
+    print("Bananas:           %d" % len(stage.bananas))
+    print("Level models:      %d" % len(stage.levelModels))
+    print("Background models: %d" % len(stage.backgroundModels))
+    print("Reflective models: %d" % len(stage.reflectiveModels))
+
+
+def printField(index, field, showTriangles, showCells):
+    countX, countZ = field.gridCount
+    print("Field %d: %s" % (index, field.name))
+    print("  Triangles at 0x%X, grid pointers at 0x%X" % (field.triangleOffset, field.gridPointersOffset))
+    print("  Grid start (%g, %g) step (%g, %g) cells %dx%d" % (field.gridStart + field.gridStep + (countX, countZ)))
+    for name, keyframes in field.animation.items():
+        print("  %s: %d keyframes %s" % (name, len(keyframes), [(time, value) for easing, time, value, a, b in keyframes]))
+    if showCells:
+        for index, triangles in enumerate(field.cells):
+            print("  Cell (%d, %d): %d triangles %s" % (index % countX, index // countX, len(triangles), list(triangles)))
+    if showTriangles:
+        for index, triangle in enumerate(field.triangles):
+            print("  Triangle %d: position %s normal %s" % (index, triangle.position, triangle.normal))
+
+
+def printItems(stage):
+    for name, items in (("Start", stage.startPositions), ("Goal", stage.goals), ("Bumper", stage.bumpers),
+                        ("Jamabar", stage.jamabars), ("Banana", stage.bananas)):
+        for index, item in enumerate(items):
+            print("%s %d: position %s" % (name, index, item.position))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Inspect an SMB LZ stage (.lz or .lz.raw)")
+    parser.add_argument("path", help="stage file to read")
+    parser.add_argument("--field", type=int, action='append', help="show this collision field (repeatable)")
+    parser.add_argument("--fields", action='store_true', help="show every collision field")
+    parser.add_argument("--triangles", action='store_true', help="list the triangles of the shown fields")
+    parser.add_argument("--cells", action='store_true', help="list the grid cells of the shown fields")
+    parser.add_argument("--items", action='store_true', help="list start positions, goals, bumpers, jamabars and bananas")
+    parser.add_argument("--decompress", metavar="OUTPUT", help="write the uncompressed stage to OUTPUT")
+    args = parser.parse_args(argv)
+
+    with Stage.open(args.path) as stage:
+        if args.decompress:
+            with open(args.decompress, 'wb') as file:
+                file.write(stage.data)
+        printSummary(stage)
+        fields = stage.collisionFields
+        indices = range(0, len(fields)) if args.fields else (args.field or [])
+        for index in indices:
+            printField(index, fields[index], args.triangles, args.cells)
+        if args.items:
+            printItems(stage)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,366 @@
+"""SMB LZ patches
+
+Describes a new export of a stage as a small delta against the previous
+one, so test machines that already have the old file only need the patch.
+The stages are split into their sections (header, items, collision
+fields, triangles, grid cell lists, ...) and each section is compared to
+the same section of the old stage record by record, so a section that
+moved or grew by a few records is still copied rather than resent.
+Pointer sections whose values all moved along with the data they point
+at are stored as a shift instead of new values.
+
+A patch is a 24 byte header followed by zlib compressed operations:
+    (6)  Magic "SMBLZP"
+    (1i) Format version
+    (1i) Compression level of the new stage (0 none, 1 fast, 2 normal, 3 best)
+    (4i) Size of the old uncompressed stage
+    (4i) CRC32 of the old uncompressed stage
+    (4i) Size of the new uncompressed stage
+    (4i) CRC32 of the new uncompressed stage
+Every operation starts with its type byte:
+    0 copy      (4i) old offset, (4i) length
+    1 data      (4i) length, then the bytes
+    2 relocate  (4i) old offset, (4i) word count, (4i) shift added to every non zero big endian word
+
+    python SMB_LZ_Patch.py diff old.lz.raw new.lz.raw -o new.lz.raw.patch
+    python SMB_LZ_Patch.py apply old.lz.raw new.lz.raw.patch -o new.lz.raw
+
+This module doesn't need Blender so it can be used by command line tools.
+"""
+import argparse
+import struct
+import sys
+import zlib
+
+import numpy as np
+
+import SMB_LZ_Compress
+import SMB_LZ_Core
+import SMB_LZ_Inspect
+
+patchMagic = b"SMBLZP"
+patchVersion = 1
+patchHeader = struct.Struct('>6sBBIIII')
+compressionLevels = ['NONE', 'FAST', 'NORMAL', 'BEST']
+
+opCopy = 0
+opData = 1
+opRelocate = 2
+
+# Record size of each section, sections of pointers are compared as relocatable words
+sectionRecords = {
+    'header': 4,
+    'startPositions': 20,
+    'falloutPlane': 4,
+    'goals': 20,
+    'bumpers': 32,
+    'jamabars': 32,
+    'bananas': 16,
+    'modelNamePointers': 4,
+    'collisionFields': SMB_LZ_Inspect.sizeOfCollisionField,
+    'animations': 4,
+    'collisionTriangles': SMB_LZ_Inspect.sizeOfTriangle,
+    'gridCellLists': 2,
+    'gridCellPointers': 4,
+    'levelModels': 12,
+    'reflectiveModels': 8,
+    'backgroundModels': 56,
+    'modelNames': 1,
+    }
+pointerSections = {'modelNamePointers', 'gridCellPointers'}
+
+
+def crc(data):
+    return zlib.crc32(data) & 0xFFFFFFFF
+
+
+def stageSections(data):
+    """Returns the (name, start, end) of every section of an uncompressed stage, in file order"""
+    """The sections cover the whole file, any padding belongs to the section before it"""
+    stage = SMB_LZ_Inspect.Stage(data)
+    size = len(data)
+    if size < SMB_LZ_Inspect.sizeOfHeader:
+        return [('data', 0, size)]
+
+    falloutPlane = stage.headerInt(0x14)
+    starts = [('header', 0), ('startPositions', SMB_LZ_Inspect.sizeOfHeader), ('falloutPlane', falloutPlane)]
+    itemsEnd = falloutPlane + 4
+    for name, records in (('goals', stage.goals), ('bumpers', stage.bumpers),
+                          ('jamabars', stage.jamabars), ('bananas', stage.bananas)):
+        if len(records) != 0:
+            starts.append((name, records.offset))
+            itemsEnd = max(itemsEnd, records.offset + records.count * records.size)
+    starts.append(('modelNamePointers', itemsEnd))
+
+    fields = stage.collisionFields
+    if len(fields) != 0:
+        starts.append(('collisionFields', fields.offset))
+        starts.append(('animations', fields.offset + fields.count * fields.size))
+        triangleOffsets = [field.triangleOffset for field in fields]
+        pointerOffsets = [field.gridPointersOffset for field in fields]
+        starts.append(('collisionTriangles', min(triangleOffsets)))
+        # The grid cell lists start at the lowest offset any cell points at
+        listOffsets = [np.frombuffer(data, dtype='>u4', count=field.numberOfCells, offset=field.gridPointersOffset)
+                       for field in fields if field.numberOfCells != 0]
+        listOffsets = np.concatenate(listOffsets) if listOffsets else np.zeros(0, dtype='>u4')
+        listOffsets = listOffsets[listOffsets != 0]
+        if len(listOffsets) != 0:
+            starts.append(('gridCellLists', int(listOffsets.min())))
+        starts.append(('gridCellPointers', min(pointerOffsets)))
+
+    modelsEnd = None
+    for name, records in (('levelModels', stage.levelModels), ('reflectiveModels', stage.reflectiveModels),
+                          ('backgroundModels', stage.backgroundModels)):
+        if len(records) != 0:
+            starts.append((name, records.offset))
+            modelsEnd = max(modelsEnd or 0, records.offset + records.count * records.size)
+    if modelsEnd is not None:
+        starts.append(('modelNames', modelsEnd))
+
+    # Anything that doesn't fit a well formed stage ends up in a bigger neighbouring section
+    starts = sorted((start, name) for name, start in starts if 0 <= start < size)
+    sections = []
+    for i, (start, name) in enumerate(starts):
+        end = starts[i + 1][0] if i + 1 < len(starts) else size
+        if end > start:
+            sections.append((name, start, end))
+    return sections
+
+
+class PatchWriter(object):
+    """Collects the operations of a patch, joining neighbouring copies"""
+
+    def __init__(self, new):
+        self.new = new
+        self.ops = bytearray()
+        self.pendingCopy = None         # (old offset, length) not yet written
+        self.numberOfCopiedBytes = 0
+        self.numberOfDataBytes = 0
+        self.numberOfRelocatedBytes = 0
+
+    def copy(self, oldOffset, length):
+        self.numberOfCopiedBytes += length
+        if self.pendingCopy is not None and sum(self.pendingCopy) == oldOffset:
+            self.pendingCopy = (self.pendingCopy[0], self.pendingCopy[1] + length)
+            return
+        self.flush()
+        self.pendingCopy = (oldOffset, length)
+
+    def data(self, newOffset, length):
+        self.flush()
+        self.numberOfDataBytes += length
+        self.ops += struct.pack('>BI', opData, length)
+        self.ops += self.new[newOffset:newOffset + length]
+
+    def relocate(self, oldOffset, count, shift):
+        self.flush()
+        self.numberOfRelocatedBytes += 4 * count
+        self.ops += struct.pack('>BIII', opRelocate, oldOffset, count, shift & 0xFFFFFFFF)
+
+    def flush(self):
+        if self.pendingCopy is not None:
+            self.ops += struct.pack('>BII', opCopy, *self.pendingCopy)
+            self.pendingCopy = None
+
+
+def commonShift(old, new):
+    """Most common difference between matching non zero words, the shift of the data they point at"""
+    moved = (old != 0) & (new != 0) & (old != new)
+    if not moved.any():
+        return 0
+    shifts, counts = np.unique((new[moved] - old[moved]).astype(np.uint32), return_counts=True)
+    return int(shifts[np.argmax(counts)])
+
+
+def diffSection(writer, old, oldStart, oldEnd, new, newStart, newEnd, recordSize, pointers):
+    """Adds the operations that rebuild new[newStart:newEnd] from old[oldStart:oldEnd]"""
+    """Records are matched at the same index from the start, or the same index from the end, so one
+    change that adds or removes records in the middle of a section only resends the changed records"""
+    numNew = (newEnd - newStart) // recordSize
+    numOld = (oldEnd - oldStart) // recordSize
+    if numNew == 0 or numOld == 0:
+        writer.data(newStart, newEnd - newStart)
+        return
+    if pointers:
+        newRecords = np.frombuffer(new, dtype='>u4', count=numNew, offset=newStart).astype(np.int64)
+        oldRecords = np.frombuffer(old, dtype='>u4', count=numOld, offset=oldStart).astype(np.int64)
+    else:
+        newRecords = np.frombuffer(new, dtype='V%d' % recordSize, count=numNew, offset=newStart)
+        oldRecords = np.frombuffer(old, dtype='V%d' % recordSize, count=numOld, offset=oldStart)
+
+    # Where each new record would come from, aligned to the start of the section and to its end
+    common = min(numNew, numOld)
+    shiftFromEnd = numOld - numNew
+    kinds = np.zeros(numNew, dtype=np.int8)         # 0 data, 1 copy from the start, 2 from the end, 3-4 relocated
+    sources = np.arange(numNew, dtype=np.int64)
+    endSources = sources + shiftFromEnd
+    fromEnd = endSources >= 0
+
+    kinds[:common][newRecords[:common] == oldRecords[:common]] = 1
+    endMatches = np.zeros(numNew, dtype=bool)
+    endMatches[fromEnd] = newRecords[fromEnd] == oldRecords[endSources[fromEnd]]
+    kinds[(kinds == 0) & endMatches] = 2
+    shifts = [0, 0]
+    if pointers:
+        # Pointers into a section that moved all move by the same amount, zero (no list) stays zero
+        def relocated(newWords, oldWords, shift):
+            return np.where(oldWords == 0, newWords == 0, newWords == ((oldWords + shift) & 0xFFFFFFFF))
+        shifts[0] = commonShift(oldRecords[:common], newRecords[:common])
+        shifts[1] = commonShift(oldRecords[endSources[fromEnd]], newRecords[fromEnd])
+        startRelocated = np.zeros(numNew, dtype=bool)
+        startRelocated[:common] = relocated(newRecords[:common], oldRecords[:common], shifts[0])
+        kinds[(kinds == 0) & startRelocated] = 3
+        endRelocated = np.zeros(numNew, dtype=bool)
+        endRelocated[fromEnd] = relocated(newRecords[fromEnd], oldRecords[endSources[fromEnd]], shifts[1])
+        kinds[(kinds == 0) & endRelocated] = 4
+
+    # One operation per run of records with the same kind
+    boundaries = np.flatnonzero(np.diff(kinds)) + 1
+    runStarts = np.concatenate(([0], boundaries))
+    runEnds = np.concatenate((boundaries, [numNew]))
+    for first, last in zip(runStarts.tolist(), runEnds.tolist()):
+        kind = int(kinds[first])
+        source = first if kind in (1, 3) else first + shiftFromEnd
+        if kind == 0:
+            writer.data(newStart + first * recordSize, (last - first) * recordSize)
+        elif kind in (1, 2):
+            writer.copy(oldStart + source * recordSize, (last - first) * recordSize)
+        else:
+            writer.relocate(oldStart + source * 4, last - first, shifts[kind - 3])
+
+    # Bytes past the last whole record
+    remainder = newStart + numNew * recordSize
+    if remainder < newEnd:
+        writer.data(remainder, newEnd - remainder)
+
+
+def diff(old, new, compressionLevel='NONE'):
+    """Returns a patch that turns the uncompressed stage old into the uncompressed stage new"""
+    """compressionLevel is how apply() should compress the new stage, 'NONE' leaves it uncompressed"""
+    old = bytes(old)
+    new = bytes(new)
+    oldSections = {name: (start, end) for name, start, end in stageSections(old)}
+    writer = PatchWriter(new)
+    for name, newStart, newEnd in stageSections(new):
+        if name not in oldSections:
+            writer.data(newStart, newEnd - newStart)
+            continue
+        oldStart, oldEnd = oldSections[name]
+        diffSection(writer, old, oldStart, oldEnd, new, newStart, newEnd,
+                    sectionRecords.get(name, 1), name in pointerSections)
+    writer.flush()
+
+    header = patchHeader.pack(patchMagic, patchVersion, compressionLevels.index(compressionLevel),
+                              len(old), crc(old), len(new), crc(new))
+    return header + zlib.compress(bytes(writer.ops), 6)
+
+
+def readHeader(patch):
+    """Returns (compression level, old size, old CRC32, new size, new CRC32) of a patch"""
+    if len(patch) < patchHeader.size:
+        raise ValueError("Not an SMB LZ patch, it's too short")
+    magic, version, level, oldSize, oldCrc, newSize, newCrc = patchHeader.unpack_from(patch)
+    if magic != patchMagic:
+        raise ValueError("Not an SMB LZ patch")
+    if version != patchVersion:
+        raise ValueError("Unsupported SMB LZ patch version %d" % version)
+    if level >= len(compressionLevels):
+        raise ValueError("Unknown compression level %d in the patch" % level)
+    return compressionLevels[level], oldSize, oldCrc, newSize, newCrc
+
+
+def apply(old, patch):
+    """Rebuilds the new uncompressed stage from the old uncompressed stage and a patch"""
+    """Raises ValueError when the old stage isn't the one the patch was made from, or the result doesn't match"""
+    compressionLevel, oldSize, oldCrc, newSize, newCrc = readHeader(patch)
+    if len(old) != oldSize or crc(old) != oldCrc:
+        raise ValueError("The patch was made against a different stage than the one it's applied to")
+
+    ops = zlib.decompress(patch[patchHeader.size:])
+    new = bytearray(newSize)
+    position = 0
+    offset = 0
+    while position < len(ops):
+        op = ops[position]
+        if op == opCopy:
+            oldOffset, length = struct.unpack_from('>II', ops, position + 1)
+            position += 9
+            new[offset:offset + length] = old[oldOffset:oldOffset + length]
+        elif op == opData:
+            length, = struct.unpack_from('>I', ops, position + 1)
+            position += 5
+            new[offset:offset + length] = ops[position:position + length]
+            position += length
+        elif op == opRelocate:
+            oldOffset, count, shift = struct.unpack_from('>III', ops, position + 1)
+            position += 13
+            length = 4 * count
+            words = np.frombuffer(old, dtype='>u4', count=count, offset=oldOffset)
+            moved = np.where(words != 0, (words.astype(np.int64) + shift) & 0xFFFFFFFF, 0).astype('>u4')
+            new[offset:offset + length] = moved.tobytes()
+        else:
+            raise ValueError("Unknown patch operation %d" % op)
+        offset += length
+
+    if offset != newSize or crc(new) != newCrc:
+        raise ValueError("The patched stage doesn't match the patch's checksum")
+    return new
+
+
+def readStage(path):
+    """Reads a stage file, decompressing it if it's compressed"""
+    with open(path, 'rb') as file:
+        data = file.read()
+    if SMB_LZ_Compress.isCompressed(data):
+        data = SMB_LZ_Compress.decompress(data)
+    return bytes(data)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Make or apply a delta between two SMB LZ stages")
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+    diffParser = commands.add_parser('diff', help="write a patch from OLD to NEW")
+    diffParser.add_argument("old", help="stage the machines already have (.lz or .lz.raw)")
+    diffParser.add_argument("new", help="stage to patch it into (.lz or .lz.raw)")
+    diffParser.add_argument("-o", "--output", required=True, help="patch file to write")
+    diffParser.add_argument("--compression", choices=compressionLevels,
+                            help="compress the patched stage (by default like NEW)")
+    applyParser = commands.add_parser('apply', help="rebuild the new stage from OLD and a patch")
+    applyParser.add_argument("old", help="stage the patch was made from (.lz or .lz.raw)")
+    applyParser.add_argument("patch", help="patch file")
+    applyParser.add_argument("-o", "--output", required=True, help="stage file to write, can be OLD")
+    args = parser.parse_args(argv)
+
+    try:
+        if args.command == 'diff':
+            # A compressed NEW is patched back into a compressed stage
+            with open(args.new, 'rb') as file:
+                new = file.read()
+            newCompressed = SMB_LZ_Compress.isCompressed(new)
+            if newCompressed:
+                new = SMB_LZ_Compress.decompress(new)
+            old = readStage(args.old)
+            patch = diff(old, new, args.compression or ('NORMAL' if newCompressed else 'NONE'))
+            # Round trip before writing, so a patch that's written always rebuilds NEW
+            if apply(old, patch) != new:
+                raise ValueError("The patch doesn't rebuild %s" % args.new)
+            SMB_LZ_Core.writeFile(args.output, patch)
+            print("Wrote %d byte patch for a %d byte stage" % (len(patch), len(new)))
+        else:
+            with open(args.patch, 'rb') as file:
+                patch = file.read()
+            new = apply(readStage(args.old), patch)
+            compressionLevel = readHeader(patch)[0]
+            if compressionLevel != 'NONE':
+                new = SMB_LZ_Compress.compress(new, compressionLevel)
+            SMB_LZ_Core.writeFile(args.output, new)
+            print("Patched %s, checksum OK" % args.output)
+    except (ValueError, zlib.error) as error:
+        print("error: %s" % error, file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,40 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+# The modules live at the top of the repository rather than in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import SMB_LZ_Core
+
+
+def gridMesh(size, origin=(0.0, 0.0, 0.0)):
+    """Returns the vertices and triangles of a flat size x size grid of quads"""
+    x, z = np.meshgrid(np.arange(size + 1, dtype=np.float64), np.arange(size + 1, dtype=np.float64), indexing='ij')
+    vertices = np.stack((x.ravel(), np.zeros(x.size), z.ravel()), axis=1) + origin
+    corners = (np.arange(size)[:, None] * (size + 1) + np.arange(size)[None, :]).ravel()
+    triangles = np.concatenate((np.stack((corners, corners + 1, corners + size + 2), axis=1),
+                                np.stack((corners, corners + size + 2, corners + size + 1), axis=1)))
+    return vertices, triangles
+
+
+@pytest.fixture
+def stage():
+    """A small stage with one of everything"""
+    stage = SMB_LZ_Core.Stage()
+    stage.startPositions.append(SMB_LZ_Core.StartPosition((0.0, 1.0, 0.0), (0.0, 0.5, 0.0)))
+    stage.falloutPlaneY = -20.0
+    stage.goals.append(SMB_LZ_Core.Goal((8.0, 0.0, 8.0), (0.0, 0.0, 0.0), "green"))
+    stage.bumpers.append(SMB_LZ_Core.ScaledItem((2.0, 0.5, 3.0), (0.0, 0.0, 0.0), (1.0, 1.0, 1.0)))
+    stage.jamabars.append(SMB_LZ_Core.ScaledItem((4.0, 0.5, 3.0), (0.0, 1.0, 0.0), (1.0, 2.0, 1.0)))
+    stage.bananas.append(SMB_LZ_Core.Banana((1.0, 1.0, 1.0)))
+    stage.bananas.append(SMB_LZ_Core.Banana((5.0, 1.0, 1.0), "bunch"))
+    vertices, triangles = gridMesh(12)
+    stage.levelModels.append(SMB_LZ_Core.CollisionModel("floor", vertices, triangles))
+    vertices, triangles = gridMesh(3, origin=(-1.5, 0.0, -1.5))
+    stage.levelModels.append(SMB_LZ_Core.CollisionModel("platform", vertices, triangles, position=(20.0, 2.0, 0.0),
+                                                        rotation=(0.0, 0.3, 0.0)))
+    stage.backgroundModels.append(SMB_LZ_Core.BackgroundModel("sky", (0.0, 0.0, 0.0), (0.0, 0.0, 0.0), (1.0, 1.0, 1.0)))
+    return stage
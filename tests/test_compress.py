@@ -0,0 +1,60 @@
+import os
+
+import pytest
+
+import SMB_LZ_Compress
+import SMB_LZ_Core
+
+levels = sorted(SMB_LZ_Compress.levels)
+
+
+def samples():
+    yield b""
+    yield b"a"
+    yield b"ab"
+    yield b"abc" * 3
+    yield bytes(5000)
+    yield os.urandom(3000)
+    yield b"".join(b"%d," % (i * i % 97) for i in range(4000))
+    # Longer than the ring buffer, with matches reaching back across it
+    block = os.urandom(300)
+    yield block + os.urandom(4000) + block + block[:17] + bytes(40)
+
+
+@pytest.mark.parametrize('level', levels)
+def test_roundtrip(level):
+    for data in samples():
+        compressed = SMB_LZ_Compress.compress(data, level)
+        assert bytes(SMB_LZ_Compress.decompress(compressed)) == data
+
+
+@pytest.mark.parametrize('level', levels)
+def test_stage_roundtrip(stage, level):
+    data = bytes(SMB_LZ_Core.StageWriter(stage).build())
+    compressed = SMB_LZ_Compress.compress(data, level)
+    assert SMB_LZ_Compress.isCompressed(compressed)
+    assert len(compressed) < len(data)
+    assert bytes(SMB_LZ_Compress.decompress(compressed)) == data
+
+
+@pytest.mark.skipif(SMB_LZ_Compress.np is None, reason="needs numpy")
+@pytest.mark.parametrize('level', levels)
+def test_numpy_and_pure_python_encoders_match(stage, level):
+    maxChain, lazy = SMB_LZ_Compress.levels[level]
+    for data in list(samples()) + [bytes(SMB_LZ_Core.StageWriter(stage).build())]:
+        assert SMB_LZ_Compress.encodeTable(data, maxChain, lazy) == SMB_LZ_Compress.encodeChains(data, maxChain, lazy)
+
+
+@pytest.mark.skipif(SMB_LZ_Compress.np is None, reason="needs numpy")
+def test_numpy_encoder_matches_across_match_blocks(monkeypatch):
+    monkeypatch.setattr(SMB_LZ_Compress, 'matchBlockSize', 1000)
+    data = b"".join(b"%d " % (i * 7919 % 1000) for i in range(2000))
+    maxChain, lazy = SMB_LZ_Compress.levels['NORMAL']
+    assert SMB_LZ_Compress.encodeTable(data, maxChain, lazy) == SMB_LZ_Compress.encodeChains(data, maxChain, lazy)
+
+
+def test_compress_without_numpy(monkeypatch):
+    data = b"".join(b"%d," % (i % 50) for i in range(3000))
+    expected = SMB_LZ_Compress.compress(data)
+    monkeypatch.setattr(SMB_LZ_Compress, 'np', None)
+    assert SMB_LZ_Compress.compress(data) == expected
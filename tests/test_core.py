@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+
+import SMB_LZ_Core
+
+
+def randomTriangles(count, seed):
+    rs = np.random.RandomState(seed)
+    triangleVertices = rs.uniform(-50.0, 50.0, (count, 3, 3))
+    # Drop the rare near degenerate ones, the scalar writer divides by their edge lengths
+    edges = np.cross(triangleVertices[:, 1] - triangleVertices[:, 0], triangleVertices[:, 2] - triangleVertices[:, 0])
+    return triangleVertices[np.linalg.norm(edges, axis=1) > 1.0]
+
+
+def writeTriangles(triangleVertices, scalarTriangleWriter):
+    writer = SMB_LZ_Core.StageWriter(SMB_LZ_Core.Stage(), scalarTriangleWriter=scalarTriangleWriter)
+    buffer = bytearray(64 * len(triangleVertices))
+    writer.writeTriangles(buffer, 0, triangleVertices)
+    return bytes(buffer)
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_packTriangles_matches_scalar_writer(seed):
+    triangleVertices = randomTriangles(500, seed)
+    assert writeTriangles(triangleVertices, False) == writeTriangles(triangleVertices, True)
+
+
+def test_packTriangles_matches_scalar_writer_for_axis_aligned_triangles():
+    # Flat and vertical triangles take the special cases of the rotation
+    triangleVertices = np.array([
+        [[0, 0, 0], [1, 0, 0], [0, 0, 1]],
+        [[0, 0, 0], [0, 0, 1], [1, 0, 0]],
+        [[0, 0, 0], [1, 0, 0], [0, 1, 0]],
+        [[0, 0, 0], [0, 1, 0], [0, 0, 1]],
+        [[3, 2, 1], [3, 2, 5], [7, 2, 1]],
+        ], dtype=np.float64)
+    assert writeTriangles(triangleVertices, False) == writeTriangles(triangleVertices, True)
+
+
+def test_scalar_and_packed_stages_match(stage):
+    packed = SMB_LZ_Core.StageWriter(stage).build()
+    scalar = SMB_LZ_Core.StageWriter(stage, scalarTriangleWriter=True).build()
+    assert bytes(packed) == bytes(scalar)
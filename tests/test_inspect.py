@@ -0,0 +1,69 @@
+import math
+
+import numpy as np
+import pytest
+
+import SMB_LZ_Compress
+import SMB_LZ_Core
+import SMB_LZ_Inspect
+
+
+def degrees(radians):
+    """The angle the inspector reads back, angles are stored in 1/65536ths of a turn"""
+    return SMB_LZ_Inspect.toDegrees(int(65536.0 * math.degrees(radians) / 360.0) & 0xFFFF)
+
+
+@pytest.fixture
+def written(stage):
+    return SMB_LZ_Inspect.Stage(bytes(SMB_LZ_Core.StageWriter(stage).build()))
+
+
+def test_items(stage, written):
+    assert written.falloutPlaneY == stage.falloutPlaneY
+    assert [s.position for s in written.startPositions] == [s.position for s in stage.startPositions]
+    assert written.startPositions[0].rotation[1] == pytest.approx(degrees(stage.startPositions[0].rotation[1]))
+    assert [(g.position, g.goalType) for g in written.goals] == [(g.position, g.goalType) for g in stage.goals]
+    assert [(b.position, b.scale) for b in written.bumpers] == [(b.position, b.scale) for b in stage.bumpers]
+    assert [(j.position, j.scale) for j in written.jamabars] == [(j.position, j.scale) for j in stage.jamabars]
+    assert [(b.position, b.bananaType) for b in written.bananas] == [(b.position, b.bananaType) for b in stage.bananas]
+    assert [b.name for b in written.backgroundModels] == [b.name for b in stage.backgroundModels]
+
+
+def test_collision_fields(stage, written):
+    assert [m.name for m in written.levelModels] == [m.name for m in stage.levelModels]
+    fields = written.collisionFields
+    assert len(fields) == len(stage.levelModels)
+    for field, model in zip(fields, stage.levelModels):
+        assert field.name == model.name
+        assert field.center == pytest.approx(model.position)
+        assert field.rotation[1] == pytest.approx(degrees(model.rotation[1]))
+        assert field.numberOfTriangles == len(model.triangles)
+
+        # Every triangle is listed in the cells it's in, and its first vertex is the triangle's position
+        listed = set()
+        for cell in field.cells:
+            listed.update(cell)
+        assert listed == set(range(field.numberOfTriangles))
+        positions = np.array([triangle.position for triangle in field.triangles])
+        expected = model.triangleVertices[:, 0]
+        order = np.lexsort(positions.T)
+        assert positions[order] == pytest.approx(expected[np.lexsort(expected.T)], abs=1e-5)
+
+
+def test_open_files(tmp_path, stage):
+    data = bytes(SMB_LZ_Core.StageWriter(stage).build())
+    raw = tmp_path / "stage.lz.raw"
+    raw.write_bytes(data)
+    compressed = tmp_path / "stage.lz"
+    compressed.write_bytes(SMB_LZ_Compress.compress(data, 'FAST'))
+    for path in (raw, compressed):
+        with SMB_LZ_Inspect.Stage.open(str(path)) as opened:
+            assert bytes(opened.data) == data
+            assert len(opened.collisionFields) == len(stage.levelModels)
+
+
+def test_main_prints_stage(tmp_path, stage, capsys):
+    path = tmp_path / "stage.lz.raw"
+    path.write_bytes(bytes(SMB_LZ_Core.StageWriter(stage).build()))
+    SMB_LZ_Inspect.main([str(path), '--field', '0', '--cells'])
+    assert "floor" in capsys.readouterr().out
@@ -0,0 +1,92 @@
+import pytest
+
+import SMB_LZ_Compress
+import SMB_LZ_Core
+import SMB_LZ_Patch
+from conftest import gridMesh
+
+
+def build(stage):
+    return bytes(SMB_LZ_Core.StageWriter(stage).build())
+
+
+def edits():
+    """Changes made to the sample stage between two exports"""
+    def moveBanana(stage):
+        stage.bananas[0] = SMB_LZ_Core.Banana((1.0, 2.0, 1.0))
+
+    def addBananas(stage):
+        stage.bananas.extend(SMB_LZ_Core.Banana((float(i), 1.0, 0.0)) for i in range(5))
+
+    def removeGoal(stage):
+        del stage.goals[:]
+
+    def moveField(stage):
+        stage.levelModels[1].position = (21.0, 2.0, 0.0)
+
+    def growField(stage):
+        vertices, triangles = gridMesh(14)
+        stage.levelModels[0].vertices = vertices
+        stage.levelModels[0].triangles = triangles
+
+    def addField(stage):
+        vertices, triangles = gridMesh(2, origin=(0.0, 5.0, 0.0))
+        stage.levelModels.append(SMB_LZ_Core.CollisionModel("ledge", vertices, triangles))
+
+    def renameField(stage):
+        stage.levelModels[0].name = "ground"
+
+    return [moveBanana, addBananas, removeGoal, moveField, growField, addField, renameField]
+
+
+@pytest.mark.parametrize('edit', edits(), ids=lambda edit: edit.__name__)
+def test_apply_rebuilds_new(stage, edit):
+    old = build(stage)
+    edit(stage)
+    new = build(stage)
+    patch = SMB_LZ_Patch.diff(old, new)
+    assert bytes(SMB_LZ_Patch.apply(old, patch)) == new
+
+
+def test_unchanged_stage_patch_is_small(stage):
+    old = build(stage)
+    patch = SMB_LZ_Patch.diff(old, old)
+    assert bytes(SMB_LZ_Patch.apply(old, patch)) == old
+    assert len(patch) < len(old) // 20
+
+
+def test_unrelated_stages(stage):
+    old = build(SMB_LZ_Core.Stage())
+    new = build(stage)
+    assert bytes(SMB_LZ_Patch.apply(old, SMB_LZ_Patch.diff(old, new))) == new
+    assert bytes(SMB_LZ_Patch.apply(new, SMB_LZ_Patch.diff(new, old))) == old
+
+
+def test_apply_to_wrong_stage(stage):
+    old = build(stage)
+    stage.bananas.pop()
+    patch = SMB_LZ_Patch.diff(old, build(stage))
+    wrong = bytearray(old)
+    wrong[-1] ^= 0xFF
+    with pytest.raises(ValueError):
+        SMB_LZ_Patch.apply(bytes(wrong), patch)
+    with pytest.raises(ValueError):
+        SMB_LZ_Patch.apply(old, b"not a patch at all, just some bytes")
+
+
+def test_command_line_roundtrip_of_compressed_stage(tmp_path, stage):
+    oldPath = tmp_path / "old.lz"
+    oldPath.write_bytes(SMB_LZ_Compress.compress(build(stage), 'FAST'))
+    stage.bananas.append(SMB_LZ_Core.Banana((0.0, 3.0, 0.0), "bunch"))
+    new = build(stage)
+    newPath = tmp_path / "new.lz"
+    newPath.write_bytes(SMB_LZ_Compress.compress(new, 'FAST'))
+    patchPath = tmp_path / "new.lz.patch"
+    outputPath = tmp_path / "patched.lz"
+
+    assert SMB_LZ_Patch.main(['diff', str(oldPath), str(newPath), '-o', str(patchPath), '--compression', 'FAST']) == 0
+    assert SMB_LZ_Patch.main(['apply', str(oldPath), str(patchPath), '-o', str(outputPath)]) == 0
+    patched = outputPath.read_bytes()
+    assert SMB_LZ_Compress.isCompressed(patched)
+    assert bytes(SMB_LZ_Compress.decompress(patched)) == new
+    assert patched == newPath.read_bytes()